@@ -95,6 +95,12 @@ _C.DATASET.ALL_AS_UNLABELED = False
 ###########################
 _C.DATALOADER = CN()
 _C.DATALOADER.NUM_WORKERS = 4
+# Page-locked host batches, so that non_blocking copies to the GPU overlap compute
+_C.DATALOADER.PIN_MEMORY = True
+# Keep the workers of each client loader alive across federated rounds
+_C.DATALOADER.PERSISTENT_WORKERS = True
+# Number of batches loaded in advance by each worker
+_C.DATALOADER.PREFETCH_FACTOR = 2
 # Apply transformations to an image K times (during training)
 _C.DATALOADER.K_TRANSFORMS = 1
 # img0 denotes image tensor without augmentation
@@ -217,6 +223,13 @@ _C.TEST.SPLIT = "test"
 # If best_val, evaluation is done every epoch (if val data
 # is unavailable, test data will be used)
 _C.TEST.FINAL_MODEL = "last_step"
+# Number of bootstrap replicates for confidence intervals of the
+# fairness metrics (binary tasks only), 0 disables them
+_C.TEST.BOOTSTRAP = 0
+# Score histogram bins of Classification_oph_stream, its AUCs and
+# fairness metrics are then approximate but use bounded memory;
+# 0 keeps the predictions for exact metrics
+_C.TEST.AUC_BINS = 0
 
 ###########################
 # Trainer specifics
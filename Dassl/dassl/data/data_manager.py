@@ -0,0 +1,114 @@
+import importlib
+import torch
+from torch.utils.data import Dataset as TorchDataset
+
+from Dassl.dassl.utils import check_availability
+
+# dataset name (cfg.DATASET.NAME) -> class in the top-level `datasets` package,
+# imported lazily so that a run only needs the dependencies of its own dataset
+AVAI_DATASETS = {
+    "FairFedMed": "datasets.FairFedMed.FairFedMed",
+    "Cifar10": "datasets.cifar10.Cifar10",
+    "Cifar100": "datasets.cifar100.Cifar100",
+    "DomainNet": "datasets.domainnet.DomainNet",
+    "Office": "datasets.office.Office",
+    "Caltech101": "datasets.caltech101.Caltech101",
+    "DescribableTextures": "datasets.dtd.DescribableTextures",
+    "Food101": "datasets.food101.Food101",
+    "OxfordFlowers": "datasets.oxford_flowers.OxfordFlowers",
+    "OxfordPets": "datasets.oxford_pets.OxfordPets",
+}
+
+
+def build_dataset(cfg):
+    check_availability(cfg.DATASET.NAME, list(AVAI_DATASETS.keys()))
+    if cfg.VERBOSE:
+        print("Loading dataset: {}".format(cfg.DATASET.NAME))
+    module_name, cls_name = AVAI_DATASETS[cfg.DATASET.NAME].rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), cls_name)(cfg)
+
+
+def build_data_loader(cfg, data_source, batch_size, is_train=True):
+    """Builds the loader of one client split.
+
+    With NUM_WORKERS > 0 decoding and resizing run in worker processes that,
+    with PERSISTENT_WORKERS, stay alive across federated rounds instead of
+    being re-spawned every time the client's loader is iterated.
+    """
+    num_workers = cfg.DATALOADER.NUM_WORKERS
+    kwargs = {}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = cfg.DATALOADER.PERSISTENT_WORKERS
+        kwargs["prefetch_factor"] = cfg.DATALOADER.PREFETCH_FACTOR
+
+    return torch.utils.data.DataLoader(
+        DatasetWrapper(data_source),
+        batch_size=batch_size,
+        shuffle=is_train,
+        num_workers=num_workers,
+        drop_last=is_train and len(data_source) >= batch_size,
+        pin_memory=cfg.DATALOADER.PIN_MEMORY and torch.cuda.is_available() and cfg.USE_CUDA,
+        **kwargs
+    )
+
+
+class DataManager:
+    """Builds the per-client train/test loaders of a federated dataset.
+
+    The dataset class exposes one data source per client in
+    ``federated_train_x`` / ``federated_test_x``.
+    """
+
+    def __init__(self, cfg):
+        dataset = build_dataset(cfg)
+
+        self.fed_train_loader_x_dict = {}
+        self.fed_test_loader_x_dict = {}
+        for idx in range(cfg.DATASET.USERS):
+            self.fed_train_loader_x_dict[idx] = build_data_loader(
+                cfg, dataset.federated_train_x[idx], cfg.DATALOADER.TRAIN_X.BATCH_SIZE, is_train=True
+            )
+            self.fed_test_loader_x_dict[idx] = build_data_loader(
+                cfg, dataset.federated_test_x[idx], cfg.DATALOADER.TEST.BATCH_SIZE, is_train=False
+            )
+
+        self._num_classes = dataset.num_classes
+        self._num_source_domains = max(len(cfg.DATASET.SOURCE_DOMAINS), 1)
+        self._lab2cname = dataset.lab2cname
+        self.dataset = dataset
+
+    @property
+    def num_classes(self):
+        return self._num_classes
+
+    @property
+    def num_source_domains(self):
+        return self._num_source_domains
+
+    @property
+    def lab2cname(self):
+        return self._lab2cname
+
+    @property
+    def classnames(self):
+        return self.dataset.classnames
+
+
+class DatasetWrapper(TorchDataset):
+    """Turns the (img, label[, attrs]) samples of a client into batch dicts."""
+
+    def __init__(self, data_source):
+        self.data_source = data_source
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __getitem__(self, idx):
+        sample = self.data_source[idx]
+        output = {"img": sample[0], "label": sample[1], "index": idx}
+        if len(sample) > 2:
+            output["attrs"] = sample[2]
+        return output
+
+    def count_by_attribute(self, attribute_type):
+        return self.data_source.count_by_attribute(attribute_type)
@@ -3,7 +3,7 @@ import os
 import numpy as np
 import os.path as osp
 import datetime
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 import torch
 import torch.nn as nn
 from tqdm import tqdm
@@ -18,6 +18,8 @@ from Dassl.dassl.utils import (
 )
 from Dassl.dassl.modeling import build_head, build_backbone
 from Dassl.dassl.evaluation import build_evaluator
+from utils.fed_utils import trainable_state_keys
+from utils.profiler import profiler
 
 from .utils import get_world_size, get_local_rank
 from torch.nn.parallel import DistributedDataParallel
@@ -113,6 +115,8 @@ class TrainerBase:
         self._optims = OrderedDict()
         self._scheds = OrderedDict()
         self._writer = None
+        # (device, dtype) -> [(state_dict key, live tensor)] of the trainable tensors, built on first use
+        self._trainable = None
 
     def register_model(self, name="model", model=None, optim=None, sched=None):
         if self.__dict__.get("_models") is None:
@@ -183,6 +187,45 @@ class TrainerBase:
         }
         torch.save(state_dict, filename)
 
+    def trainable_tensors(self):
+        """The live tensors that change during local training, grouped by (device, dtype)."""
+        if self._trainable is None:
+            state = self.model.state_dict(keep_vars=True)
+            self._trainable = defaultdict(list)
+            for key in trainable_state_keys(self.model):
+                tensor = state[key]
+                self._trainable[(tensor.device, tensor.dtype)].append((key, tensor))
+        return self._trainable
+
+    @profiler.timed("state_swap")
+    @torch.no_grad()
+    def get_trainable_state(self):
+        """
+        Copy of the trainable tensors as a partial state_dict, packed into one
+        flat buffer per (device, dtype); the values are views into it.
+        """
+        state = {}
+        for group in self.trainable_tensors().values():
+            flat = torch.cat([tensor.reshape(-1) for _, tensor in group])
+            offset = 0
+            for key, tensor in group:
+                state[key] = flat[offset:offset + tensor.numel()].view(tensor.shape)
+                offset += tensor.numel()
+        return state
+
+    @profiler.timed("state_swap")
+    @torch.no_grad()
+    def set_trainable_state(self, weights):
+        """
+        Copy the trainable tensors found in `weights` into the model in place.
+        Other keys are ignored, frozen tensors are never written, so this
+        replaces load_state_dict(weights, strict=False) for client switches.
+        """
+        for group in self.trainable_tensors().values():
+            for key, tensor in group:
+                if key in weights:
+                    tensor.copy_(weights[key])
+
     def resume_model_if_exist(self, directory):
         names = self.get_model_names()
         file_missing = False
@@ -326,13 +369,15 @@ class TrainerBase:
 
     def model_backward(self, loss):
         self.detect_anomaly(loss)
-        loss.backward()
+        with profiler.phase("backward"):
+            loss.backward()
 
     def model_update(self, names=None):
         names = self.get_model_names(names)
-        for name in names:
-            if self._optims[name] is not None:
-                self._optims[name].step()
+        with profiler.phase("optimizer_step"):
+            for name in names:
+                if self._optims[name] is not None:
+                    self._optims[name].step()
 
     def model_backward_and_update(self, loss, names=None):
         self.model_zero_grad(names)
@@ -362,6 +407,8 @@ class SimpleTrainer(TrainerBase):
         self.build_model()
         self.evaluator = build_evaluator(cfg, lab2cname=self.lab2cname)
         self.best_result = -np.inf
+        # client idx -> total seconds spent waiting on its dataloader
+        self.data_wait = defaultdict(float)
 
     def check_cfg(self, cfg):
         """Check whether some variables are set correctly for
@@ -424,6 +471,7 @@ class SimpleTrainer(TrainerBase):
             # self.model = nn.DataParallel(self.model)
 
     def train(self,idx=-1,global_epoch=0,is_fed=False,is_last_client=False,global_weight=None, fedprox=False, mu=0.5):
+        profiler.client = idx
         super().train(self.start_epoch, self.max_epoch,idx,global_epoch,is_fed,is_last_client,global_weight,fedprox,mu)
 
     def fed_before_train(self, is_global = False):
@@ -519,10 +567,13 @@ class SimpleTrainer(TrainerBase):
             self.save_model_with_grad(filename)
 
     @torch.no_grad()
+    @profiler.timed("evaluation")
     def test(self, split=None, is_global=False, current_epoch=0, idx=-1, global_test=False):
         """A generic testing pipeline."""
+        profiler.client = idx
         self.set_model_mode("eval")
         self.evaluator.reset()
+        self.evaluator.client, self.evaluator.round = idx, current_epoch
 
         if split is None:
             split = self.cfg.TEST.SPLIT
@@ -576,8 +627,8 @@ class SimpleTrainer(TrainerBase):
         input = batch["img"]
         label = batch["label"]
 
-        input = input.to(self.device)
-        label = label.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
 
         return input, label
 
@@ -670,9 +721,9 @@ class TrainerXU(SimpleTrainer):
         label_x = batch_x["label"]
         input_u = batch_u["img"]
 
-        input_x = input_x.to(self.device)
-        label_x = label_x.to(self.device)
-        input_u = input_u.to(self.device)
+        input_x = input_x.to(self.device, non_blocking=True)
+        label_x = label_x.to(self.device, non_blocking=True)
+        input_u = input_u.to(self.device, non_blocking=True)
 
         return input_x, label_x, input_u
 
@@ -694,6 +745,7 @@ class TrainerX(SimpleTrainer):
         end = time.time()
         for self.batch_idx, batch in enumerate(loader):
             data_time.update(time.time() - end)
+            profiler.add("data_wait", data_time.val)
             if fedprox:
                 loss_summary = self.forward_backward(batch, global_weight=global_weight, fedprox=fedprox, mu=mu)
             else:
@@ -737,13 +789,16 @@ class TrainerX(SimpleTrainer):
 
             end = time.time()
 
+        self.data_wait[idx] += data_time.sum
+        self.write_scalar("train/data_wait/" + str(idx), self.data_wait[idx], global_epoch * self.max_epoch + self.epoch)
+
     def parse_batch_train(self, batch):
         input = batch["img"]
         label = batch["label"]
         domain = batch["domain"]
 
-        input = input.to(self.device)
-        label = label.to(self.device)
-        domain = domain.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
+        domain = domain.to(self.device, non_blocking=True)
 
         return input, label, domain
\ No newline at end of file
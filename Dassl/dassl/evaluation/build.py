@@ -1,8 +1,9 @@
 from Dassl.dassl.utils import Registry, check_availability
-from evaluation.evaluator_oph import Classification_oph
+from evaluation.evaluator_oph import Classification_oph, Classification_oph_stream
 
 EVALUATOR_REGISTRY = Registry("EVALUATOR")
 EVALUATOR_REGISTRY.register(Classification_oph)
+EVALUATOR_REGISTRY.register(Classification_oph_stream)
 
 
 def build_evaluator(cfg, **kwargs):
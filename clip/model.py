@@ -1,3 +1,5 @@
+import inspect
+import math
 from collections import OrderedDict
 from typing import Tuple, Union
 
@@ -5,8 +7,108 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 import pdb
 
+# torch >= 1.11 asks for the checkpoint variant, 1.10 only has the reentrant one
+_CHECKPOINT_KWARGS = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def use_checkpoint(num_checkpointed, i):
+    """Whether unit i is checkpointed when the first `num_checkpointed` units are (-1: all)."""
+    return (num_checkpointed < 0 or i < num_checkpointed) and torch.is_grad_enabled()
+
+
+def checkpoint_module(module, fn, *args):
+    """
+    fn(*args) without keeping the activations inside `module`, they are
+    recomputed in the backward pass.
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+
+    def run(*args):
+        # the first pass runs without grad, the recompute in backward with grad,
+        # which must not update the BatchNorm running statistics a second time
+        # (in train mode they normalize with batch statistics either way)
+        if not torch.is_grad_enabled() or not bns:
+            return fn(*args)
+        tracked = [bn.track_running_stats for bn in bns]
+        for bn in bns:
+            bn.track_running_stats = False
+        try:
+            return fn(*args)
+        finally:
+            for bn, track in zip(bns, tracked):
+                bn.track_running_stats = track
+
+    if not torch.is_grad_enabled():
+        return fn(*args)
+    if not any(torch.is_tensor(arg) and arg.requires_grad for arg in args):
+        if not any(p.requires_grad for p in module.parameters()):
+            # frozen, there are no activations to keep
+            return fn(*args)
+        # reentrant checkpointing only backpropagates into the module if an input requires grad
+        anchor = torch.empty(0, device=args[0].device, requires_grad=True)
+        return checkpoint(lambda anchor, *args: run(*args), anchor, *args,
+                          preserve_rng_state=False, **_CHECKPOINT_KWARGS)
+    return checkpoint(run, *args, preserve_rng_state=False, **_CHECKPOINT_KWARGS)
+
+
+def set_grad_checkpoint(visual, num_checkpointed):
+    """
+    Checkpoint the first `num_checkpointed` blocks of a ModifiedVisionTransformer
+    or residual stages of a ModifiedResNet_GLP_OT (-1: all).
+    Returns a description of what is checkpointed.
+    """
+    if isinstance(visual, ModifiedResNet_GLP_OT):
+        target, units = visual, 'residual stages'
+        total = 4
+    else:
+        target, units = visual.transformer, 'transformer blocks'
+        total = len(visual.transformer.resblocks)
+    target.grad_checkpoint = num_checkpointed
+    num = total if num_checkpointed < 0 else min(num_checkpointed, total)
+    return f'{num}/{total} {units}'
+
+
+def interpolate_positional_embedding(positional_embedding, grid):
+    """Bicubic resize of a (1 + g * g) x d positional embedding, class token first, to (1 + grid * grid) x d."""
+    cls_pos, patch_pos = positional_embedding[:1], positional_embedding[1:]
+    g = math.isqrt(patch_pos.shape[0])
+    if g == grid:
+        return positional_embedding
+    patch_pos = patch_pos.float().reshape(1, g, g, -1).permute(0, 3, 1, 2)
+    patch_pos = F.interpolate(patch_pos, size=(grid, grid), mode='bicubic', align_corners=False)
+    patch_pos = patch_pos.permute(0, 2, 3, 1).reshape(grid * grid, -1).to(positional_embedding.dtype)
+    return torch.cat([cls_pos, patch_pos])
+
+
+def set_input_resolution(visual, resolution):
+    """
+    Adapt a CLIP image encoder to square inputs of `resolution` pixels by
+    interpolating its positional embedding (ViT) or the one of its attention
+    pooling (ResNet) to the new token grid. Call it before freezing
+    parameters, the embedding is replaced. Nothing changes at the
+    pretrained resolution.
+    """
+    if resolution == visual.input_resolution:
+        return
+    print(f"Interpolating the positional embeddings from {visual.input_resolution} to {resolution} pixels")
+    if hasattr(visual, 'attnpool'):
+        # stem: conv stride 2 (padding 1) and avgpool 2, then 3 stages with avgpool 2
+        grid = (resolution + 1) // 2 // 2 // 2 // 2 // 2
+        module = visual.attnpool
+        module.spacial_dim = grid
+    else:
+        grid = resolution // visual.conv1.kernel_size[0]
+        module = visual
+    assert grid > 0, f'input resolution {resolution} is too small'
+    with torch.no_grad():
+        module.positional_embedding = nn.Parameter(
+            interpolate_positional_embedding(module.positional_embedding.data, grid)
+        )
+    visual.input_resolution = resolution
+
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -77,39 +179,24 @@ class AttentionPool2d(nn.Module):
         x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)  # (HW+1)NC
         x = x + self.positional_embedding[:, None, :].to(x.dtype)  # (HW+1)NC
 
-        if attr is None:
-            q_proj_weight=self.q_proj.weight
-            k_proj_weight=self.k_proj.weight
-            v_proj_weight=self.v_proj.weight
-            out_proj_weight=self.c_proj.weight
-            q_proj_bias=self.q_proj.bias
-            k_proj_bias=self.k_proj.bias
-            v_proj_bias=self.v_proj.bias
-            out_proj_bias=self.c_proj.bias
-        else:
-            q_proj_weight=self.q_proj.weight(x, attr)
-            k_proj_weight=self.k_proj.weight(x, attr)
-            v_proj_weight=self.v_proj.weight(x, attr)
-            out_proj_weight=self.c_proj.weight(x, attr)
-            q_proj_bias=self.q_proj.bias()
-            k_proj_bias=self.k_proj.bias()
-            v_proj_bias=self.v_proj.bias()
-            out_proj_bias=self.c_proj.bias()
+        if attr is not None:
+            return self.forward_attr(x, attr)
+
         x, _ = F.multi_head_attention_forward(
             query=x, key=x, value=x,
             embed_dim_to_check=x.shape[-1],
             num_heads=self.num_heads,
-            q_proj_weight=q_proj_weight,
-            k_proj_weight=k_proj_weight,
-            v_proj_weight=v_proj_weight,
+            q_proj_weight=self.q_proj.weight,
+            k_proj_weight=self.k_proj.weight,
+            v_proj_weight=self.v_proj.weight,
             in_proj_weight=None,
-            in_proj_bias=torch.cat([q_proj_bias, k_proj_bias, v_proj_bias]),
+            in_proj_bias=torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias]),
             bias_k=None,
             bias_v=None,
             add_zero_attn=False,
             dropout_p=0,
-            out_proj_weight=out_proj_weight,
-            out_proj_bias=out_proj_bias,
+            out_proj_weight=self.c_proj.weight,
+            out_proj_bias=self.c_proj.bias,
             use_separate_proj_weight=True,
             training=self.training,
             need_weights=False
@@ -117,6 +204,25 @@ class AttentionPool2d(nn.Module):
 
         return x
 
+    def forward_attr(self, x, attr):
+        # The projections are (Fair)LoRA layers: calling them keeps the frozen
+        # weight shared and adds the per-attribute low-rank term to the
+        # activations, instead of materializing a c_out x c_in weight per sample.
+        L, N, C = x.shape
+        head_dim = C // self.num_heads
+        q = self.q_proj(x, attr) * head_dim ** -0.5
+        k = self.k_proj(x, attr)
+        v = self.v_proj(x, attr)
+        q = q.reshape(L, N * self.num_heads, head_dim).transpose(0, 1)
+        k = k.reshape(L, N * self.num_heads, head_dim).transpose(0, 1)
+        v = v.reshape(L, N * self.num_heads, head_dim).transpose(0, 1)
+
+        attn = torch.softmax(q @ k.transpose(1, 2), dim=-1)  # (N*heads) x L x L
+        x = (attn @ v).transpose(0, 1).reshape(L, N, C)
+        x = self.c_proj(x, attr)
+
+        return x
+
 # class AttentionPool2d(nn.Module):
 #     def __init__(self, spacial_dim: int, embed_dim: int, num_heads: int, output_dim: int = None):
 #         super().__init__()
@@ -257,6 +363,9 @@ class ModifiedResNet_GLP_OT(nn.Module):
         embed_dim = width * 32  # the ResNet feature dimension
         self.attnpool = AttentionPool2d(input_resolution // 32, embed_dim, heads, output_dim)
 
+        # number of residual stages, from layer1, whose activations are recomputed in backward (-1: all)
+        self.grad_checkpoint = 0
+
     def _make_layer(self, planes, blocks, stride=1):
         layers = [Bottleneck(self._inplanes, planes, stride)]
 
@@ -274,27 +383,20 @@ class ModifiedResNet_GLP_OT(nn.Module):
             x = self.avgpool(x)
             return x
 
+        def run_stage(stage):
+            def run(x, attr):
+                for layer in stage:
+                    x = layer(x) if attr is None else layer(x, attr)
+                return x
+            return run
+
         x = x.type(self.conv1.weight.dtype)
         x = stem(x)
-        if attr is None:
-            for layer in self.layer1:
-                x = layer(x)
-            for layer in self.layer2:
-                x = layer(x)
-            for layer in self.layer3:
-                x = layer(x)
-            for layer in self.layer4:
-                x = layer(x)
-
-        else:
-            for layer in self.layer1:
-                x = layer(x, attr)
-            for layer in self.layer2:
-                x = layer(x, attr)
-            for layer in self.layer3:
-                x = layer(x, attr)
-            for layer in self.layer4:
-                x = layer(x, attr)
+        for i, stage in enumerate([self.layer1, self.layer2, self.layer3, self.layer4]):
+            if use_checkpoint(self.grad_checkpoint, i):
+                x = checkpoint_module(stage, run_stage(stage), x, attr)
+            else:
+                x = run_stage(stage)(x, attr)
         #bs, 2048, 7, 7
         x = self.attnpool(x, attr)
 
@@ -366,11 +468,16 @@ class Transformer(nn.Module):
         current_trainer = design_details['trainer']
         # self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
         self.resblocks = nn.ModuleList([ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
+        # number of blocks, from the input side, whose activations are recomputed in backward (-1: all)
+        self.grad_checkpoint = 0
 
     def forward(self, x: torch.Tensor, attr=None):
         # return self.resblocks(x, attr=attr)
-        for block in self.resblocks:
-            x = block(x, attr)
+        for i, block in enumerate(self.resblocks):
+            if use_checkpoint(self.grad_checkpoint, i):
+                x = checkpoint_module(block, block, x, attr)
+            else:
+                x = block(x, attr)
         return x
 
 
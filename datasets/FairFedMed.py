@@ -1,6 +1,6 @@
 import os
 
-from utils.data_utils import FairFedMedDataset
+from utils.data_utils import FairFedMedDataset, PackedFairFedMedDataset
 
 # @DATASET_REGISTRY.register()
 class FairFedMed():
@@ -11,30 +11,37 @@ class FairFedMed():
         self.dataset_dir = os.path.join(root, self.dataset_dir)
         self.num_classes = 2
 
+        # packed memmap backend of preprocessed samples, see utils.data_utils.pack_fairfedmed_split
+        dataset_cls = PackedFairFedMedDataset if cfg.DATASET.PACKED else FairFedMedDataset
+
         federated_train_x = []
         federated_test_x = []
         for net_id in range(cfg.DATASET.USERS):
-            train_set = FairFedMedDataset(
+            train_set = dataset_cls(
                 base_path=self.dataset_dir, 
                 site=net_id+1, 
                 attribute_type=cfg.DATASET.ATTRIBUTE_TYPE, 
                 attributes=cfg.DATASET.ATTRIBUTES,
                 modality_type=cfg.DATASET.MODALITY_TYPE,
-                resolution=224, 
+                resolution=cfg.INPUT.SIZE[0], 
                 depth=3, 
                 train=True, 
+                uint8=cfg.DATASET.UINT8,
+                slice_step=cfg.DATASET.OCT_SLICE_STEP,
                 # transform=None
             )
 
-            test_set = FairFedMedDataset(
+            test_set = dataset_cls(
                 base_path=self.dataset_dir, 
                 site=net_id+1, 
                 attribute_type=cfg.DATASET.ATTRIBUTE_TYPE,
                 attributes=cfg.DATASET.ATTRIBUTES,
                 modality_type=cfg.DATASET.MODALITY_TYPE,
-                resolution=224, 
+                resolution=cfg.INPUT.SIZE[0], 
                 depth=3, 
                 train=False, 
+                uint8=cfg.DATASET.UINT8,
+                slice_step=cfg.DATASET.OCT_SLICE_STEP,
                 # transform=None
             )
 
@@ -4,7 +4,9 @@ from collections import OrderedDict, defaultdict
 import torch
 from sklearn.metrics import f1_score, confusion_matrix
 
-from .metrics import compute_auc, evalute_comprehensive_perf_scores
+from .metrics import (
+    binned_auc, bootstrap_fairness_ci, compute_auc, evalute_comprehensive_perf_scores, evalute_fairness_binned
+)
 
 
 class Classification_oph:
@@ -18,6 +20,9 @@ class Classification_oph:
         self._per_class_res = None
         self._y_true = []
         self._y_pred = []
+        # set by trainer.test(), they pick the bootstrap stream
+        self.client = -1
+        self.round = -1
         if cfg.TEST.PER_CLASS_RESULT:
             assert lab2cname is not None
             self._per_class_res = defaultdict(list)
@@ -99,18 +104,24 @@ class Classification_oph:
             f"* auc: {auc:.2f}%"
         )
 
+        self._report_fairness(results, evalute_comprehensive_perf_scores(pred_prob, gt, attr), len(attr))
+
+        if self.cfg.TEST.BOOTSTRAP > 0 and (pred_prob.ndim == 1 or pred_prob.shape[-1] == 2):
+            self._report_ci(results, pred_prob, gt, attr)
+
+        return results
+
+    def _report_fairness(self, results, fairness, num_attrs):
         overall_acc, esaccs_by_attrs, \
         overall_auc, esaucs_by_attrs, aucs_by_attrs, \
-        dpds, eods, aods, between_group_disparity = evalute_comprehensive_perf_scores(
-            pred_prob, gt, attr
-        )
+        dpds, eods, aods, between_group_disparity = fairness
         print(
             "=> result_oph\n"
             f"* overall_acc: {(100*overall_acc):.2f}%\n" 
             f"* overall_auc: {(100*overall_auc):.2f}%\n"
         )
 
-        for idx in range(len(attr)):
+        for idx in range(num_attrs):
             attr_cur = self.cfg.DATASET.ATTRIBUTES[idx]
             print(
                 f"* esacc_{attr_cur}: {(100*esaccs_by_attrs[idx]):.2f}%\n"
@@ -142,4 +153,182 @@ class Classification_oph:
         results['aods'] = aods  # list
         results['between_group_disparity'] = between_group_disparity  # list
 
-        return results
\ No newline at end of file
+    def _report_ci(self, results, pred_prob, gt, attr):
+        # SEED < 0 is an unseeded run; otherwise every client and round gets its own stream
+        seed = None
+        if self.cfg.SEED >= 0:
+            seed = [self.cfg.SEED, self.round + 1, self.client + 1]
+        ci = bootstrap_fairness_ci(
+            pred_prob, gt, attr, num_replicates=self.cfg.TEST.BOOTSTRAP, seed=seed
+        )
+        print(
+            f"=> 95% CI ({self.cfg.TEST.BOOTSTRAP} bootstrap replicates)\n"
+            f"* overall_acc: [{100*ci['overall_acc'][0]:.2f}, {100*ci['overall_acc'][1]:.2f}]%\n"
+            f"* overall_auc: [{100*ci['overall_auc'][0]:.2f}, {100*ci['overall_auc'][1]:.2f}]%"
+        )
+        for idx in range(len(attr)):
+            attr_cur = self.cfg.DATASET.ATTRIBUTES[idx]
+            print('\n'.join([
+                f"* {name}_{attr_cur}: [{100*ci[key][0][idx]:.2f}, {100*ci[key][1][idx]:.2f}]%"
+                for name, key in [('esacc', 'esaccs_by_attrs'), ('esauc', 'esaucs_by_attrs'),
+                                  ('dpd', 'dpds'), ('eod', 'eods'), ('aod', 'aods')]
+            ]))
+        # a dict, so trainer.test() does not log it as a scalar
+        results['ci'] = ci
+
+
+class Classification_oph_stream(Classification_oph):
+    """
+    Classification_oph without a host sync per batch.
+
+    process() only queues device ops: predictions are counted into one
+    on-device buffer, which evaluate() copies to the host once.
+    With TEST.AUC_BINS = 0 the probabilities are kept on the device as well
+    and the metrics are exact. With TEST.AUC_BINS > 0 (binary tasks) no
+    sample is kept: the positive-class scores go into per-group histograms
+    of AUC_BINS bins and AUCs and fairness metrics are computed from the
+    counts, so memory does not grow with the size of the split.
+
+    Group slots cover the attribute values seen so far, including -1
+    (unknown), which is a group of its own as in Classification_oph. The
+    range is read from the attributes, which the trainers leave on the host.
+    """
+
+    def __init__(self, cfg, lab2cname=None, **kwargs):
+        super().__init__(cfg, lab2cname, **kwargs)
+        self.num_bins = cfg.TEST.AUC_BINS
+        self._counts = None
+
+    def reset(self):
+        super().reset()
+        self._counts = None
+
+    def _layout(self, num_groups):
+        # flat layout: confusion matrix | per-group confusion matrices | per-group histograms
+        self._shapes = [(self._num_classes, self._num_classes)]
+        if self.num_bins > 0:
+            self._shapes += [(self._num_attrs, num_groups, 2, 2), (self._num_attrs, num_groups, 2, self.num_bins)]
+        self._offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self._shapes])
+        self._num_groups = num_groups
+
+    def _unpack(self, counts):
+        return [counts[start:end].reshape(shape) for shape, start, end in
+                zip(self._shapes, self._offsets[:-1], self._offsets[1:])]
+
+    def _init_counts(self, num_classes, num_attrs, device):
+        self._num_classes, self._num_attrs = num_classes, num_attrs
+        # slot i counts the attribute value group_lo + i
+        self._group_lo = 0
+        self._layout(0)
+        self._counts = torch.zeros(self._offsets[-1], dtype=torch.long, device=device)
+
+    def _fit_groups(self, lo, hi):
+        """Grow the group slots to cover the attribute values lo..hi, keeping the counts."""
+        if self._num_groups > 0:
+            lo, hi = min(lo, self._group_lo), max(hi, self._group_lo + self._num_groups - 1)
+        if self._num_groups > 0 and lo == self._group_lo and hi - lo + 1 == self._num_groups:
+            return
+        conf, group_conf, group_hist = self._unpack(self._counts)
+        pad = (self._group_lo - lo, hi - self._group_lo - self._num_groups + 1) if self._num_groups > 0 else (0, hi - lo + 1)
+        grown = [conf] + [torch.cat([
+            t.new_zeros(t.shape[:1] + (pad[0],) + t.shape[2:]), t, t.new_zeros(t.shape[:1] + (pad[1],) + t.shape[2:])
+        ], dim=1) for t in (group_conf, group_hist)]
+        self._group_lo = lo
+        self._layout(hi - lo + 1)
+        self._counts = torch.cat([t.reshape(-1) for t in grown])
+
+    def process(self, mo, gt, attr):
+        if mo.dtype == torch.float16:
+            mo = mo.to(torch.float32)
+
+        if mo.shape == gt.shape:
+            prob = mo.sigmoid()    # binary
+            pred = (prob >= 0.5).long()
+            num_classes = 2
+        else:
+            prob = mo.softmax(-1)
+            pred = mo.argmax(-1)
+            num_classes = mo.shape[1]
+        gt = gt.long()
+        if self._counts is None:
+            self._init_counts(num_classes, attr.shape[0], mo.device)
+
+        index = [gt * num_classes + pred]
+        if self.num_bins > 0:
+            if num_classes != 2:
+                raise ValueError(f'TEST.AUC_BINS needs a binary task, got {num_classes} classes')
+            score = prob if prob.dim() == 1 else prob[:, 1]
+            bins = (score * self.num_bins).long().clamp_(0, self.num_bins - 1)
+            # a copy only if the attributes were moved to the device
+            attr_host = attr.cpu()
+            self._fit_groups(int(attr_host.min()), int(attr_host.max()))
+            attr = attr.to(mo.device).long() - self._group_lo
+            group = attr + self._num_groups * torch.arange(attr.shape[0], device=attr.device)[:, None]
+            index.append(self._offsets[1] + (group * 2 + gt) * 2 + pred)
+            index.append(self._offsets[2] + (group * 2 + gt) * self.num_bins + bins)
+        else:
+            self._pred_prob.append(prob)
+            self._gt.append(gt)
+            self._attr.append(attr)
+
+        # index_add_ rather than bincount, which syncs to size its output on cuda
+        index = torch.cat([i.reshape(-1) for i in index])
+        self._counts.index_add_(0, index, torch.ones_like(index))
+
+    def evaluate(self):
+        results = OrderedDict()
+        counts = self._unpack(self._counts.cpu().numpy())
+        conf = counts[0]
+
+        total = int(conf.sum())
+        correct = int(np.trace(conf))
+        acc = 100.0 * correct / total
+        err = 100.0 - acc
+        # macro F1 over the classes present in the labels, as f1_score(labels=np.unique(y_true))
+        present = conf.sum(1) > 0
+        tp = np.diag(conf)[present]
+        macro_f1 = 100.0 * np.mean(2 * tp / (conf.sum(1)[present] + conf.sum(0)[present]))
+
+        if self.num_bins > 0:
+            group_conf, group_hist = counts[1:]
+            auc = 100 * binned_auc(group_hist[0].sum(0))
+        else:
+            pred_prob = torch.cat(self._pred_prob).cpu().numpy()
+            gt = torch.cat(self._gt).cpu().numpy()
+            attr = torch.cat(self._attr, dim=1).cpu().numpy()
+            auc = 100 * compute_auc(pred_prob, gt)
+
+        # The first value will be returned by trainer.test()
+        results["accuracy"] = acc
+        results["error_rate"] = err
+        results["macro_f1"] = macro_f1
+        results["auc"] = auc
+
+        print(
+            "=> result\n"
+            f"* total: {total:,}\n"
+            f"* correct: {correct:,}\n"
+            f"* accuracy: {acc:.2f}%\n"
+            f"* error: {err:.2f}%\n"
+            f"* macro_f1: {macro_f1:.2f}%\n"
+            f"* auc: {auc:.2f}%"
+        )
+
+        if self._per_class_res is not None:
+            print("=> per-class result")
+            for label in np.where(present)[0]:
+                print(
+                    f"* class: {label} ({self._lab2cname[label]})\t"
+                    f"total: {conf[label].sum():,}\t"
+                    f"correct: {conf[label, label]:,}\t"
+                    f"acc: {100.0 * conf[label, label] / conf[label].sum():.1f}%"
+                )
+
+        if self.num_bins > 0:
+            self._report_fairness(results, evalute_fairness_binned(conf, group_hist, group_conf), len(group_conf))
+        else:
+            self._report_fairness(results, evalute_comprehensive_perf_scores(pred_prob, gt, attr), len(attr))
+            if self.cfg.TEST.BOOTSTRAP > 0 and (pred_prob.ndim == 1 or pred_prob.shape[-1] == 2):
+                self._report_ci(results, pred_prob, gt, attr)
+
+        return results
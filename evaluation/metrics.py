@@ -193,6 +193,337 @@ def evalute_comprehensive_perf_(preds, gts, attrs=None, num_classes=2):
 
     return esaccs_by_attrs, esaucs_by_attrs, aucs_by_attrs, dpds, eods, between_group_disparity
 
+def _roc_auc_sorted(y_true, y_score):
+    """
+    roc_curve() + auc() of sklearn on samples already sorted by decreasing
+    score, same thresholds, dropped points and trapezoid sum, so the value
+    is bit-identical.
+    """
+    distinct_value_indices = np.where(np.diff(y_score))[0]
+    threshold_idxs = np.r_[distinct_value_indices, y_true.size - 1]
+    tps = np.cumsum(y_true * 1.0, dtype=np.float64)[threshold_idxs]
+    fps = 1 + threshold_idxs - tps
+    if len(fps) > 2:
+        optimal_idxs = np.where(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])[0]
+        fps = fps[optimal_idxs]
+        tps = tps[optimal_idxs]
+    tps = np.r_[0, tps]
+    fps = np.r_[0, fps]
+    # a single class gives nan, as roc_curve does
+    fpr = fps / fps[-1] if fps[-1] > 0 else np.repeat(np.nan, fps.shape)
+    tpr = tps / tps[-1] if tps[-1] > 0 else np.repeat(np.nan, tps.shape)
+    return np.add.reduce(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2.0)
+
+
+class SortedScores:
+    """
+    Binary scores sorted once, AUCs of any subset are then read off the
+    sorted order without re-sorting.
+
+    preds of shape (N,) are scored like roc_curve(gts, preds), preds of
+    shape (N, 2) like the macro one-vs-rest roc_auc_score of compute_auc().
+    """
+
+    def __init__(self, preds, gts):
+        self.is_prob = preds.ndim == 1
+        columns = [preds] if self.is_prob else [preds[:, c] for c in range(preds.shape[1])]
+        labels = [gts == 1] if self.is_prob else [gts == c for c in range(preds.shape[1])]
+        self.columns = []
+        for score, y_true in zip(columns, labels):
+            order = np.argsort(score, kind='mergesort')[::-1]
+            self.columns.append((order, score[order], y_true[order]))
+        # first index of every run of tied scores, per column
+        self.run_starts = [np.r_[0, np.where(np.diff(score))[0] + 1] for _, score, _ in self.columns]
+
+    def auc(self, mask=None):
+        """compute_auc(preds[mask], gts[mask]); raises ValueError where roc_auc_score does."""
+        aucs = []
+        for order, score, y_true in self.columns:
+            if mask is not None:
+                keep = mask[order]
+                score, y_true = score[keep], y_true[keep]
+            if not self.is_prob and (y_true.all() or not y_true.any()):
+                raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+            aucs.append(_roc_auc_sorted(y_true, score))
+        return aucs[0] if self.is_prob else np.average(aucs)
+
+    def weighted_auc(self, weights):
+        """
+        AUCs of R weighted copies of the samples at once.
+
+        weights: R x N sample multiplicities in the original order, e.g. one
+        bootstrap replicate per row, zero outside a subgroup. Returns R AUCs,
+        nan for rows without both classes.
+        """
+        aucs = []
+        for (order, _, y_true), starts in zip(self.columns, self.run_starts):
+            w = weights[:, order]
+            # tied scores share one ROC point
+            tps = np.add.reduceat(w * y_true, starts, axis=1).cumsum(1)
+            fps = np.add.reduceat(w * ~y_true, starts, axis=1).cumsum(1)
+            tps = np.pad(tps, ((0, 0), (1, 0)))
+            fps = np.pad(fps, ((0, 0), (1, 0)))
+            area = (np.diff(fps, axis=1) * (tps[:, 1:] + tps[:, :-1]) / 2.).sum(1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                aucs.append(area / (tps[:, -1] * fps[:, -1]))
+        return aucs[0] if self.is_prob else np.mean(aucs, axis=0)
+
+
+def _group_rates(y_true, y_pred, group_idx, num_groups):
+    """Per-group selection rate, TPR, FPR and TNR (0 where undefined, as sklearn/fairlearn)."""
+    count = np.bincount(group_idx, minlength=num_groups)
+    pos = np.bincount(group_idx, weights=y_true, minlength=num_groups)
+    neg = count - pos
+    tp = np.bincount(group_idx, weights=y_true * y_pred, minlength=num_groups)
+    fp = np.bincount(group_idx, weights=(1 - y_true) * y_pred, minlength=num_groups)
+    tn = np.bincount(group_idx, weights=(1 - y_true) * (1 - y_pred), minlength=num_groups)
+    selected = np.bincount(group_idx, weights=y_pred, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = np.where(pos > 0, tp / pos, 0.)
+        fpr = np.where(neg > 0, fp / neg, 0.)
+        tnr = np.where(neg > 0, tn / neg, 0.)
+    return selected / count, tpr, fpr, tnr, (pos, neg, tp, tn)
+
+
+def evalute_fairness_binary(preds, gts, attrs):
+    """
+    Same outputs as evalute_comprehensive_perf_scores() for num_classes=2,
+    from one sort of the scores and bincounts over the groups instead of
+    per-group sklearn/fairlearn/aif360 calls.
+    """
+    esaccs_by_attrs = []
+    esaucs_by_attrs = []
+    aucs_by_attrs = []
+    dpds = []
+    eods = []
+    aods = []
+    between_group_disparity = []
+
+    overall_acc = accuracy(preds, gts, topk=(1,))
+    scores = SortedScores(preds, gts)
+    overall_auc = scores.auc()
+
+    if preds.ndim >= 2:
+        pred_labels = preds.argmax(-1)
+    else:
+        pred_labels = (preds >= 0.5).astype(float)
+    correct = (pred_labels == gts).astype(float)
+    overall_es_acc = np.sum(correct) / gts.shape[0]
+    y_true = (gts == 1).astype(float)
+    y_pred = (pred_labels == 1).astype(float)
+
+    for i in range(attrs.shape[0]):
+        groups, group_idx = np.unique(attrs[i, :].astype(int), return_inverse=True)
+        num_groups = len(groups)
+
+        # ES-Acc
+        group_acc = np.bincount(group_idx, weights=correct, minlength=num_groups) / np.bincount(group_idx, minlength=num_groups)
+        tmp = sum(np.abs(acc - overall_es_acc) for acc in group_acc)
+        esaccs_by_attrs.append(overall_es_acc / (tmp + 1))
+
+        # per-group AUC, ES-AUC and between-group disparity
+        aucs_by_group = []
+        es_error = None
+        for g in range(num_groups):
+            try:
+                aucs_by_group.append(scores.auc(group_idx == g))
+            except ValueError as e:
+                es_error = e
+                aucs_by_group.append(-1.)
+        if es_error is not None:
+            print(es_error)
+            exit()
+        tmp = sum(np.abs(auc_g - overall_auc) for auc_g in aucs_by_group)
+        esaucs_by_attrs.append(overall_auc / (tmp + 1))
+        aucs_by_attrs.append(np.array(aucs_by_group))
+        std_disparity, max_disparity = compute_between_group_disparity(aucs_by_group, overall_auc)
+        between_group_disparity.append([std_disparity, max_disparity])
+
+        # DPD, EOD and AOD
+        selection, tpr, fpr, tnr, (pos, neg, tp, tn) = _group_rates(y_true, y_pred, group_idx, num_groups)
+        dpds.append(selection.max() - selection.min())
+        eods.append(max(tpr.max() - tpr.min(), fpr.max() - fpr.min()))
+
+        # privileged group vs the rest, averaged over groups
+        aod = []
+        for g in range(num_groups):
+            u_pos, u_neg = pos.sum() - pos[g], neg.sum() - neg[g]
+            u_tp, u_tn = tp.sum() - tp[g], tn.sum() - tn[g]
+            u_tpr = u_tp / u_pos if u_pos > 0 else 0.
+            u_tnr = u_tn / u_neg if u_neg > 0 else 0.
+            fpr_diff = -(u_tnr - tnr[g])
+            tpr_diff = u_tpr - tpr[g]
+            aod.append(np.abs((tpr_diff + fpr_diff) / 2))
+        aods.append(sum(aod) / max(len(aod), 1))
+
+    esaccs_by_attrs = np.array(esaccs_by_attrs)
+    esaucs_by_attrs = np.array(esaucs_by_attrs)
+    dpds = np.array(dpds)
+    eods = np.array(eods)
+    between_group_disparity = np.array(between_group_disparity)
+
+    return overall_acc, esaccs_by_attrs, overall_auc, esaucs_by_attrs, aucs_by_attrs, dpds, eods, aods, between_group_disparity
+
+def binned_auc(hist):
+    """
+    ROC AUC from score histograms, hist[..., label, bin] with label 0/1 and
+    bins of increasing score; samples in one bin count as tied. nan without
+    both classes.
+    """
+    neg, pos = hist[..., 0, ::-1].astype(np.float64), hist[..., 1, ::-1].astype(np.float64)
+    zero = np.zeros(neg.shape[:-1] + (1,))
+    tps = np.concatenate([zero, np.cumsum(pos, -1)], -1)
+    fps = np.concatenate([zero, np.cumsum(neg, -1)], -1)
+    area = (np.diff(fps, axis=-1) * (tps[..., 1:] + tps[..., :-1]) / 2.).sum(-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return area / (tps[..., -1] * fps[..., -1])
+
+
+def evalute_fairness_binned(conf, group_hist, group_conf):
+    """
+    Same outputs as evalute_fairness_binary() from accumulated counts, for
+    evaluators that never keep the per-sample scores.
+
+    conf: 2 x 2 confusion matrix [label, prediction]
+    group_hist: num_attrs x num_groups x 2 x num_bins score histograms
+    group_conf: num_attrs x num_groups x 2 x 2 confusion matrices per group
+
+    AUCs are binned_auc() of the histograms summed over groups; groups
+    without samples are left out, groups without both classes get a nan AUC.
+    """
+    esaccs_by_attrs = []
+    esaucs_by_attrs = []
+    aucs_by_attrs = []
+    dpds = []
+    eods = []
+    aods = []
+    between_group_disparity = []
+
+    overall_acc = np.trace(conf) / conf.sum()
+    overall_auc = binned_auc(group_hist[0].sum(0))
+
+    for i in range(group_conf.shape[0]):
+        present = group_conf[i].sum((1, 2)) > 0
+        hist, g_conf = group_hist[i][present], group_conf[i][present].astype(np.float64)
+        count = g_conf.sum((1, 2))
+
+        group_acc = (g_conf[:, 0, 0] + g_conf[:, 1, 1]) / count
+        esaccs_by_attrs.append(overall_acc / (np.abs(group_acc - overall_acc).sum() + 1))
+
+        aucs_by_group = binned_auc(hist)
+        esaucs_by_attrs.append(overall_auc / (np.abs(aucs_by_group - overall_auc).sum() + 1))
+        aucs_by_attrs.append(aucs_by_group)
+        between_group_disparity.append(list(compute_between_group_disparity(aucs_by_group, overall_auc)))
+
+        pos, neg = g_conf[:, 1].sum(1), g_conf[:, 0].sum(1)
+        tp, fp, tn = g_conf[:, 1, 1], g_conf[:, 0, 1], g_conf[:, 0, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            selection = (tp + fp) / count
+            tpr = np.where(pos > 0, tp / pos, 0.)
+            fpr = np.where(neg > 0, fp / neg, 0.)
+            tnr = np.where(neg > 0, tn / neg, 0.)
+            u_pos, u_neg = pos.sum() - pos, neg.sum() - neg
+            u_tpr = np.where(u_pos > 0, (tp.sum() - tp) / u_pos, 0.)
+            u_tnr = np.where(u_neg > 0, (tn.sum() - tn) / u_neg, 0.)
+        dpds.append(selection.max() - selection.min())
+        eods.append(max(tpr.max() - tpr.min(), fpr.max() - fpr.min()))
+        aods.append(np.abs(((u_tpr - tpr) - (u_tnr - tnr)) / 2).mean())
+
+    esaccs_by_attrs = np.array(esaccs_by_attrs)
+    esaucs_by_attrs = np.array(esaucs_by_attrs)
+    dpds = np.array(dpds)
+    eods = np.array(eods)
+    between_group_disparity = np.array(between_group_disparity)
+
+    return overall_acc, esaccs_by_attrs, overall_auc, esaucs_by_attrs, aucs_by_attrs, dpds, eods, aods, between_group_disparity
+
+def bootstrap_fairness_ci(preds, gts, attrs, num_replicates=1000, alpha=0.05, seed=None):
+    """
+    Percentile bootstrap confidence intervals of the binary metrics of
+    evalute_fairness_binary().
+
+    The replicates are drawn as one R x N index matrix and turned into
+    sample multiplicities, all metrics of all replicates are then weighted
+    sums over the sorted scores and the groups. Replicates where a metric
+    is undefined (e.g. a group without positives) are left out of its
+    interval.
+
+    Returns a dict of (2, ...) arrays, lower and upper bound.
+    """
+    n = gts.shape[0]
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, n, size=(num_replicates, n))
+    weights = np.bincount(
+        (idx + n * np.arange(num_replicates)[:, None]).ravel(), minlength=num_replicates * n
+    ).reshape(num_replicates, n).astype(np.float64)
+
+    scores = SortedScores(preds, gts)
+    overall_auc = scores.weighted_auc(weights)
+
+    if preds.ndim >= 2:
+        pred_labels = preds.argmax(-1)
+    else:
+        pred_labels = (preds >= 0.5).astype(float)
+    correct = (pred_labels == gts).astype(float)
+    y_true = (gts == 1).astype(float)
+    y_pred = (pred_labels == 1).astype(float)
+    overall_acc = weights @ correct / n
+
+    esaccs, esaucs, aucs_by_attrs, dpds, eods, aods, disparity = [], [], [], [], [], [], []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(attrs.shape[0]):
+            groups, group_idx = np.unique(attrs[i, :].astype(int), return_inverse=True)
+            onehot = np.eye(len(groups))[group_idx]         # N x G
+            count = weights @ onehot                         # R x G
+            present = count > 0
+
+            group_acc = (weights * correct) @ onehot / count
+            esaccs.append(overall_acc / (np.abs(group_acc - overall_acc[:, None]).sum(1) + 1))
+
+            group_auc = np.stack([scores.weighted_auc(weights * onehot[:, g]) for g in range(len(groups))], 1)
+            aucs_by_attrs.append(group_auc)
+            esaucs.append(overall_auc / (np.abs(group_auc - overall_auc[:, None]).sum(1) + 1))
+            disparity.append(np.stack([
+                group_auc.std(1) / overall_auc,
+                (group_auc.max(1) - group_auc.min(1)) / overall_auc,
+            ], 1))
+
+            pos = (weights * y_true) @ onehot
+            neg = count - pos
+            tp = (weights * y_true * y_pred) @ onehot
+            fp = (weights * (1 - y_true) * y_pred) @ onehot
+            tn = neg - fp
+            selection = np.where(present, (weights * y_pred) @ onehot / count, np.nan)
+            tpr = np.where(pos > 0, tp / pos, 0.)
+            fpr = np.where(neg > 0, fp / neg, 0.)
+            tnr = np.where(neg > 0, tn / neg, 0.)
+            dpds.append(np.nanmax(selection, 1) - np.nanmin(selection, 1))
+            tpr_range = np.nanmax(np.where(present, tpr, np.nan), 1) - np.nanmin(np.where(present, tpr, np.nan), 1)
+            fpr_range = np.nanmax(np.where(present, fpr, np.nan), 1) - np.nanmin(np.where(present, fpr, np.nan), 1)
+            eods.append(np.maximum(tpr_range, fpr_range))
+
+            # each group as the privileged one against the rest
+            u_pos, u_neg = pos.sum(1, keepdims=True) - pos, neg.sum(1, keepdims=True) - neg
+            u_tpr = np.where(u_pos > 0, (tp.sum(1, keepdims=True) - tp) / u_pos, 0.)
+            u_tnr = np.where(u_neg > 0, (tn.sum(1, keepdims=True) - tn) / u_neg, 0.)
+            aod = np.abs(((u_tpr - tpr) - (u_tnr - tnr)) / 2)
+            aods.append(np.nanmean(np.where(present, aod, np.nan), 1))
+
+    def interval(x):
+        return np.nanpercentile(x, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+    return {
+        'overall_acc': interval(overall_acc),
+        'overall_auc': interval(overall_auc),
+        'esaccs_by_attrs': interval(np.stack(esaccs, 1)),
+        'esaucs_by_attrs': interval(np.stack(esaucs, 1)),
+        'aucs_by_attrs': [interval(x) for x in aucs_by_attrs],
+        'dpds': interval(np.stack(dpds, 1)),
+        'eods': interval(np.stack(eods, 1)),
+        'aods': interval(np.stack(aods, 1)),
+        'between_group_disparity': interval(np.stack(disparity, 1)),
+    }
+
 def evalute_comprehensive_perf_scores(preds, gts, attrs=None, num_classes=2):
     """
     Args:
@@ -200,6 +531,9 @@ def evalute_comprehensive_perf_scores(preds, gts, attrs=None, num_classes=2):
         gts: batch_size
       attrs: num_attrs x batch_size
     """
+    if num_classes == 2:
+        # single-sort engine, same values as the per-group sklearn/fairlearn/aif360 calls
+        return evalute_fairness_binary(preds, gts, attrs)
 
     esaccs_by_attrs = []
     esaucs_by_attrs = []
@@ -240,57 +574,11 @@ def evalute_comprehensive_perf_scores(preds, gts, attrs=None, num_classes=2):
         std_disparity, max_disparity = compute_between_group_disparity(aucs_by_group, overall_auc)
         between_group_disparity.append([std_disparity, max_disparity])
 
-        if num_classes == 2:
-            if preds.shape == gts.shape:
-                pred_labels = (preds >= 0.5).astype(float)
-            else:
-                assert preds.shape[-1] == 2
-                pred_labels = preds.argmax(-1)
-            try:
-                dpd = demographic_parity_difference(gts,
-                                            pred_labels,
-                                            sensitive_features=attr)
-            except Exception as e:
-                print('Warning:', e)
-                dpd = 0
-            try:
-                dpr = demographic_parity_ratio(gts,
-                                            pred_labels,
-                                            sensitive_features=attr)
-            except Exception as e:
-                print('Warning:', e)
-                dpr = 0
-            try:
-                eod = equalized_odds_difference(gts,
-                                            pred_labels,
-                                            sensitive_features=attr)
-            except Exception as e:
-                print('Warning:', e)
-                eod = 0
-            try:
-                eor = equalized_odds_ratio(gts,
-                                            pred_labels,
-                                            sensitive_features=attr)
-            except Exception as e:
-                print('Warning:', e)
-                eor = 0
-
-            # evaluate the fairness between pos and neg samples
-            aod = []
-            for priv_group in set(attr):
-                aod_g = average_odds_difference(gts,
-                                        pred_labels,
-                                        prot_attr=attr,
-                                        priv_group=priv_group) 
-                aod.append(np.abs(aod_g))
-            aod = sum(aod) / max(len(aod), 1)
-        
-        else:
-            dpd = multiclass_demographic_parity(preds, gts, attr)
-            dpr = 0
-            eod = multiclass_equalized_odds(preds, gts, attr)
-            eor = 0
-            aod = 0
+        dpd = multiclass_demographic_parity(preds, gts, attr)
+        dpr = 0
+        eod = multiclass_equalized_odds(preds, gts, attr)
+        eor = 0
+        aod = 0
 
         dpds.append(dpd)
         eods.append(eod)
@@ -1,4 +1,5 @@
 import argparse
+import os
 import torch
 from Dassl.dassl.utils import setup_logger, set_random_seed, collect_env_info
 from Dassl.dassl.config import get_cfg_default
@@ -8,7 +9,11 @@ import time
 import copy
 from prettytable import PrettyTable
 import numpy as np
-from utils.fed_utils import average_weights, average_weights_EMA, count_parameters
+from utils.fed_utils import average_weights, average_weights_EMA, count_parameters, FlatAggregator, trainable_state_keys
+from utils.fed_utils import ClientStateStore
+from utils.fed_utils import get_rng_states, set_rng_states, save_federated_state, load_federated_state
+from utils.client_pool import ClientPool, get_trainer_state, set_trainer_state, to_device
+from utils.profiler import profiler
 
 def print_args(args, cfg):
     print("***************")
@@ -40,6 +45,9 @@ def reset_cfg(cfg, args):
     if args.transforms:
         cfg.INPUT.TRANSFORMS = args.transforms
 
+    if args.input_size:
+        cfg.INPUT.SIZE = (args.input_size, args.input_size)
+
     if args.trainer:
         cfg.TRAINER.NAME = args.trainer
 
@@ -48,6 +56,9 @@ def reset_cfg(cfg, args):
 
     if args.head:
         cfg.MODEL.HEAD.NAME = args.head
+
+    if args.evaluator:
+        cfg.TEST.EVALUATOR = args.evaluator
     
     cfg.OPTIM.LR = args.lr # learning rate
     # If True, tfm_train and tfm_test will be None, only use range(0,1) & normalize
@@ -80,7 +91,7 @@ def extend_cfg(cfg, args):
     cfg.TRAINER.GLP_OT.N_CTX = args.n_ctx  # number of context vectors
     cfg.TRAINER.GLP_OT.CSC = False  # class-specific context
     cfg.TRAINER.GLP_OT.CTX_INIT = args.ctx_init  # initialization words
-    cfg.TRAINER.GLP_OT.PREC = "fp16"  # fp16, fp32, amp
+    cfg.TRAINER.GLP_OT.PREC = args.prec  # fp16, fp32, amp, bf16
     cfg.TRAINER.GLP_OT.CLASS_TOKEN_POSITION = "end"  # 'middle' or 'end' or 'front'
     cfg.TRAINER.GLP_OT.N = args.num_prompt # number of prompts
     cfg.TRAINER.GLP_OT.THRESH = args.thresh # thresh of sinkhorn distance
@@ -88,6 +99,12 @@ def extend_cfg(cfg, args):
     cfg.TRAINER.GLP_OT.OT = args.OT # type of OT used
     cfg.TRAINER.GLP_OT.TOP_PERCENT = args.top_percent
     cfg.TRAINER.GLP_OT.MAX_ITER = args.max_iter
+    cfg.TRAINER.GLP_OT.CHECK_EVERY = args.ot_check_every # iterations between convergence checks
+    cfg.TRAINER.GLP_OT.LOG_DOMAIN = args.ot_log_domain # log-domain OT for small eps
+    cfg.TRAINER.GLP_OT.WARM_START = args.ot_warm_start # start OT from the previous batch's scalings
+    cfg.TRAINER.GLP_OT.SLICE_CHUNK = args.slice_chunk # checkpointed chunks of 3d volumes, in pseudo images
+    cfg.TRAINER.GLP_OT.TOKEN_REDUCTION = args.token_reduction # none, topk, avgpool or merge
+    cfg.TRAINER.GLP_OT.NUM_TOKENS = args.num_tokens # patch tokens left for OT
 
     # config for FairLoRA
     cfg.TRAINER.GLP_OT_LORA = CN()
@@ -98,6 +115,7 @@ def extend_cfg(cfg, args):
     cfg.TRAINER.GLP_OT_LORA.TYPE = args.lora_type
     cfg.TRAINER.GLP_OT_LORA.LOCAL_S = args.lora_local_s
     cfg.TRAINER.GLP_OT_LORA.GLOBAL_S = args.lora_global_s
+    cfg.TRAINER.GLP_OT_LORA.GRAD_CHECKPOINT = args.grad_checkpoint # image encoder blocks (ViT) or stages (RN) recomputed in backward, -1 for all
 
     cfg.DATASET.SUBSAMPLE_CLASSES = "all"  # all, base or new
     cfg.DATASET.USERS = args.num_users  # number of clients
@@ -114,12 +132,19 @@ def extend_cfg(cfg, args):
     cfg.DATASET.ATTRIBUTES = args.attributes
     cfg.DATASET.MODALITY_TYPE = args.modality_type
     cfg.DATASET.DIM_PER_3D_SLICE = args.dim_per_3d_slice
+    cfg.DATASET.OCT_SLICE_STEP = args.oct_slice_step  # every n-th of the 128 B-scans is used
+    cfg.DATASET.PACKED = args.packed_data  # read FairFedMed from memmaps of preprocessed samples
+    cfg.DATASET.UINT8 = args.uint8_input  # load uint8 samples, normalized on the device
     cfg.OPTIM.ROUND = args.round # global round
     cfg.OPTIM.MAX_EPOCH = 1 # local epoch
     cfg.OPTIM.GAMMA = args.gamma # gamma of single-step
     cfg.OPTIM.LR = args.lr # learning rate
 
     cfg.MODEL.BACKBONE.PRETRAINED = True
+    cfg.MODEL.FEATURE_CACHE = args.feature_cache  # directory of cached frozen-encoder image features
+
+    cfg.TEST.BOOTSTRAP = args.bootstrap  # bootstrap replicates of the fairness metric CIs, 0 disables them
+    cfg.TEST.AUC_BINS = args.auc_bins  # score histogram bins of the streaming evaluator, 0 is exact
 
 
 def setup_cfg(args):
@@ -148,6 +173,41 @@ def setup_cfg(args):
     return cfg
 
 
+def train_clients(local_trainer, client_pool, idxs_users, init_weights, epoch, flag_last_client=False, **train_kwargs):
+    """
+    Trains the selected clients starting from init_weights (one state_dict per
+    client) and yields (idx, trained state_dict) in the order of idxs_users.
+
+    Sequentially, the clients share the trainer's optimizer/scheduler state
+    and RNG streams as in a plain loop. On client_pool every client starts
+    from the state the round started with and is seeded from (SEED, round,
+    client), see ClientPool; the results then differ from sequential runs.
+    """
+    tasks = []
+    for idx, weights in zip(idxs_users, init_weights):
+        kwargs = dict(train_kwargs)
+        if flag_last_client:
+            kwargs['is_last_client'] = idx == idxs_users[-1]
+        tasks.append((idx, weights, kwargs))
+
+    if client_pool is not None:
+        trained = client_pool.train(local_trainer, tasks, epoch)
+        for idx in idxs_users:
+            yield idx, trained[idx]
+    else:
+        for idx, weights, kwargs in tasks:
+            local_trainer.set_trainable_state(weights)
+            local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True, **kwargs)
+            yield idx, local_trainer.get_trainable_state()
+
+
+def trainable_only(weights, keys):
+    # checkpoints keep the tensors that change during training, not the frozen backbone
+    if isinstance(weights, dict):
+        return {k: v for k, v in weights.items() if k in keys}
+    return weights
+
+
 def main(args):
     cfg = setup_cfg(args)
     if cfg.SEED >= 0:
@@ -172,6 +232,8 @@ def main(args):
     local_weights_0= [[] for i in range(args.num_users)]
     local_weights_1= [[] for i in range(args.num_users)]
     local_weights_per = [{} for i in range(args.num_users)]
+    # FedOTPLinearFT/FedOTPLoRA: global weights + per-client local prompts and lora_S
+    client_states = ClientStateStore(args.num_users)
     local_proj = [{} for i in range(args.num_users)]
 
     local_trainer = build_trainer(cfg)
@@ -184,7 +246,7 @@ def main(args):
     datanumber_client = []
     datanumber_client_by_attr = []
     if args.trainer == 'CLIP':
-        global_weights = copy.deepcopy(local_trainer.model.state_dict())
+        global_weights = local_trainer.get_trainable_state()
     else:
         for net_i in range(cfg.DATASET.USERS):
             # local_trainer = build_trainer(cfg)
@@ -197,7 +259,15 @@ def main(args):
             # local_trainer.fed_before_train()
             # local_trainers[net_i] = local_trainer
             # local_weights[net_i] = copy.deepcopy(local_trainer.model.state_dict())
-        global_weights = copy.deepcopy(local_trainer.model.state_dict())
+        global_weights = local_trainer.get_trainable_state()
+        # client copies of the trainable tensors only, used for weight averaging
+        aggregator = FlatAggregator(local_trainer.model, cfg.DATASET.USERS)
+    client_pool = None
+    if args.client_workers > 0 and args.trainer != 'CLIP':
+        client_pool = ClientPool(cfg, local_trainer, args.client_workers)
+    if args.profile:
+        # phases of clients trained in ClientPool workers are not recorded
+        profiler.enable(os.path.join(cfg.OUTPUT_DIR, 'profile'))
 
     # Training
     start_epoch = 0
@@ -210,8 +280,34 @@ def main(args):
     global_epoch_list = []
     global_time_list = []
     start = time.time()
+
+    trainable_keys = set(trainable_state_keys(local_trainer.model))
+    fed_state = load_federated_state(cfg.RESUME) if cfg.RESUME else None
+    if fed_state is not None:
+        print(f"Resume from round {fed_state['epoch']} in {cfg.RESUME}")
+        start_epoch = fed_state['epoch'] + 1
+        weights = to_device(fed_state['weights'], local_trainer.device)
+        global_weights = weights['global_weights']
+        local_weights_per = weights['local_weights_per']
+        local_weights_0 = weights['local_weights_0']
+        local_weights_1 = weights['local_weights_1']
+        client_states.set_global(global_weights)
+        client_states.overlays = weights['client_overlays']
+        idxs_users = fed_state['idxs_users']
+        set_trainer_state(local_trainer, fed_state['trainer'])
+        (global_test_acc_list, global_test_error_list, global_test_f1_list,
+         global_test_auc_list, global_epoch_list, global_time_list) = fed_state['metrics']
+        global_epoch_list = [int(e) for e in global_epoch_list]
+        if global_time_list:
+            start = time.time() - global_time_list[-1]
+        # restore last, so that client sampling continues bit-identically
+        set_rng_states(fed_state['rng'])
+    elif cfg.RESUME:
+        print(f"No federated checkpoint found in {cfg.RESUME}, train from scratch")
+
     n_cls = len(local_trainer.dm.dataset.classnames)
     for epoch in range(start_epoch, max_epoch):
+        profiler.start_round(epoch)
 
         if args.trainer == 'CLIP':
             print("------------local test start-------------")
@@ -220,7 +316,7 @@ def main(args):
             m = max(int(args.frac * args.num_users), 1)
             idxs_users = np.random.choice(range(args.num_users), m, replace=False)
             for idx in idxs_users:
-                local_trainer.model.load_state_dict(global_weights)
+                local_trainer.set_trainable_state(global_weights)
                 results.append(local_trainer.test(idx=idx,current_epoch=epoch))
             global_test_acc = []
             global_test_error = []
@@ -265,20 +361,18 @@ def main(args):
             # idxs_users = list(range(0, cfg.DATASET.USERS))
             print("idxs_users", idxs_users)
             print("------------local train start epoch:", epoch, "-------------")
-            for idx in idxs_users:
-                local_trainer.model.load_state_dict(global_weights,strict=False)
-                local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True)
-                local_weight = local_trainer.model.state_dict()
-                local_weights[idx] = copy.deepcopy(local_weight)
+            init_weights = [global_weights for idx in idxs_users]
+            for idx, local_weight in train_clients(local_trainer, client_pool, idxs_users, init_weights, epoch):
+                aggregator.collect(idx, local_weight)
             print("------------local train finish epoch:", epoch, "-------------")
 
-            global_weights = average_weights(local_weights,idxs_users, datanumber_client)
+            global_weights = aggregator.average(idxs_users, datanumber_client)
 
             print("------------local test start-------------")
             results = []
             all_users = list(range(0, cfg.DATASET.USERS))
             for idx in all_users:
-                local_trainer.model.load_state_dict(global_weights,strict=False)
+                local_trainer.set_trainable_state(global_weights)
                 results.append(local_trainer.test(idx=idx,current_epoch=epoch))
             global_test_acc = []
             global_test_error = []
@@ -322,21 +416,22 @@ def main(args):
             # idxs_users = list(range(0, cfg.DATASET.USERS))
             print("idxs_users", idxs_users)
             print("------------local train start epoch:", epoch, "-------------")
-            for idx in idxs_users:
-                local_trainer.model.load_state_dict(global_weights,strict=False)
-                local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True, global_weight=global_weights, fedprox=True, mu=args.mu)
-                local_weight = local_trainer.model.state_dict()
-                local_weights[idx] = copy.deepcopy(local_weight)
+            init_weights = [global_weights for idx in idxs_users]
+            for idx, local_weight in train_clients(
+                local_trainer, client_pool, idxs_users, init_weights, epoch,
+                global_weight=global_weights, fedprox=True, mu=args.mu
+            ):
+                aggregator.collect(idx, local_weight)
             print("------------local train finish epoch:", epoch, "-------------")
 
-            global_weights = average_weights(local_weights, idxs_users, datanumber_client)
+            global_weights = aggregator.average(idxs_users, datanumber_client)
             # update global weights
             # global_trainer.model.load_state_dict(global_weights)
 
             print("------------local test start-------------")
             results = []
             for idx in idxs_users:
-                local_trainer.model.load_state_dict(global_weights,strict=False)
+                local_trainer.set_trainable_state(global_weights)
                 results.append(local_trainer.test(idx=idx,current_epoch=epoch))
             global_test_acc = []
             global_test_error = []
@@ -383,17 +478,12 @@ def main(args):
                 idxs_users = np.random.choice(range(args.num_users), m, replace=False)
             print("idxs_users", idxs_users)
             print("------------local train start epoch:", epoch, "-------------")
-            for idx in idxs_users:
-                if epoch == 0:
-                    local_trainer.model.load_state_dict(global_weights, strict=False)
-                else:
-                    local_trainer.model.load_state_dict(local_weights_per[idx], strict=False)
-                local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True)
-                local_weight = local_trainer.model.state_dict()
+            init_weights = [global_weights if epoch == 0 else local_weights_per[idx] for idx in idxs_users]
+            for idx, local_weight in train_clients(local_trainer, client_pool, idxs_users, init_weights, epoch):
                 # gloabl embeddings
-                local_weights_0[idx] = copy.deepcopy(local_weight['prompt_learner.ctx'][:args.avg_prompt])  
+                local_weights_0[idx] = local_weight['prompt_learner.ctx'][:args.avg_prompt].clone()
                 # local embeddings
-                local_weights_1[idx] = copy.deepcopy(local_weight['prompt_learner.ctx'][args.avg_prompt:args.num_prompt])
+                local_weights_1[idx] = local_weight['prompt_learner.ctx'][args.avg_prompt:args.num_prompt].clone()
             print("------------local train finish epoch:", epoch, "-------------")
 
             global_weights = average_weights(local_weights_0, idxs_users, datanumber_client, islist=True)
@@ -407,7 +497,7 @@ def main(args):
             if args.num_users >= 50:
                 if epoch >= 140:
                     for idx in all_users:
-                        local_trainer.model.load_state_dict(local_weights_per[idx],strict=False)
+                        local_trainer.set_trainable_state(local_weights_per[idx])
                         results.append(local_trainer.test(idx=idx,current_epoch=epoch))
                     global_test_acc = []
                     global_test_error = []
@@ -428,7 +518,7 @@ def main(args):
                     print("Epoch on server :", epoch)
             else:
                 for idx in all_users:
-                    local_trainer.model.load_state_dict(local_weights_per[idx], strict=False)
+                    local_trainer.set_trainable_state(local_weights_per[idx])
                     results.append(local_trainer.test(idx=idx,current_epoch=epoch))
 
                 global_test_acc = []
@@ -486,19 +576,18 @@ def main(args):
                 idxs_users = np.random.choice(range(args.num_users), m, replace=False)
             print("idxs_users", idxs_users)
             print("------------local train start epoch:", epoch, "-------------")
-            for idx in idxs_users:
-                if epoch == 0:
-                    local_trainer.model.load_state_dict(global_weights, strict=False)
-                else:
-                    local_trainer.model.load_state_dict(local_weights_per[idx], strict=False)
-                local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True)
-                local_weight = local_trainer.model.state_dict()
-                local_weights_0[idx] = copy.deepcopy(local_weight['prompt_learner.ctx'][args.avg_prompt:args.num_prompt])
-                local_weights_1[idx] = copy.deepcopy({k:v for k,v in local_weight.items() if 'lora_S' in k})
-                local_weights[idx] = copy.deepcopy(local_weight)
+            init_weights = [global_weights if epoch == 0 else client_states.weights(idx) for idx in idxs_users]
+            for idx, local_weight in train_clients(local_trainer, client_pool, idxs_users, init_weights, epoch):
+                # local embeddings, and lora_S if it stays local
+                client_states.personalize(idx, local_weight, 'prompt_learner.ctx', rows=(args.avg_prompt, args.num_prompt))
+                if cfg.TRAINER.GLP_OT_LORA.LOCAL_S:
+                    for k in local_weight:
+                        if 'lora_S' in k:
+                            client_states.personalize(idx, local_weight, k)
+                aggregator.collect(idx, local_weight)
             print("------------local train finish epoch:", epoch, "-------------")
 
-            global_weights = average_weights(local_weights, idxs_users, datanumber_client)
+            global_weights = aggregator.average(idxs_users, datanumber_client)
             # update global weights
             # global_trainer.model.load_state_dict(global_weights)
 
@@ -506,17 +595,12 @@ def main(args):
             results = []
             all_users = list(range(0, cfg.DATASET.USERS))
             
-            for idx in all_users:
-                local_weights_per[idx] = copy.deepcopy(global_weights)
-                # keep local embeddings
-                local_weights_per[idx]['prompt_learner.ctx'][args.avg_prompt:args.num_prompt] = local_weights_0[idx]
-                if cfg.TRAINER.GLP_OT_LORA.LOCAL_S:
-                    for k, v in local_weights_1[idx].items():
-                        local_weights_per[idx][k] = v
+            # every client sees the new global weights under its own local tensors
+            client_states.set_global(global_weights)
             if args.num_users >= 50:
                 if epoch >= 140:
                     for idx in all_users:
-                        local_trainer.model.load_state_dict(local_weights_per[idx],strict=False)
+                        local_trainer.set_trainable_state(client_states.weights(idx))
                         results.append(local_trainer.test(idx=idx,current_epoch=epoch))
                     global_test_acc = []
                     global_test_error = []
@@ -537,7 +621,7 @@ def main(args):
                     print("Epoch on server :", epoch)
             else:
                 for idx in all_users:
-                    local_trainer.model.load_state_dict(local_weights_per[idx], strict=False)
+                    local_trainer.set_trainable_state(client_states.weights(idx))
                     results.append(local_trainer.test(idx=idx,current_epoch=epoch))
 
                 global_test_acc = []
@@ -595,22 +679,22 @@ def main(args):
                 idxs_users = np.random.choice(range(args.num_users), m, replace=False)
             print("idxs_users", idxs_users)
             print("------------local train start epoch:", epoch, "-------------")
-            for idx in idxs_users:
-                if epoch == 0:
-                    local_trainer.model.load_state_dict(global_weights, strict=False)
-                else:
-                    local_trainer.model.load_state_dict(local_weights_per[idx], strict=False)
-
-                local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True, is_last_client=idx==idxs_users[-1])
-                local_weight = local_trainer.model.state_dict()
-                local_weights_0[idx] = copy.deepcopy(local_weight['prompt_learner.ctx'][args.avg_prompt:args.num_prompt])
-                local_weights_1[idx] = copy.deepcopy({k:v for k,v in local_weight.items() if 'lora_S' in k})
-                local_weights[idx] = copy.deepcopy(local_weight)
+            init_weights = [global_weights if epoch == 0 else client_states.weights(idx) for idx in idxs_users]
+            for idx, local_weight in train_clients(
+                local_trainer, client_pool, idxs_users, init_weights, epoch, flag_last_client=True
+            ):
+                # local embeddings, and lora_S if it stays local
+                client_states.personalize(idx, local_weight, 'prompt_learner.ctx', rows=(args.avg_prompt, args.num_prompt))
+                if cfg.TRAINER.GLP_OT_LORA.LOCAL_S:
+                    for k in local_weight:
+                        if 'lora_S' in k:
+                            client_states.personalize(idx, local_weight, k)
+                aggregator.collect(idx, local_weight)
             print("------------local train finish epoch:", epoch, "-------------")
 
             # Important!!
             print('Use EMA')
-            global_weights = average_weights_EMA(global_weights, local_weights, idxs_users, datanumber_client, datanumber_client_by_attr, epoch, max_epoch)
+            global_weights = aggregator.average_EMA(global_weights, idxs_users, datanumber_client, datanumber_client_by_attr, epoch, max_epoch)
             # global_weights = average_weights(local_weights, idxs_users, datanumber_client, datanumber_client_by_attr)
             # update global weights
             # global_trainer.model.load_state_dict(global_weights)
@@ -619,17 +703,12 @@ def main(args):
             results = []
             all_users = list(range(0, cfg.DATASET.USERS))
             
-            for idx in all_users:
-                local_weights_per[idx] = copy.deepcopy(global_weights)
-                # keep local embeddings
-                local_weights_per[idx]['prompt_learner.ctx'][args.avg_prompt:args.num_prompt] = local_weights_0[idx]
-                if cfg.TRAINER.GLP_OT_LORA.LOCAL_S:
-                    for k, v in local_weights_1[idx].items():
-                        local_weights_per[idx][k] = v
+            # every client sees the new global weights under its own local tensors
+            client_states.set_global(global_weights)
             if args.num_users >= 50:
                 if epoch >= 140:
                     for idx in all_users:
-                        local_trainer.model.load_state_dict(local_weights_per[idx],strict=False)
+                        local_trainer.set_trainable_state(client_states.weights(idx))
                         results.append(local_trainer.test(idx=idx,current_epoch=epoch))
                     global_test_acc = []
                     global_test_error = []
@@ -650,7 +729,7 @@ def main(args):
                     print("Epoch on server :", epoch)
             else:
                 for idx in all_users:
-                    local_trainer.model.load_state_dict(local_weights_per[idx], strict=False)
+                    local_trainer.set_trainable_state(client_states.weights(idx))
                     results.append(local_trainer.test(idx=idx,current_epoch=epoch))
 
                 global_test_acc = []
@@ -706,9 +785,9 @@ def main(args):
             print("idxs_users", idxs_users)
             print("------------local train start epoch:", epoch, "-------------")
             results = []
-            for idx in idxs_users:
-                local_trainer.model.load_state_dict(global_weights)
-                local_trainer.train(idx=idx, global_epoch=epoch, is_fed=True)
+            init_weights = [global_weights for idx in idxs_users]
+            for idx, local_weight in train_clients(local_trainer, client_pool, idxs_users, init_weights, epoch):
+                local_trainer.set_trainable_state(local_weight)
                 results.append(local_trainer.test(idx=idx,current_epoch=epoch))
             global_test_acc = []
             global_test_error = []
@@ -746,7 +825,40 @@ def main(args):
             print("------------local test finish-------------")
             break
 
-
+        if args.checkpoint_freq > 0 and ((epoch + 1) % args.checkpoint_freq == 0 or epoch + 1 == max_epoch):
+            fed_state = {
+                'epoch': epoch,
+                'weights': to_device({
+                    'global_weights': trainable_only(global_weights, trainable_keys),
+                    'local_weights_per': [trainable_only(w, trainable_keys) for w in local_weights_per],
+                    'local_weights_0': local_weights_0,
+                    'local_weights_1': local_weights_1,
+                    'client_overlays': client_states.overlays,
+                }, 'cpu'),
+                'idxs_users': [int(idx) for idx in idxs_users],
+                'trainer': get_trainer_state(local_trainer),
+                'metrics': tuple([float(v) for v in values] for values in (
+                    global_test_acc_list, global_test_error_list, global_test_f1_list,
+                    global_test_auc_list, global_epoch_list, global_time_list)),
+                'rng': get_rng_states(),
+            }
+            print("Save federated state to", save_federated_state(fed_state, cfg.OUTPUT_DIR))
+
+    profiler.close({
+        'settings': {
+            'prec': cfg.TRAINER.GLP_OT.PREC,
+            'grad_checkpoint': cfg.TRAINER.GLP_OT_LORA.GRAD_CHECKPOINT,
+            'slice_chunk': cfg.TRAINER.GLP_OT.SLICE_CHUNK,
+            'token_reduction': cfg.TRAINER.GLP_OT.TOKEN_REDUCTION,
+            'num_tokens': cfg.TRAINER.GLP_OT.NUM_TOKENS,
+        },
+        'wall_time': float(global_time_list[-1]) if global_time_list else None,
+        'acc': float(global_test_acc_list[-1]) if global_test_acc_list else None,
+        'auc': float(global_test_auc_list[-1]) if global_test_auc_list else None,
+    })
+
+    if client_pool is not None:
+        client_pool.close()
     for idx in idxs_users:
         local_trainer.fed_after_train()
     # global_trainer.fed_after_train()
@@ -771,6 +883,9 @@ if __name__ == "__main__":
     parser.add_argument('--test_batch_size', type=int, default=100, help="number of test batch size")
     parser.add_argument("--seed", type=int, default=1, help="only positive value enables a fixed seed")
     parser.add_argument('--mu', type=float, default=0.5, help='The parameter for fedprox')
+    parser.add_argument('--checkpoint_freq', type=int, default=1, help="save the federated state every N rounds for --resume, 0 disables it")
+    parser.add_argument('--client_workers', type=int, default=0, help="train the clients of a round in parallel on N worker processes, 0 trains them sequentially; with N > 0 every client starts from the round's optimizer/scheduler state and is seeded per (seed, round, client), so results differ from sequential runs")
+    parser.add_argument('--profile', type=bool, default=False, help="time the phases of every round and client, written to OUTPUT_DIR/profile as JSONL, a Chrome trace and a summary.json that python -m utils.profiler compares across runs")
 
     # parameters of datasets
     # caltech101, oxford_flowers, oxford_pets, food101 and dtd
@@ -789,6 +904,14 @@ if __name__ == "__main__":
     parser.add_argument('--attributes', type=list, default=['gender', 'race', 'ethnicity', 'language', 'maritalstatus'], help='the data attributes in medical data')
     parser.add_argument('--modality_type', type=str, default='slo_fundus', help='slo_fundus, oct_bscans')
     parser.add_argument('--dim_per_3d_slice', type=int, default=16, help='split oct_bscans into multuple slices, dim of each slice')
+    parser.add_argument('--oct_slice_step', type=int, default=4, help='use every n-th B-scan of the oct_bscans volumes, 4: 128 -> 32 slices')
+    parser.add_argument('--packed_data', type=bool, default=False, help='If True, pack the preprocessed FairFedMed samples into memmaps once and read them from there.')
+    parser.add_argument('--uint8_input', type=bool, default=False, help='If True, FairFedMed samples stay uint8 until the model scales and normalizes them on the device.')
+    parser.add_argument('--feature_cache', type=str, default='', help='If set, encode every client split once with the frozen image encoder and train prompts from the features cached in this directory.')
+    parser.add_argument('--evaluator', type=str, default='', help='overrides TEST.EVALUATOR, e.g. Classification_oph_stream to evaluate without a host sync per batch')
+    parser.add_argument('--auc_bins', type=int, default=0, help='score histogram bins of Classification_oph_stream for bounded-memory approximate AUCs, 0 keeps predictions for exact metrics')
+    parser.add_argument('--prec', type=str, default='fp16', help='precision of the GLP_OT trainers: fp16 (CLIP default), fp32, amp (fp16 autocast on cuda) or bf16 (bf16 frozen weights and autocast, also on cpu)')
+    parser.add_argument('--bootstrap', type=int, default=0, help='number of bootstrap replicates for 95% confidence intervals of the fairness metrics, 0 reports point estimates only')
     parser.add_argument('--input_no_transform', type=bool, default=False, help='If True, tfm_train and tfm_test will be None.')
 
     # parameters of learnable prompts
@@ -803,6 +926,12 @@ if __name__ == "__main__":
     parser.add_argument('--eps', type=float, default=0.1, help='the lambada of sinkhorn distance')
     parser.add_argument('--thresh', type=float, default=1e-3, help='the thresh of sinkhorn distance')
     parser.add_argument('--max_iter', type=int, default=100, help="max iteration of COT")
+    parser.add_argument('--ot_check_every', type=int, default=10, help="check OT convergence every k iterations")
+    parser.add_argument('--ot_log_domain', type=bool, default=False, help="solve OT in the log domain, stable for small eps")
+    parser.add_argument('--ot_warm_start', type=bool, default=False, help="warm-start OT from the previous batch's scalings")
+    parser.add_argument('--token_reduction', type=str, default='none', help="reduce the patch tokens before OT: none, topk (most similar to the pooled feature), avgpool (of the token grid) or merge (bipartite token merging)")
+    parser.add_argument('--num_tokens', type=int, default=49, help="patch tokens left by --token_reduction, OT cost and similarity memory scale with it")
+    parser.add_argument('--slice_chunk', type=int, default=0, help="encode oct_bscans volumes this many pseudo images (dim_per_3d_slice B-scans each) at a time with checkpointing, bounding memory for any --oct_slice_step; 0 encodes all slices at once")
 
     parser.add_argument('--unfreeze_image_encoder', type=bool, default=False, help='Unfreeze image encoder of CLIP')
     parser.add_argument('--unfreeze_text_encoder', type=bool, default=False, help='Unfreeze text encoder of CLIP')
@@ -813,6 +942,8 @@ if __name__ == "__main__":
         help='if True, sigular values are viewed as local weights, which DONOT comminicate with golbal weights')
     parser.add_argument('--lora_global_s', type=bool, default=False, 
         help='if True, we use a set of global sigular values, which is used to comminicate with golbal weights')
+    parser.add_argument('--grad_checkpoint', type=int, default=0,
+        help='activation checkpointing of the first N image encoder blocks (ViT) or residual stages (RN), -1 for all; trades backward time for activation memory')
 
     # parameters of path
     parser.add_argument('--logdir', type=str, required=False, default="./logs/", help='Log directory path')
@@ -822,6 +953,7 @@ if __name__ == "__main__":
     parser.add_argument("--dataset-config-file", type=str, default="configs/datasets/caltech101.yaml", help="path to config file for dataset setup")
     parser.add_argument("--resume", type=str, default=None, help="checkpoint directory (from which the training resumes)")
     parser.add_argument("--transforms", type=str, nargs="+", help="data augmentation methods")
+    parser.add_argument("--input_size", type=int, default=0, help="input resolution overriding INPUT.SIZE, e.g. 192 or 160; CLIP's positional embeddings are interpolated to it")
     parser.add_argument("--backbone", type=str, default="", help="name of CNN backbone")
     parser.add_argument("--head", type=str, default="", help="name of head")
     parser.add_argument("--eval-only", action="store_true", help="evaluation only")
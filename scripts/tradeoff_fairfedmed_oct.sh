@@ -0,0 +1,85 @@
+#!/bin/bash
+
+export CUDA_VISIBLE_DEVICES=2
+
+# memory/time of activation checkpointing and accuracy/speed of token reduction,
+# each setting trained with --profile and compared by utils/profiler.py at the end
+
+# custom config
+DATA="DATA/"
+MODEL=FedOTP
+TRAINER=GLP_OT
+PRETRAINED=True
+OT=COT
+TOP_PERCENT=0.8
+EPS=0.1
+THRESH=0.001
+MAX_ITER=100
+LR=0.001
+GAMMA=1
+USERS=3
+FRAC=0.7
+ROUND=30
+STEPSIZE=40
+NUM_PROMPT=2
+DATASET=fairfedmed
+PARTITION=noniid-labeldir100
+SEED=1
+CFG=vit_b16_oph  # token reduction works on the patch tokens of the ViT
+CTP=end  # class token position (end or middle)
+NCTX=4  # number of context tokens
+IID=False
+CSC=False  # class-specific context (False or True)
+BETA=0.3
+INPUT_NO_TRANSFORM=False
+ATTRIBUTE_TYPE='race'
+MODALITY_TYPE='oct_bscans'
+DIM_PER_3D_SLICE=8
+UNFREEZE_IMAGE_ENC=True  # activations are only kept for backward through a trainable encoder
+NUM_TOKENS=49
+DIRS=()
+# grad_checkpoint token_reduction
+for SETTING in "0 none" "-1 none" "0 topk" "0 avgpool" "0 merge"
+do
+  read GRAD_CKPT TOKEN_REDUCTION <<< "${SETTING}"
+  DIR=output/tradeoff_${CFG}_oct/${DATASET}_${MODALITY_TYPE}_${PARTITION}_beta${BETA}_slice${DIM_PER_3D_SLICE}/${MODEL}_${TRAINER}_${OT}_${TOP_PERCENT}_eps${EPS}_${ATTRIBUTE_TYPE}/ckpt${GRAD_CKPT}_${TOKEN_REDUCTION}${NUM_TOKENS}_seed${SEED}
+  DIRS+=("${DIR}")
+  if [ -d "$DIR" ]; then
+    echo "Oops! The results exist at ${DIR} (so skip this job)"
+  else
+    python federated_main.py \
+    --root ${DATA} \
+    --model ${MODEL} \
+    --seed ${SEED} \
+    --num_users ${USERS} \
+    --frac ${FRAC} \
+    --lr ${LR} \
+    --OT ${OT} \
+    --top_percent ${TOP_PERCENT} \
+    --eps ${EPS} \
+    --thresh ${THRESH} \
+    --max_iter ${MAX_ITER} \
+    --gamma ${GAMMA} \
+    --trainer ${TRAINER} \
+    --round ${ROUND} \
+    --stepsize ${STEPSIZE} \
+    --input_no_transform ${INPUT_NO_TRANSFORM} \
+    --attribute_type ${ATTRIBUTE_TYPE} \
+    --modality_type ${MODALITY_TYPE} \
+    --dim_per_3d_slice ${DIM_PER_3D_SLICE} \
+    --partition ${PARTITION} \
+    --beta ${BETA} \
+    --n_ctx ${NCTX} \
+    --num_prompt ${NUM_PROMPT} \
+    --unfreeze_image_encoder ${UNFREEZE_IMAGE_ENC} \
+    --grad_checkpoint ${GRAD_CKPT} \
+    --token_reduction ${TOKEN_REDUCTION} \
+    --num_tokens ${NUM_TOKENS} \
+    --profile True \
+    --dataset-config-file configs/datasets/${DATASET}.yaml \
+    --config-file configs/trainers/GLP_OT/${CFG}.yaml \
+    --output-dir ${DIR}
+  fi
+done
+
+python -m utils.profiler "${DIRS[@]}"
@@ -0,0 +1,101 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from Dassl.dassl.engine.trainer import TrainerBase
+from utils.fed_utils import ClientStateStore
+
+NUM_CLIENTS, AVG_PROMPT, NUM_PROMPT = 3, 1, 2
+
+
+class PromptLearner(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.ctx = nn.Parameter(torch.randn(NUM_PROMPT, 4, 8))
+
+
+class ToyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.prompt_learner = PromptLearner()
+        self.fc = nn.Linear(8, 8)
+        self.fc.requires_grad_(False)  # frozen backbone, never swapped
+        self.lora_S = nn.Embedding(3, 4)
+        self.bn = nn.BatchNorm1d(8)
+        # a second (device, dtype) group of trainable tensors
+        self.head = nn.Linear(8, 2).to(torch.float64)
+
+
+def make_trainer(seed):
+    torch.manual_seed(seed)
+    trainer = TrainerBase()
+    trainer.model = ToyModel()
+    return trainer
+
+
+def trained_weights(trainer, seed):
+    torch.manual_seed(seed)
+    return {k: torch.randn_like(v) for k, v in trainer.get_trainable_state().items()}
+
+
+def test_overlays_match_the_copied_client_weights():
+    trainer = make_trainer(0)
+    store = ClientStateStore(NUM_CLIENTS)
+    local_weights_0 = [[] for _ in range(NUM_CLIENTS)]
+    local_weights_1 = [[] for _ in range(NUM_CLIENTS)]
+    for epoch in range(3):
+        for idx in range(NUM_CLIENTS):
+            local_weight = trained_weights(trainer, 10 * epoch + idx)
+            local_weights_0[idx] = copy.deepcopy(local_weight['prompt_learner.ctx'][AVG_PROMPT:NUM_PROMPT])
+            local_weights_1[idx] = copy.deepcopy({k: v for k, v in local_weight.items() if 'lora_S' in k})
+            store.personalize(idx, local_weight, 'prompt_learner.ctx', rows=(AVG_PROMPT, NUM_PROMPT))
+            store.personalize(idx, local_weight, 'lora_S.weight')
+        global_weights = trained_weights(trainer, 100 + epoch)
+        snapshot = copy.deepcopy(global_weights)
+        store.set_global(global_weights)
+
+        for idx in range(NUM_CLIENTS):
+            # the per-client deepcopy the overlays replace
+            expected = copy.deepcopy(global_weights)
+            expected['prompt_learner.ctx'][AVG_PROMPT:NUM_PROMPT] = local_weights_0[idx]
+            for k, v in local_weights_1[idx].items():
+                expected[k] = v
+            weights = store.weights(idx)
+            assert weights.keys() == expected.keys()
+            for k in expected:
+                torch.testing.assert_close(weights[k], expected[k], msg=k)
+            # merging an overlay never writes into the shared global tensors
+            for k in snapshot:
+                torch.testing.assert_close(global_weights[k], snapshot[k], msg=k)
+
+
+def test_swap_round_trips_the_state_dict():
+    trainer = make_trainer(0)
+    before = copy.deepcopy(trainer.model.state_dict())
+    state = trainer.get_trainable_state()
+    assert set(state) == {'prompt_learner.ctx', 'lora_S.weight', 'bn.weight', 'bn.bias',
+                          'bn.running_mean', 'bn.running_var', 'head.weight', 'head.bias'}
+    # a copy, not a view of the live tensors
+    with torch.no_grad():
+        trainer.model.prompt_learner.ctx.add_(1.)
+    trainer.set_trainable_state(state)
+    after = trainer.model.state_dict()
+    for k in before:
+        torch.testing.assert_close(after[k], before[k], msg=k)
+
+    # swapping client weights in equals load_state_dict(strict=False)
+    weights = trained_weights(trainer, 1)
+    other = make_trainer(0)
+    other.model.load_state_dict(weights, strict=False)
+    trainer.set_trainable_state(weights)
+    for k, v in other.model.state_dict().items():
+        torch.testing.assert_close(trainer.model.state_dict()[k], v, msg=k)
+    for k, v in trainer.get_trainable_state().items():
+        assert v.dtype == weights[k].dtype
+        torch.testing.assert_close(v, weights[k], msg=k)
+
+    # frozen tensors are never written, even when the weights carry them
+    fc_weight = trainer.model.fc.weight.clone()
+    trainer.set_trainable_state({'fc.weight': torch.zeros_like(fc_weight)})
+    torch.testing.assert_close(trainer.model.fc.weight, fc_weight)
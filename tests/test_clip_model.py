@@ -0,0 +1,17 @@
+import torch
+
+from clip.model import ModifiedVisionTransformer, set_input_resolution
+
+
+def test_set_input_resolution():
+    visual = ModifiedVisionTransformer(32, 8, 64, 1, 1, 16, design_details={'trainer': 'GLP_OT'})
+    positional_embedding = visual.positional_embedding
+    set_input_resolution(visual, 32)
+    assert visual.positional_embedding is positional_embedding
+
+    set_input_resolution(visual, 48)
+    assert visual.input_resolution == 48
+    assert visual.positional_embedding.shape == (6 * 6 + 1, 64)
+    # the class token embedding is kept
+    torch.testing.assert_close(visual.positional_embedding[0], positional_embedding[0])
+    assert visual(torch.randn(2, 3, 48, 48)).shape == (6 * 6 + 1, 2, 16)
@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from skimage.transform import resize
+
+from utils.data_utils import (
+    FairFedMedDataset, PackedFairFedMedDataset, _index_shape_len, load_fairfedmed_index, resize_stack
+)
+
+
+def test_index_keeps_shapes_across_the_cache(tmp_path):
+    for i in range(2):
+        np.savez(
+            tmp_path / f'data_{i}.npz',
+            oct_bscans=np.zeros((4, 3, 3), dtype=np.uint8),
+            rnflt=np.zeros(200, dtype=np.float32),
+            glaucoma=np.array(i),
+        )
+    filenames = ['data_0.npz', 'data_1.npz']
+    index_path = str(tmp_path / 'index.csv')
+
+    built = load_fairfedmed_index(str(tmp_path), filenames, index_path)
+    cached = load_fairfedmed_index(str(tmp_path), filenames, index_path)
+    for index in [built, cached]:
+        assert index.loc[filenames, 'oct_bscans_shape'].map(_index_shape_len).tolist() == [4, 4]
+        # a 1-D shape must not come back from the csv as an int
+        assert index.loc[filenames, 'rnflt_shape'].map(_index_shape_len).tolist() == [200, 200]
+        assert index.loc[filenames, 'glaucoma'].tolist() == [0, 1]
+    assert not [f for f in os.listdir(tmp_path) if '.tmp' in f]
+
+
+@pytest.mark.parametrize('shape,resolution', [
+    ((4, 200, 200), 224),  # oct_bscans upsampled to the ViT input
+    ((4, 200, 200), 128),  # downsampled, anti-aliased
+    ((1, 20, 30), 24),     # slo_fundus, non-square
+    ((3, 1, 5), 8),        # a single row, border reflection only
+])
+def test_resize_stack_matches_skimage(shape, resolution):
+    stack = np.random.RandomState(0).randint(0, 256, shape).astype(np.uint8)
+    expected = np.stack([resize(s.astype(np.float32), (resolution, resolution)) for s in stack])
+    resized = resize_stack(stack, resolution)
+    assert resized.shape == expected.shape
+    np.testing.assert_allclose(resized, expected, atol=1e-3, rtol=1e-5)
+
+
+def make_fairfedmed(base_path, num_samples=3):
+    rng = np.random.RandomState(0)
+    os.makedirs(base_path / 'all')
+    filenames = [f'data_{i}.npz' for i in range(num_samples)]
+    for i, filename in enumerate(filenames):
+        np.savez(
+            base_path / 'all' / filename,
+            oct_bscans=rng.randint(0, 256, (8, 12, 12)).astype(np.uint8),
+            slo_fundus=rng.randint(0, 256, (20, 20)).astype(np.uint8),
+            glaucoma=np.array(i % 2),
+            race=np.array(i % 3),
+            gender=np.array(i % 2),
+        )
+    pd.DataFrame({'filename': filenames}).to_csv(base_path / 'meta_site1_race_train.csv', index=False)
+
+
+@pytest.mark.parametrize('modality_type', ['oct_bscans', 'oct_bscans_3d', 'slo_fundus'])
+@pytest.mark.parametrize('uint8', [False, True])
+def test_packed_samples_match_the_npz(tmp_path, modality_type, uint8):
+    make_fairfedmed(tmp_path)
+    kwargs = dict(
+        base_path=str(tmp_path), site=1, attribute_type='race', attributes=['race', 'gender'],
+        modality_type=modality_type, resolution=16, uint8=uint8, slice_step=2,
+    )
+    dataset = FairFedMedDataset(**kwargs)
+    packed = PackedFairFedMedDataset(**kwargs)
+    # a second dataset reuses the pack
+    reopened = PackedFairFedMedDataset(**kwargs)
+    assert packed.data_files == dataset.data_files == reopened.data_files
+    for i in range(len(dataset)):
+        expected = dataset[i]
+        for sample in [packed[i], reopened[i]]:
+            assert sample[0].dtype == expected[0].dtype
+            np.testing.assert_array_equal(sample[0], expected[0])
+            assert sample[0].flags.writeable
+            torch.testing.assert_close(sample[1], expected[1])
+            torch.testing.assert_close(sample[2], expected[2])
+
+    # the pack is specific to the preprocessing options
+    other = PackedFairFedMedDataset(**dict(kwargs, resolution=24))
+    assert other.prefix != packed.prefix
+    assert other[0][0].shape[-1] == (24 if modality_type != 'oct_bscans_3d' else 12)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch
+from yacs.config import CfgNode as CN
+
+from evaluation.evaluator_oph import Classification_oph, Classification_oph_stream
+
+
+def make_cfg(auc_bins):
+    cfg = CN()
+    cfg.SEED = 1
+    cfg.TEST = CN()
+    cfg.TEST.PER_CLASS_RESULT = False
+    cfg.TEST.BOOTSTRAP = 0
+    cfg.TEST.AUC_BINS = auc_bins
+    cfg.DATASET = CN()
+    cfg.DATASET.ATTRIBUTES = ['race', 'gender', 'maritalstatus']
+    return cfg
+
+
+def run(evaluator, batches):
+    evaluator.reset()
+    for logits, gt, attr in batches:
+        evaluator.process(logits, gt, attr)
+    return evaluator.evaluate()
+
+
+@pytest.mark.parametrize('auc_bins', [0, 4096])
+def test_stream_matches_baseline_with_unknown_groups(auc_bins):
+    rng = np.random.default_rng(0)
+    batches = []
+    for i in range(6):
+        gt = torch.from_numpy(rng.integers(0, 2, 32))
+        logits = torch.from_numpy(rng.normal(size=(32, 2)).astype(np.float32)) + 1.5 * torch.nn.functional.one_hot(gt, 2)
+        # -1 is "unknown"; the later batches bring a new unknown group and a larger value
+        attr = np.stack([rng.integers(0, 3, 32), rng.integers(0, 2, 32), rng.integers(0, 3 + i // 2, 32)])
+        if i >= 2:
+            attr[1:, :4] = -1
+        batches.append((logits, gt, torch.from_numpy(attr)))
+
+    expected = run(Classification_oph(make_cfg(auc_bins)), batches)
+    results = run(Classification_oph_stream(make_cfg(auc_bins)), batches)
+    tol = 0 if auc_bins == 0 else 1e-3
+    for key in ['accuracy', 'auc', 'overall_acc', 'overall_auc']:
+        assert results[key] == pytest.approx(expected[key], abs=100 * tol), key
+    for key in ['esaccs_by_attrs', 'esaucs_by_attrs', 'dpds', 'eods', 'aods']:
+        np.testing.assert_allclose(results[key], expected[key], atol=tol, err_msg=key)
+    for got, want in zip(results['aucs_by_attrs'], expected['aucs_by_attrs']):
+        np.testing.assert_allclose(got, want, atol=tol)
+
+
+def bootstrap_ci(seed, client, round):
+    rng = np.random.default_rng(1)
+    gt = torch.from_numpy(rng.integers(0, 2, 64))
+    logits = torch.from_numpy(rng.normal(size=(64, 2)).astype(np.float32))
+    attr = torch.from_numpy(np.stack([rng.integers(0, 3, 64), rng.integers(-1, 2, 64), rng.integers(0, 4, 64)]))
+    cfg = make_cfg(0)
+    cfg.SEED = seed
+    cfg.TEST.BOOTSTRAP = 20
+    evaluator = Classification_oph(cfg)
+    evaluator.client, evaluator.round = client, round
+    return run(evaluator, [(logits, gt, attr)])['ci']['overall_auc']
+
+
+def test_bootstrap_seed():
+    # SEED=-1 is an unseeded run
+    bootstrap_ci(-1, 0, 0)
+    np.testing.assert_array_equal(bootstrap_ci(1, 0, 3), bootstrap_ci(1, 0, 3))
+    assert not np.array_equal(bootstrap_ci(1, 0, 3), bootstrap_ci(1, 1, 3))
+    assert not np.array_equal(bootstrap_ci(1, 0, 3), bootstrap_ci(1, 0, 4))
@@ -0,0 +1,82 @@
+import pytest
+import torch
+import torch.nn as nn
+
+import Dassl.dassl.engine  # noqa: F401, resolves the trainer registry import cycle
+from trainers.GLP_OT_SVLoRA import AttrGroups, FairLoRALinear
+
+NUM_ATTRS, RANK, BATCH = 3, 6, 4
+
+
+def make_layer(conv, global_s):
+    torch.manual_seed(0)
+    original = nn.Conv2d(16, 24, 1) if conv else nn.Linear(16, 24)
+    layer = FairLoRALinear(original, rank=RANK, alpha=0.4, global_s=bool(global_s), num_attrs=NUM_ATTRS).double()
+    # A is zero-initialized, which would hide any difference in S
+    nn.init.normal_(layer.lora_A.weight)
+    if global_s:
+        # reset_parameters() leaves the global singular values 1-D, the embedding creates them 1 x r
+        shape = (RANK,) if global_s == '1d' else (1, RANK)
+        layer.lora_S_global.weight.data = torch.randn(shape, dtype=torch.double)
+    return layer
+
+
+def make_input(conv, num_slices):
+    torch.manual_seed(1)
+    if conv:
+        x = torch.randn(BATCH * num_slices, 16, 5, 5, dtype=torch.double)
+    else:
+        x = torch.randn(7, BATCH * num_slices, 16, dtype=torch.double)
+    attr = torch.tensor([0, 2, 1, 2])
+    return x, attr
+
+
+def forward_and_grads(layer, x, attr):
+    layer.zero_grad()
+    y = layer(x, attr)
+    y.pow(2).sum().backward()
+    return y.detach(), {n: p.grad.clone() for n, p in layer.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize('conv', [False, True])
+@pytest.mark.parametrize('global_s', [False, '1d', '2d'])
+@pytest.mark.parametrize('num_slices', [1, 3])
+def test_fused_matches_diag(conv, global_s, num_slices):
+    layer = make_layer(conv, global_s)
+    x, attr = make_input(conv, num_slices)
+
+    y_fused, grads_fused = forward_and_grads(layer, x, attr)
+    layer.fused = False
+    y_diag, grads_diag = forward_and_grads(layer, x, attr)
+
+    torch.testing.assert_close(y_fused, y_diag)
+    assert grads_fused.keys() == grads_diag.keys()
+    for name in grads_fused:
+        torch.testing.assert_close(grads_fused[name], grads_diag[name], msg=name)
+
+
+@pytest.mark.parametrize('conv', [False, True])
+@pytest.mark.parametrize('global_s', [False, '1d', '2d'])
+@pytest.mark.parametrize('num_slices', [1, 3])
+def test_merged_matches_fused(conv, global_s, num_slices):
+    layer = make_layer(conv, global_s)
+    x, attr = make_input(conv, num_slices)
+    with torch.no_grad():
+        y_fused = layer(x, attr)
+        layer.merge()
+        y_merged = layer(x, attr)
+    torch.testing.assert_close(y_merged, y_fused)
+
+
+@pytest.mark.parametrize('conv', [False, True])
+@pytest.mark.parametrize('num_slices', [1, 3])
+@pytest.mark.parametrize('attr', [[0, 2, 1, 2], [2, 2, 2, 2]])
+def test_merged_with_attr_groups(conv, num_slices, attr):
+    layer = make_layer(conv, '1d')
+    x, _ = make_input(conv, num_slices)
+    attr = torch.tensor(attr)
+    with torch.no_grad():
+        y_fused = layer(x, attr)
+        layer.merge()
+        y_merged = layer(x, AttrGroups(attr, num_slices, x.device))
+    torch.testing.assert_close(y_merged, y_fused)
@@ -0,0 +1,95 @@
+import types
+
+import torch
+import torch.nn as nn
+
+from Dassl.dassl.config import get_cfg_default
+from Dassl.dassl.data import build_data_loader
+from utils.feature_cache import cache_client_features, feature_cache_prefix
+
+
+class ToySplit(torch.utils.data.Dataset):
+    """A client split whose samples are a function of their file name."""
+
+    def __init__(self, data_files):
+        self.data_files = data_files
+
+    def __len__(self):
+        return len(self.data_files)
+
+    def __getitem__(self, item):
+        value = float(self.data_files[item].split('_')[1])
+        return torch.full((4,), value), torch.tensor(item % 2), torch.tensor([item % 3, 0])
+
+
+class ToyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.image_encoder = nn.Linear(4, 2)
+        self.image_encoder.requires_grad_(False)
+        self.encoded = 0
+
+    def encode_image(self, image):
+        self.encoded += image.shape[0]
+        return self.image_encoder(image)
+
+
+def make_cfg(cache_dir, seed=1):
+    cfg = get_cfg_default()
+    cfg.SEED = seed
+    cfg.DATALOADER.NUM_WORKERS = 0
+    cfg.DATASET.NAME = 'FairFedMed'
+    cfg.DATASET.ROOT = 'data'
+    cfg.DATASET.USERS = 1
+    cfg.DATASET.IID = False
+    cfg.DATASET.PARTITION = 'noniid'
+    cfg.DATASET.USEALL = False
+    cfg.DATASET.NUM_SHOTS = 4
+    cfg.DATASET.BETA = 0.5
+    cfg.DATASET.ATTRIBUTE_TYPE = 'race'
+    cfg.DATASET.ATTRIBUTES = ['race', 'gender']
+    cfg.DATASET.MODALITY_TYPE = 'slo_fundus'
+    cfg.DATASET.OCT_SLICE_STEP = 4
+    cfg.DATASET.UINT8 = False
+    cfg.MODEL.FEATURE_CACHE = str(cache_dir)
+    return cfg
+
+
+def cache(cfg, data_files):
+    trainer = types.SimpleNamespace(cfg=cfg, model=ToyModel(), device=torch.device('cpu'))
+    trainer.fed_train_loader_x_dict = {0: build_data_loader(cfg, ToySplit(data_files), 2, is_train=True)}
+    trainer.fed_test_loader_x_dict = {0: build_data_loader(cfg, ToySplit(data_files), 2, is_train=False)}
+    assert cache_client_features(trainer)
+    features = trainer.fed_test_loader_x_dict[0].dataset.data_source
+    return trainer.model.encoded, torch.stack([features[i][0] for i in range(len(features))])
+
+
+def test_cache_is_keyed_by_the_samples(tmp_path):
+    files = ['f_0', 'f_1', 'f_2', 'f_3']
+    encoded, features = cache(make_cfg(tmp_path), files)
+    assert encoded == 8  # train and test split
+
+    encoded, reused = cache(make_cfg(tmp_path), files)
+    assert encoded == 0
+    torch.testing.assert_close(reused, features)
+
+    # another few-shot draw of the same size must not reuse the entry
+    other = ['f_4', 'f_5', 'f_6', 'f_7']
+    encoded, features = cache(make_cfg(tmp_path), other)
+    assert encoded == 8
+    assert not torch.allclose(features, reused)
+
+
+def test_prefix_covers_the_split():
+    cfg = make_cfg('cache')
+    prefix = feature_cache_prefix(cfg, 0, 'train')
+    for key, value in [('SEED', 2), ('DATASET.NUM_SHOTS', 8), ('DATASET.IID', True), ('DATASET.USEALL', True),
+                       ('DATASET.ROOT', 'other'), ('DATASET.ATTRIBUTES', ['gender', 'race'])]:
+        changed = make_cfg('cache')
+        node = changed
+        *path, name = key.split('.')
+        for part in path:
+            node = getattr(node, part)
+        setattr(node, name, value)
+        assert feature_cache_prefix(changed, 0, 'train') != prefix, key
@@ -0,0 +1,61 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from utils.fed_utils import FlatAggregator, average_weights, average_weights_EMA
+
+NUM_CLIENTS, NUM_ATTRS = 4, 3
+
+
+class ToyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = nn.Linear(5, 2)
+        self.fc.weight.requires_grad = False  # frozen, not aggregated
+        self.lora_S = nn.Embedding(NUM_ATTRS, 4)
+        self.bn = nn.BatchNorm1d(2)
+
+
+def client_states(model):
+    keys = [k for k, v in model.state_dict(keep_vars=True).items()
+            if k != 'fc.weight' and k != 'bn.num_batches_tracked']
+    states = []
+    for i in range(NUM_CLIENTS):
+        torch.manual_seed(i)
+        states.append({k: torch.randn_like(model.state_dict()[k]) for k in keys})
+    return keys, states
+
+
+@pytest.mark.parametrize('by_attr', [False, True])
+def test_average_matches_average_weights(by_attr):
+    model = ToyModel()
+    keys, states = client_states(model)
+    aggregator = FlatAggregator(model, NUM_CLIENTS)
+    assert sorted(aggregator.keys) == sorted(keys)
+    idxs_users = [0, 2, 3]
+    for idx in idxs_users:
+        aggregator.collect(idx, states[idx])
+    datanumber_client = [10, 20, 30, 40]
+    datanumber_client_by_attr = [[1, 2, 3], [4, 5, 6], [7, 1, 2], [3, 3, 9]] if by_attr else None
+
+    result = aggregator.average(idxs_users, datanumber_client, datanumber_client_by_attr)
+    expected = average_weights(states, idxs_users, datanumber_client, datanumber_client_by_attr)
+    for key in keys:
+        torch.testing.assert_close(result[key], expected[key], msg=key)
+
+
+def test_average_EMA_matches_average_weights_EMA():
+    model = ToyModel()
+    keys, states = client_states(model)
+    aggregator = FlatAggregator(model, NUM_CLIENTS)
+    idxs_users = [1, 3]
+    for idx in idxs_users:
+        aggregator.collect(idx, states[idx])
+    datanumber_client = [10, 20, 30, 40]
+    datanumber_client_by_attr = [[1, 2, 3], [4, 5, 6], [7, 1, 2], [3, 3, 9]]
+    w_g = states[0]
+
+    result = aggregator.average_EMA(w_g, idxs_users, datanumber_client, datanumber_client_by_attr, 3, 10)
+    expected = average_weights_EMA(w_g, states, idxs_users, datanumber_client, datanumber_client_by_attr, 3, 10)
+    for key in keys:
+        torch.testing.assert_close(result[key], expected[key], msg=key)
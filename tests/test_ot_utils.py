@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from utils.ot_utils import entropic_cot, entropic_cot_log, sinkhorn, sinkhorn_log
+
+B, M, N, EPS = 6, 12, 4, 0.1
+
+
+def baseline_sinkhorn(K, u, v, max_iter, thresh):
+    """CustomCLIP.Sinkhorn before the solvers were batched."""
+    r = torch.ones_like(u)
+    c = torch.ones_like(v)
+    for i in range(max_iter):
+        r0 = r
+        r = u / torch.matmul(K, c.unsqueeze(-1)).squeeze(-1)
+        c = v / torch.matmul(K.permute(0, 2, 1).contiguous(), r.unsqueeze(-1)).squeeze(-1)
+        err = (r - r0).abs().mean()
+        if err.item() < thresh:
+            break
+    return torch.matmul(r.unsqueeze(-1), c.unsqueeze(-2)) * K
+
+
+def baseline_cot(a, b, K, max_iter, thresh):
+    """CustomCLIP.entropic_COT_fast before the solvers were batched."""
+    dx = torch.ones_like(a)
+    dy = torch.ones_like(b)
+    Kp = torch.matmul(torch.diag_embed(1 / a, dim1=1), K)
+    Kq = torch.matmul(torch.diag_embed(1 / b, dim1=1), K.permute(0, 2, 1))
+    u = dx
+    v = dy
+    for i in range(max_iter):
+        v0 = v
+        u = torch.minimum(torch.div(dx, torch.matmul(Kp, v.unsqueeze(-1)).squeeze(-1)), dx)
+        v = torch.div(dy, torch.matmul(Kq, u.unsqueeze(-1)).squeeze(-1))
+        err = (v - v0).abs().mean()
+        if err.item() < thresh:
+            break
+    Kprev = torch.matmul(torch.diag_embed(u, dim1=1), K)
+    return torch.matmul(Kprev, torch.diag_embed(v, dim1=1))
+
+
+def make_problem(ot, seed=0):
+    torch.manual_seed(seed)
+    sim = torch.rand(B, M, N, dtype=torch.float64) * 2 - 1
+    wdist = 1.0 - sim
+    xx = torch.full((B, M), 1. / M, dtype=torch.float64)
+    yy = torch.full((B, N), 1. / N, dtype=torch.float64)
+    if ot == 'COT':
+        yy = yy * 0.8
+    return wdist, xx, yy
+
+
+def solve(ot, log_domain, wdist, xx, yy, **kwargs):
+    if ot == 'Sinkhorn':
+        if log_domain:
+            return sinkhorn_log(wdist, xx, yy, EPS, **kwargs)
+        return sinkhorn(torch.exp(-wdist / EPS), xx, yy, **kwargs)
+    if log_domain:
+        return entropic_cot_log(xx, yy, wdist, EPS, **kwargs)
+    return entropic_cot(xx, yy, torch.exp(-wdist / EPS), **kwargs)
+
+
+def baseline(ot, wdist, xx, yy, max_iter, thresh):
+    K = torch.exp(-wdist / EPS)
+    if ot == 'Sinkhorn':
+        return baseline_sinkhorn(K, xx, yy, max_iter, thresh)
+    return baseline_cot(xx, yy, K, max_iter, thresh)
+
+
+@pytest.mark.parametrize('ot', ['Sinkhorn', 'COT'])
+def test_check_every_one_is_the_baseline_iteration(ot):
+    wdist, xx, yy = make_problem(ot)
+    expected = baseline(ot, wdist, xx, yy, max_iter=100, thresh=1e-3)
+    T, _ = solve(ot, False, wdist, xx, yy, max_iter=100, thresh=1e-3, check_every=1)
+    torch.testing.assert_close(T, expected, atol=1e-12, rtol=1e-10)
+
+
+@pytest.mark.parametrize('ot', ['Sinkhorn', 'COT'])
+@pytest.mark.parametrize('log_domain', [False, True])
+@pytest.mark.parametrize('check_every', [1, 10])
+@pytest.mark.parametrize('warm_start', [False, True])
+def test_converges_to_the_baseline_plan(ot, log_domain, check_every, warm_start):
+    wdist, xx, yy = make_problem(ot)
+    expected = baseline(ot, wdist, xx, yy, max_iter=5000, thresh=1e-12)
+
+    init = None
+    if warm_start:
+        # the duals of the previous batch, as kept in CustomCLIP.ot_duals
+        previous, _, _ = make_problem(ot, seed=1)
+        _, duals = solve(ot, log_domain, previous, xx, yy, max_iter=100, thresh=1e-3, check_every=check_every)
+        init = duals[1]
+    T, _ = solve(ot, log_domain, wdist, xx, yy, max_iter=5000, thresh=1e-12, check_every=check_every, init=init)
+    torch.testing.assert_close(T, expected, atol=1e-9, rtol=1e-6)
+
+
+@pytest.mark.parametrize('ot', ['Sinkhorn', 'COT'])
+def test_warm_start_needs_fewer_iterations(ot):
+    wdist, xx, yy = make_problem(ot)
+    _, duals = solve(ot, False, wdist, xx, yy, max_iter=5000, thresh=1e-12, check_every=1)
+    # restarting from the converged duals stops at the first check
+    T, _ = solve(ot, False, wdist, xx, yy, max_iter=1, thresh=1e-9, check_every=1, init=duals[1])
+    expected = baseline(ot, wdist, xx, yy, max_iter=5000, thresh=1e-12)
+    torch.testing.assert_close(T, expected, atol=1e-9, rtol=1e-6)
@@ -0,0 +1,126 @@
+import types
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from yacs.config import CfgNode as CN
+
+import Dassl.dassl.engine  # noqa: F401, resolves the trainer registry import cycle
+import trainers.GLP_OT_SVLoRA
+from clip.model import ModifiedVisionTransformer
+from trainers.GLP_OT_SVLoRA import (
+    GLP_OT_SVLoRA, FairLoRALinear, apply_lora_to_model, merge_lora_weights, unmerge_lora_weights
+)
+from utils.precision import cast_frozen_weights, encoder_autocast
+
+NUM_ATTRS = 3
+
+
+class TinyCLIP(nn.Module):
+    """A small ViT image encoder with FairLoRA on its MLPs and a linear head, run like CustomCLIP."""
+
+    def __init__(self, prec):
+        super().__init__()
+        torch.manual_seed(0)
+        self.image_encoder = ModifiedVisionTransformer(32, 8, 64, 2, 1, 16, design_details={'trainer': 'GLP_OT'})
+        apply_lora_to_model(self, True, rank=4, alpha=0.4, lora_type='FairLoRA', global_s=True, num_attrs=NUM_ATTRS)
+        for name, param in self.image_encoder.named_parameters():
+            param.requires_grad = 'lora_' in name
+            if 'lora_A' in name:
+                # A is zero-initialized, which would leave the LoRA branch out of the comparison
+                nn.init.normal_(param, std=0.1)
+        self.head = nn.Linear(16, 2)
+        self.prec = prec
+        if prec == 'bf16':
+            cast_frozen_weights(self.image_encoder, torch.bfloat16)
+
+    def forward(self, image, attr=None):
+        with encoder_autocast(self.prec, image.device):
+            image_features = self.image_encoder(image, attr=attr)
+        return self.head(image_features.float()[0])
+
+
+def make_batch():
+    torch.manual_seed(1)
+    return {
+        'img': torch.randn(4, 3, 32, 32),
+        'label': torch.tensor([0, 1, 1, 0]),
+        # race, gender
+        'attrs': torch.tensor([[0, 1], [2, 0], [1, 1], [2, 0]]),
+    }
+
+
+def record_attrs(model):
+    seen = []
+    for module in model.modules():
+        if isinstance(module, FairLoRALinear):
+            module.register_forward_pre_hook(lambda module, args: seen.append(args[1]))
+    return seen
+
+
+@pytest.mark.parametrize('prec', ['amp', 'bf16'])
+def test_matches_fp32(prec):
+    batch = make_batch()
+    attr = batch['attrs'][:, 0]
+    with torch.no_grad():
+        expected = TinyCLIP('fp32').image_encoder(batch['img'], attr=attr)
+        model = TinyCLIP(prec)
+        with encoder_autocast(prec, batch['img'].device):
+            features = model.image_encoder(batch['img'], attr=attr)
+    assert features.dtype == torch.bfloat16
+    torch.testing.assert_close(features.float(), expected, atol=5e-2, rtol=5e-2)
+
+
+def make_trainer(model, scaler):
+    trainer = types.SimpleNamespace()
+    trainer.cfg = CN()
+    trainer.cfg.DATASET = CN()
+    trainer.cfg.DATASET.NAME = 'FairFedMed'
+    trainer.cfg.DATASET.ATTRIBUTES = ['race', 'gender']
+    trainer.cfg.DATASET.ATTRIBUTE_TYPE = 'race'
+    trainer.device = torch.device('cpu')
+    trainer.model = model
+    trainer.scaler = scaler
+    trainer.optim = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=0.1)
+    trainer.batch_idx, trainer.num_batches = 0, 2
+    trainer.parse_batch_train = lambda batch: GLP_OT_SVLoRA.parse_batch_train(trainer, batch)
+
+    def model_backward_and_update(loss):
+        trainer.optim.zero_grad()
+        loss.backward()
+        trainer.optim.step()
+
+    trainer.model_backward_and_update = model_backward_and_update
+    return trainer
+
+
+@pytest.mark.parametrize('prec', ['fp32', 'amp', 'bf16'])
+@pytest.mark.parametrize('scaler', [False, True])
+def test_attrs_reach_fairlora(prec, scaler, monkeypatch):
+    # the pinned scikit-learn returns numpy scalars, newer ones python floats
+    compute_auc = trainers.GLP_OT_SVLoRA.compute_auc
+    monkeypatch.setattr(trainers.GLP_OT_SVLoRA, 'compute_auc', lambda *args: np.float64(compute_auc(*args)))
+    model = TinyCLIP(prec)
+    seen = record_attrs(model)
+    batch = make_batch()
+    # a disabled GradScaler takes the loss scaling branch of forward_backward() on the cpu
+    trainer = make_trainer(model, torch.cuda.amp.GradScaler(enabled=False) if scaler else None)
+    lora_S = model.image_encoder.transformer.resblocks[0].mlp.c_fc.lora_S.weight.clone()
+
+    GLP_OT_SVLoRA.forward_backward(trainer, batch)
+    assert len(seen) == 4
+    for attr in seen:
+        torch.testing.assert_close(attr, batch['attrs'][:, 0])
+    # the step went through the scaler or model_backward_and_update()
+    assert not torch.equal(lora_S, model.image_encoder.transformer.resblocks[0].mlp.c_fc.lora_S.weight)
+
+    # evaluation runs on the merged weights
+    seen.clear()
+    merge_lora_weights(model)
+    with torch.no_grad():
+        model(batch['img'], batch['attrs'][:, 0])
+    unmerge_lora_weights(model)
+    assert len(seen) == 4
+    for attr in seen:
+        torch.testing.assert_close(attr, batch['attrs'][:, 0])
@@ -0,0 +1,33 @@
+import json
+
+from utils.profiler import RoundProfiler, compare
+
+
+def profile_run(output_dir, grad_checkpoint, duration, acc):
+    profiler = RoundProfiler()
+    profiler.enable(str(output_dir / 'profile'))
+    for round in range(2):
+        profiler.start_round(round)
+        profiler.add('backward', duration)
+        with profiler.phase('image_encode'):
+            pass
+    profiler.close({'settings': {'grad_checkpoint': grad_checkpoint}, 'wall_time': 10., 'acc': acc, 'auc': None})
+
+
+def test_summary_is_compared_across_runs(tmp_path, capsys):
+    profile_run(tmp_path / 'baseline', 0, 1., 0.75)
+    profile_run(tmp_path / 'checkpointed', -1, 2., 0.5)
+    with open(tmp_path / 'baseline' / 'profile' / 'summary.json') as f:
+        summary = json.load(f)
+    assert summary['phases']['backward']['calls'] == 2
+    assert abs(summary['phases']['backward']['total_s'] - 2.) < 1e-6
+
+    capsys.readouterr()
+    rows = compare([tmp_path / 'baseline', tmp_path / 'checkpointed'])
+    assert [row['grad_checkpoint'] for row in rows] == [0, -1]
+    assert [row['acc'] for row in rows] == [0.75, 0.5]
+    assert abs(rows[1]['backward_s'] - 4.) < 1e-6
+    assert rows[0]['ot_solve_s'] is None
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split()[:3] == ['run', 'grad_checkpoint', 'wall_s']
+    assert lines[1].split()[0] == 'baseline' and lines[2].split()[0] == 'checkpointed'
@@ -0,0 +1,93 @@
+import random
+
+import numpy as np
+import torch
+from yacs.config import CfgNode as CN
+
+from federated_main import train_clients
+from utils.client_pool import get_trainer_state, set_trainer_state, to_device
+from utils.fed_utils import get_rng_states, load_federated_state, save_federated_state, set_rng_states
+
+
+class ToyTrainer:
+    """The parts of a trainer that train_clients() and the federated checkpoint touch."""
+
+    def __init__(self):
+        self.cfg = CN()
+        self.cfg.SEED = 1
+        self.cfg.DATASET = CN()
+        self.cfg.DATASET.USERS = 2
+        torch.manual_seed(0)
+        self.model = torch.nn.Linear(3, 1)
+        optim = torch.optim.SGD(self.model.parameters(), lr=0.1, momentum=0.9)
+        self._optims = {'model': optim}
+        self._scheds = {'model': torch.optim.lr_scheduler.StepLR(optim, 1, gamma=0.5)}
+
+    def get_model_names(self):
+        return ['model']
+
+    def get_trainable_state(self):
+        return {k: v.detach().clone() for k, v in self.model.state_dict().items()}
+
+    def set_trainable_state(self, weights):
+        self.model.load_state_dict(weights)
+
+    def train(self, idx, global_epoch, is_fed):
+        # every generator a real round draws from: sampling, augmentation, dropout
+        x = torch.randn(8, 3) * random.random() + np.random.rand()
+        self._optims['model'].zero_grad()
+        self.model(x).pow(2).mean().backward()
+        self._optims['model'].step()
+        self._scheds['model'].step()
+
+
+def run_round(trainer, global_weights, epoch):
+    idxs_users = [int(idx) for idx in np.random.permutation(trainer.cfg.DATASET.USERS)]
+    local_weights = dict(train_clients(trainer, None, idxs_users, [global_weights] * len(idxs_users), epoch))
+    return {k: sum(w[k] for w in local_weights.values()) / len(local_weights) for k in global_weights}
+
+
+def save(trainer, global_weights, epoch, directory):
+    fed_state = {
+        'epoch': epoch,
+        'weights': to_device({'global_weights': global_weights}, 'cpu'),
+        'trainer': get_trainer_state(trainer),
+        'rng': get_rng_states(),
+    }
+    save_federated_state(fed_state, directory)
+
+
+def test_resume_continues_like_an_uninterrupted_run(tmp_path):
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    trainer = ToyTrainer()
+    global_weights = trainer.get_trainable_state()
+    for epoch in range(4):
+        global_weights = run_round(trainer, global_weights, epoch)
+        if epoch == 1:
+            save(trainer, global_weights, epoch, str(tmp_path))
+    expected_rng = get_rng_states()
+
+    # a new process: different global rng states, fresh trainer
+    random.seed(1)
+    np.random.seed(1)
+    torch.manual_seed(1)
+    resumed = ToyTrainer()
+    fed_state = load_federated_state(str(tmp_path))
+    global_weights = fed_state['weights']['global_weights']
+    set_trainer_state(resumed, fed_state['trainer'])
+    set_rng_states(fed_state['rng'])
+    for epoch in range(fed_state['epoch'] + 1, 4):
+        global_weights = run_round(resumed, global_weights, epoch)
+
+    for k, v in trainer.get_trainable_state().items():
+        torch.testing.assert_close(resumed.get_trainable_state()[k], v)
+    assert resumed._optims['model'].param_groups[0]['lr'] == trainer._optims['model'].param_groups[0]['lr']
+    for state, expected in zip(resumed._optims['model'].state.values(), trainer._optims['model'].state.values()):
+        torch.testing.assert_close(state['momentum_buffer'], expected['momentum_buffer'])
+    rng = get_rng_states()
+    assert rng['python'] == expected_rng['python']
+    torch.testing.assert_close(rng['numpy'][1], expected_rng['numpy'][1])
+    assert rng['numpy'][2:] == expected_rng['numpy'][2:]
+    torch.testing.assert_close(rng['torch'], expected_rng['torch'])
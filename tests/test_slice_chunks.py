@@ -0,0 +1,97 @@
+import types
+
+import pytest
+import torch
+import torch.nn as nn
+
+import Dassl.dassl.engine  # noqa: F401, resolves the trainer registry import cycle
+import trainers.GLP_OT
+import trainers.GLP_OT_SVLoRA
+from clip.model import ModifiedVisionTransformer
+
+B, DIM_PER_SLICE, NUM_SLICES, N, N_CLS = 2, 2, 4, 2, 3
+
+
+def make_model(module, lora):
+    """CustomCLIP around a small ViT, without the prompt learner and text encoder."""
+    torch.manual_seed(0)
+    model = module.CustomCLIP.__new__(module.CustomCLIP)
+    nn.Module.__init__(model)
+    # the 3d preprocessing of the GLP_OT trainer runs for HarvardOph
+    dataset = 'FairFedMed' if lora else 'HarvardOph'
+    model.cfg = types.SimpleNamespace(DATASET=types.SimpleNamespace(NAME=dataset))
+    model.image_encoder = ModifiedVisionTransformer(16, 8, 64, 1, 1, 32, design_details={'trainer': 'GLP_OT'})
+    if lora:
+        module.apply_lora_to_model(model, True, rank=4, alpha=0.4, lora_type='FairLoRA', num_attrs=3)
+        for name, param in model.image_encoder.named_parameters():
+            param.requires_grad = 'lora_' in name
+            if 'lora_A' in name:
+                nn.init.normal_(param, std=0.1)
+        model.lora_merged = False
+    model.is_3d_input = True
+    model.dim_per_3d_slice = DIM_PER_SLICE
+    model.proj_per_3d_slice = nn.Conv2d(DIM_PER_SLICE, 3, 5, padding=2)
+    model.register_buffer('pixel_scale', torch.ones(1, 3, 1, 1), persistent=False)
+    model.register_buffer('pixel_shift', torch.zeros(1, 3, 1, 1), persistent=False)
+    model.dtype = torch.float32
+    model.prec = 'fp32'
+    model.N, model.n_cls = N, N_CLS
+    model.OT, model.eps, model.thresh, model.max_iter, model.check_every = 'Sinkhorn', 0.1, 1e-9, 2000, 1
+    model.log_domain, model.warm_start, model.ot_duals = False, True, None
+    model.token_reduction, model.num_tokens, model.top_percent = 'none', 0, 1.0
+    return model
+
+
+def similarity(model, image, attr, text_features, slice_chunk):
+    model.ot_duals = None
+    model.slice_chunk = slice_chunk
+    args = (image, attr) if attr is not None else (image,)
+    if slice_chunk:
+        return model.forward_slice_chunks(*args, text_features)
+    image_features = model.encode_image(*args)
+    return model.ot_similarity(image_features, text_features).view(B, -1, N_CLS).mean(1)
+
+
+@pytest.mark.parametrize('module', [trainers.GLP_OT, trainers.GLP_OT_SVLoRA])
+def test_chunks_match_the_whole_volume(module):
+    lora = module is trainers.GLP_OT_SVLoRA
+    model = make_model(module, lora)
+    torch.manual_seed(1)
+    image = torch.rand(B, DIM_PER_SLICE * NUM_SLICES, 16, 16) * 255
+    attr = torch.tensor([0, 2]) if lora else None
+    text_features = torch.randn(N * N_CLS, 32, requires_grad=True)
+
+    results = []
+    for slice_chunk in [0, 1]:
+        model.zero_grad()
+        text_features.grad = None
+        sim_op = similarity(model, image, attr, text_features, slice_chunk)
+        sim_op.pow(2).sum().backward()
+        grads = {n: p.grad.clone() for n, p in model.named_parameters() if p.grad is not None}
+        results.append((sim_op.detach(), text_features.grad.clone(), grads))
+
+    (sim_whole, text_grad_whole, grads_whole), (sim_chunks, text_grad_chunks, grads_chunks) = results
+    torch.testing.assert_close(sim_chunks, sim_whole, atol=1e-5, rtol=1e-4)
+    torch.testing.assert_close(text_grad_chunks, text_grad_whole, atol=1e-5, rtol=1e-4)
+    assert grads_whole and grads_whole.keys() == grads_chunks.keys()
+    for name in grads_whole:
+        torch.testing.assert_close(grads_chunks[name], grads_whole[name], atol=1e-5, rtol=1e-4, msg=name)
+
+
+@pytest.mark.parametrize('module', [trainers.GLP_OT, trainers.GLP_OT_SVLoRA])
+def test_divergence_returns_none(module, monkeypatch):
+    lora = module is trainers.GLP_OT_SVLoRA
+    model = make_model(module, lora)
+    image = torch.rand(B, DIM_PER_SLICE * NUM_SLICES, 16, 16) * 255
+    attr = torch.tensor([0, 2]) if lora else None
+    text_features = torch.randn(N * N_CLS, 32)
+    calls = []
+
+    def diverge(image_features, text_features):
+        calls.append(1)
+        return None
+
+    monkeypatch.setattr(model, 'ot_similarity', diverge)
+    assert similarity(model, image, attr, text_features, 1) is None
+    # the remaining chunks are not encoded
+    assert len(calls) == 1
@@ -0,0 +1,82 @@
+import torch
+import torch.nn as nn
+
+from utils.text_cache import TextFeatureCache
+
+
+class PromptLearner(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.ctx = nn.Parameter(torch.randn(4, 8))
+        self.register_buffer('token_prefix', torch.randn(2, 8))
+
+    def forward(self):
+        return self.ctx.sum(0) + self.token_prefix
+
+
+def make_cache():
+    torch.manual_seed(0)
+    prompt_learner = PromptLearner()
+    text_encoder = nn.Linear(8, 8)
+    calls = []
+
+    def encode_prompts():
+        calls.append(1)
+        return text_encoder(prompt_learner())
+
+    return prompt_learner, text_encoder, TextFeatureCache(prompt_learner, text_encoder), encode_prompts, calls
+
+
+def test_features_are_reused_until_a_tensor_changes():
+    prompt_learner, text_encoder, cache, encode_prompts, calls = make_cache()
+    with torch.no_grad():
+        features = cache(encode_prompts)
+        assert cache(encode_prompts) is features
+        assert len(calls) == 1
+
+        # optimizer steps and set_trainable_state() write in place, bumping _version
+        prompt_learner.ctx.add_(1.)
+        updated = cache(encode_prompts)
+        assert len(calls) == 2
+        torch.testing.assert_close(updated, text_encoder(prompt_learner()))
+
+        text_encoder.weight.copy_(torch.eye(8))
+        cache(encode_prompts)
+        assert len(calls) == 3
+
+        prompt_learner.token_prefix.mul_(2.)
+        cache(encode_prompts)
+        assert len(calls) == 4
+
+    prompt_learner.load_state_dict(PromptLearner().state_dict())
+    with torch.no_grad():
+        torch.testing.assert_close(cache(encode_prompts), text_encoder(prompt_learner()))
+    assert len(calls) == 5
+
+
+def test_replaced_parameter_invalidates():
+    prompt_learner, _, cache, encode_prompts, calls = make_cache()
+    with torch.no_grad():
+        cache(encode_prompts)
+        # same _version, new storage
+        prompt_learner.ctx = nn.Parameter(torch.zeros(4, 8))
+        cache(encode_prompts)
+    assert len(calls) == 2
+
+
+def test_data_writes_need_invalidate():
+    prompt_learner, _, cache, encode_prompts, calls = make_cache()
+    with torch.no_grad():
+        stale = cache(encode_prompts)
+        prompt_learner.ctx.data = prompt_learner.ctx.data + 1.
+        cache.invalidate()
+        assert not torch.equal(cache(encode_prompts), stale)
+    assert len(calls) == 2
+
+
+def test_trained_prompts_are_always_recomputed():
+    _, _, cache, encode_prompts, calls = make_cache()
+    features = cache(encode_prompts)
+    assert features.requires_grad
+    cache(encode_prompts)
+    assert len(calls) == 2
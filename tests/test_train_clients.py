@@ -0,0 +1,53 @@
+import torch
+from yacs.config import CfgNode as CN
+
+from federated_main import train_clients
+
+
+class ToyTrainer:
+    """The parts of a trainer that train_clients() touches."""
+
+    def __init__(self):
+        self.cfg = CN()
+        self.cfg.SEED = 1
+        self.cfg.DATASET = CN()
+        self.cfg.DATASET.USERS = 4
+        self.model = torch.nn.Linear(3, 1)
+        optim = torch.optim.SGD(self.model.parameters(), lr=0.1, momentum=0.9)
+        self._optims = {'model': optim}
+        self._scheds = {'model': torch.optim.lr_scheduler.StepLR(optim, 1, gamma=0.5)}
+
+    def get_model_names(self):
+        return ['model']
+
+    def get_trainable_state(self):
+        return {k: v.detach().clone() for k, v in self.model.state_dict().items()}
+
+    def set_trainable_state(self, weights):
+        self.model.load_state_dict(weights)
+
+    def train(self, idx, global_epoch, is_fed):
+        x = torch.randn(8, 3)
+        self._optims['model'].zero_grad()
+        self.model(x).pow(2).mean().backward()
+        self._optims['model'].step()
+        self._scheds['model'].step()
+
+
+def test_sequential_clients_train_like_a_plain_loop():
+    trainer = ToyTrainer()
+    init = trainer.get_trainable_state()
+    torch.manual_seed(0)
+    trained = dict(train_clients(trainer, None, [0, 1, 2], [init] * 3, epoch=2))
+
+    baseline = ToyTrainer()
+    torch.manual_seed(0)
+    for idx in [0, 1, 2]:
+        baseline.set_trainable_state(init)
+        baseline.train(idx=idx, global_epoch=2, is_fed=True)
+        for k, v in baseline.get_trainable_state().items():
+            torch.testing.assert_close(trained[idx][k], v)
+    # the optimizer and scheduler state carry over from client to client
+    assert trainer._optims['model'].param_groups[0]['lr'] == 0.1 * 0.5 ** 3
+    for state, expected in zip(trainer._optims['model'].state.values(), baseline._optims['model'].state.values()):
+        torch.testing.assert_close(state['momentum_buffer'], expected['momentum_buffer'])
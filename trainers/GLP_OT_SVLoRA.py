@@ -4,7 +4,6 @@ import copy, math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from torch.cuda.amp import GradScaler, autocast
 
 # from Dassl.dassl.engine import TRAINER_REGISTRY, TrainerX
 from Dassl.dassl.engine.trainer import TrainerX, create_ddp_model
@@ -13,8 +12,15 @@ from Dassl.dassl.utils import load_pretrained_weights, load_checkpoint
 from Dassl.dassl.optim import build_optimizer, build_lr_scheduler
 
 from evaluation.metrics import compute_auc
+from utils.ot_utils import sinkhorn, sinkhorn_log, entropic_cot, entropic_cot_log
+from utils.text_cache import TextFeatureCache
+from utils.feature_cache import cache_client_features
+from utils.profiler import profiler
+from utils.precision import PRECISIONS, encoder_autocast, grad_scaler, cast_frozen_weights
+from utils.token_reduction import TOKEN_REDUCTIONS, reduce_tokens
 
 from clip import clip
+from clip.model import set_input_resolution, set_grad_checkpoint, checkpoint_module
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 _tokenizer = _Tokenizer()
@@ -213,6 +219,8 @@ class LoRALinear(nn.Module):
 
         self.lora_A = nn.Embedding(original_linear.in_features, rank)
         self.lora_B = nn.Embedding(rank, original_linear.out_features)
+        # inference only: low-rank branch folded into the frozen weight, see merge()
+        self.merged_weight = None
 
         device = self.original_linear.weight.device
         dtype = self.original_linear.weight.dtype
@@ -239,8 +247,17 @@ class LoRALinear(nn.Module):
         return self.original_linear.bias
 
     def forward(self, x, attr=None):
+        if self.merged_weight is not None:
+            return F.linear(x, self.merged_weight, self.original_linear.bias)
         return self.original_linear(x) + ((x @ self.lora_A.weight) @ self.lora_B.weight) * self.scaling
 
+    @torch.no_grad()
+    def merge(self):
+        self.merged_weight = self.weight(None)
+
+    def unmerge(self):
+        self.merged_weight = None
+
     def save_lora_weights(self):
         return {
             'lora_A': self.lora_A.weight.data.clone(),
@@ -272,6 +289,8 @@ class SVLoRALinear(nn.Module):
         if self.global_s:
             self.lora_S_global = nn.Embedding(rank, 1)
         self.lora_B = nn.Embedding(rank, original_linear.out_features)
+        # inference only: low-rank branch folded into the frozen weight, see merge()
+        self.merged_weight = None
 
         device = self.original_linear.weight.device
         dtype = self.original_linear.weight.dtype
@@ -306,10 +325,24 @@ class SVLoRALinear(nn.Module):
         nn.init.normal_(self.lora_B.weight)  
     
     def forward(self, x, attr=None):
+        if self.merged_weight is not None:
+            return F.linear(x, self.merged_weight, self.original_linear.bias)
         if self.global_s:
             return self.original_linear(x) + (((x @ self.lora_A.weight) @ torch.diag(self.lora_S.weight + self.lora_S_global.weight)) @ self.lora_B.weight) * self.scaling
         else:
             return self.original_linear(x) + (((x @ self.lora_A.weight) @ torch.diag(self.lora_S.weight)) @ self.lora_B.weight) * self.scaling
+
+    @torch.no_grad()
+    def merge(self):
+        lora_S = self.lora_S.weight
+        if self.global_s:
+            lora_S = lora_S + self.lora_S_global.weight
+        # c_out x c_in
+        dw = ((self.lora_A.weight @ torch.diag(lora_S)) @ self.lora_B.weight).t()
+        self.merged_weight = self.original_linear.weight + self.scaling * dw
+
+    def unmerge(self):
+        self.merged_weight = None
         
     def save_lora_weights(self):
         w = {
@@ -330,6 +363,25 @@ class SVLoRALinear(nn.Module):
             self.lora_S_global.data.copy_(lora_weights['lora_S_global'])
 
 
+class AttrGroups:
+    """
+    The samples of a batch sorted by attribute value, built once per batch
+    for the merged FairLoRA layers, so that they share one permutation
+    instead of grouping the batch in every layer. attr is expected on the
+    host, as parse_batch_test() leaves it.
+    """
+
+    def __init__(self, attr, num_slices, device):
+        # oct b-scan data will be splited into multiple slices
+        attr = attr.cpu().repeat_interleave(num_slices)
+        values, order = attr.sort()
+        groups, counts = torch.unique_consecutive(values, return_counts=True)
+        self.groups = groups.tolist()
+        self.counts = counts.tolist()
+        self.order = order.to(device)
+        self.inverse = order.argsort().to(device)
+
+
 class FairLoRALinear(nn.Module):
     def __init__(
         self, 
@@ -338,6 +390,7 @@ class FairLoRALinear(nn.Module):
         alpha=0.4,
         global_s=False,
         num_attrs=-1,
+        fused=True,
     ):
         super(FairLoRALinear, self).__init__()
         self.original_linear = original_linear
@@ -347,6 +400,9 @@ class FairLoRALinear(nn.Module):
         self.global_s = global_s
         assert num_attrs > 0, 'Number of attributes must be provided!'
         self.num_attrs = num_attrs
+        # fused: scale the rank-r activations by S[attr]; otherwise use the
+        # reference per-sample diag(S) path (kept for parity checks)
+        self.fused = fused
 
         if original_linear.weight.dim() == 2:
             self.is_1x1_conv = False
@@ -361,6 +417,8 @@ class FairLoRALinear(nn.Module):
         if self.global_s:
             self.lora_S_global = nn.Embedding(1, rank)
         self.lora_B = nn.Embedding(rank, out_features)
+        # inference only: num_attrs x c_out x c_in, one folded weight per group, see merge()
+        self.merged_weight = None
 
         device = self.original_linear.weight.device
         dtype = self.original_linear.weight.dtype
@@ -423,29 +481,82 @@ class FairLoRALinear(nn.Module):
             ).to(self.lora_S_global.weight.dtype)
         nn.init.normal_(self.lora_B.weight)  
     
-    def weight(self, x, attr):
-        with torch.no_grad():
-            attr_one_hot = F.one_hot(
-                attr, num_classes=self.num_attrs
-            ).to(x.device).to(x.dtype)  # bs x num_attrs
-        lora_S = attr_one_hot @ self.lora_S.weight            # bs x r
-        lora_S = torch.stack([torch.diag(s) for s in lora_S]) # bs x r x r
-        if self.global_s:
-            lora_S = lora_S + torch.diag(self.lora_S_global.weight)
-        # oct b-scan data will be splited into multiple slices
-        num_slices = x.shape[1] // lora_S.shape[0]
-        lora_S = lora_S[:,None].repeat(1,num_slices,1,1).flatten(0,1)
-
-        # b x c_in x c_out
-        dw = torch.einsum('cr, brr->bcr', self.lora_A.weight, lora_S) @ self.lora_B.weight
-        # b x c_out x c_in
-        dw = self.scaling * dw.permute(0,2,1)
-        return self.original_linear.weight[None].repeat(dw.shape[0],1,1) + dw
-    
     def bias(self):
         return self.original_linear.bias
         
+    def global_S(self):
+        # r, shared singular values; reset_parameters() stores them 1-D, the
+        # nn.Embedding(1, rank) they are created as is 1 x r
+        return self.lora_S_global.weight.reshape(-1)
+
+    def selected_S(self, attr, device):
+        # bs x r, singular values of each sample's group
+        lora_S = self.lora_S(attr.to(device))
+        if self.global_s:
+            lora_S = lora_S + self.global_S()
+        return lora_S * self.scaling
+
     def forward(self, x, attr):
+        if self.merged_weight is not None:
+            return self.forward_merged(x, attr)
+        if not self.fused:
+            return self.forward_diag(x, attr)
+
+        y = self.original_linear(x)
+        lora_S = self.selected_S(attr, x.device)
+        bs, r = lora_S.shape
+        if self.is_1x1_conv:
+            # (b*slices) x r x h x w
+            dy = F.conv2d(x, self.lora_A.weight.t()[:, :, None, None])
+            # oct b-scan data will be splited into multiple slices
+            dy = dy.view(bs, -1, r, *dy.shape[2:]) * lora_S[:, None, :, None, None]
+            dy = F.conv2d(dy.flatten(0, 1), self.lora_B.weight.t()[:, :, None, None])
+        else:
+            # n x (b*slices) x r
+            dy = x @ self.lora_A.weight
+            n = dy.shape[0]
+            dy = (dy.view(n, bs, -1, r) * lora_S[None, :, None, :]).view(n, -1, r)
+            dy = dy @ self.lora_B.weight
+
+        return y + dy
+
+    @torch.no_grad()
+    def merge(self):
+        lora_S = self.lora_S.weight                          # num_attrs x r
+        if self.global_s:
+            lora_S = lora_S + self.global_S()
+        # num_attrs x c_in x c_out
+        dw = (self.lora_A.weight[None] * lora_S[:, None, :]) @ self.lora_B.weight
+        weight = self.original_linear.weight
+        weight = weight.view(weight.shape[0], -1)
+        self.merged_weight = weight[None] + self.scaling * dw.permute(0,2,1)
+
+    def unmerge(self):
+        self.merged_weight = None
+
+    def forward_merged(self, x, attr):
+        bias = self.original_linear.bias
+        # samples are laid out along dim 0 for 1x1 convs and dim 1 for (n, b, c) tokens
+        dim = 0 if self.is_1x1_conv else 1
+        if not isinstance(attr, AttrGroups):
+            attr = AttrGroups(attr, x.shape[dim] // attr.shape[0], x.device)
+
+        if len(attr.groups) == 1:
+            x_groups = [x]
+        else:
+            x_groups = x.index_select(dim, attr.order).split(attr.counts, dim)
+        outs = []
+        for g, x_g in zip(attr.groups, x_groups):
+            if self.is_1x1_conv:
+                outs.append(F.conv2d(x_g, self.merged_weight[g][:, :, None, None], bias))
+            else:
+                outs.append(F.linear(x_g, self.merged_weight[g], bias))
+        if len(outs) == 1:
+            return outs[0]
+        # restore the original sample order
+        return torch.cat(outs, dim).index_select(dim, attr.inverse)
+
+    def forward_diag(self, x, attr):
         y = self.original_linear(x)
 
         with torch.no_grad():
@@ -455,7 +566,7 @@ class FairLoRALinear(nn.Module):
         lora_S = attr_one_hot @ self.lora_S.weight            # bs x r
         lora_S = torch.stack([torch.diag(s) for s in lora_S]) # bs x r x r
         if self.global_s:
-            lora_S = lora_S + torch.diag(self.lora_S_global.weight)
+            lora_S = lora_S + torch.diag(self.global_S())
         if self.is_1x1_conv:
             b, c_in, h, w = x.shape
             x = x.reshape(b, c_in, h*w).permute(2,0,1)
@@ -562,12 +673,33 @@ def apply_lora_to_model(
                         parent_module = getattr(parent_module, part)
                     setattr(parent_module, name.split('.')[-1], lora_layer)
 
+def merge_lora_weights(model):
+    """Fold the low-rank branch of every LoRA layer into a cached weight
+    so that inference runs at the cost of the plain frozen layers."""
+    for module in model.modules():
+        if isinstance(module, (LoRALinear, SVLoRALinear, FairLoRALinear)):
+            module.merge()
+        elif isinstance(module, CustomCLIP):
+            module.lora_merged = True
+
+
+def unmerge_lora_weights(model):
+    for module in model.modules():
+        if isinstance(module, (LoRALinear, SVLoRALinear, FairLoRALinear)):
+            module.unmerge()
+        elif isinstance(module, CustomCLIP):
+            module.lora_merged = False
+
+
 class CustomCLIP(nn.Module):
     def __init__(self, cfg, classnames, clip_model):
         super().__init__()
         self.cfg = cfg
         self.pixel_mean = torch.tensor(self.cfg.INPUT.PIXEL_MEAN)
         self.pixel_std = torch.tensor(self.cfg.INPUT.PIXEL_STD)
+        # (x - mean) / std as a single x * pixel_scale + pixel_shift, kept on the model device
+        self.register_buffer('pixel_scale', (1. / self.pixel_std).reshape(1,-1,1,1), persistent=False)
+        self.register_buffer('pixel_shift', (-self.pixel_mean / self.pixel_std).reshape(1,-1,1,1), persistent=False)
 
         self.n_cls = len(classnames)
         # Check if the dataset modality involves 3D input
@@ -588,8 +720,16 @@ class CustomCLIP(nn.Module):
         self.tokenized_prompts = self.prompt_learner.tokenized_prompts
         self.image_encoder = clip_model.visual
         self.text_encoder = TextEncoder(clip_model)
+        # text features only change with the prompt/text-encoder weights
+        self.text_cache = TextFeatureCache(self.prompt_learner, self.text_encoder)
+        # set when the client loaders yield cached image features instead of images
+        self.cached_features = False
+        # set by merge_lora_weights(), attributes then reach the encoder as AttrGroups
+        self.lora_merged = False
         self.logit_scale = clip_model.logit_scale
         self.dtype = clip_model.dtype
+        # the encoders run under autocast for amp/bf16, OT and the logits in self.dtype
+        self.prec = cfg.TRAINER.GLP_OT.PREC
         self.device = torch.device("cuda:0")
         self.device1 = torch.device("cuda")
         self.N = cfg.TRAINER.GLP_OT.N
@@ -601,74 +741,57 @@ class CustomCLIP(nn.Module):
         self.OT = cfg.TRAINER.GLP_OT.OT
         self.top_percent = cfg.TRAINER.GLP_OT.TOP_PERCENT
         self.max_iter = cfg.TRAINER.GLP_OT.MAX_ITER
+        self.check_every = cfg.TRAINER.GLP_OT.CHECK_EVERY
+        self.log_domain = cfg.TRAINER.GLP_OT.LOG_DOMAIN
+        self.warm_start = cfg.TRAINER.GLP_OT.WARM_START
+        # target scalings of the last OT solve, reused when warm_start is on
+        self.ot_duals = None
+        # pseudo images (dim_per_3d_slice B-scans each) per checkpointed chunk of a 3d volume, 0: all at once
+        self.slice_chunk = cfg.TRAINER.GLP_OT.SLICE_CHUNK
+        # patch tokens are reduced to num_tokens before OT, see utils.token_reduction
+        self.token_reduction = cfg.TRAINER.GLP_OT.TOKEN_REDUCTION
+        self.num_tokens = cfg.TRAINER.GLP_OT.NUM_TOKENS
+
+    def solve_ot(self, wdist, xx, yy):
+        init = None
+        if self.warm_start and self.ot_duals is not None and self.ot_duals.shape == yy.shape:
+            init = self.ot_duals
+
+        kwargs = dict(max_iter=self.max_iter, thresh=self.thresh, check_every=self.check_every, init=init)
+        if self.OT == 'Sinkhorn':
+            if self.log_domain:
+                T, duals = sinkhorn_log(wdist, xx, yy, self.eps, **kwargs)
+            else:
+                T, duals = sinkhorn(torch.exp(-wdist / self.eps), xx, yy, **kwargs)
+        elif self.OT == 'COT':
+            if self.log_domain:
+                T, duals = entropic_cot_log(xx, yy, wdist, self.eps, **kwargs)
+            else:
+                T, duals = entropic_cot(xx, yy, torch.exp(-wdist / self.eps), **kwargs)
+        else:
+            raise NotImplementedError
 
-    def Sinkhorn(self, K, u, v):
-        '''
-        K is the Wasserstein distance, [bs*n_cls, 196, 77]
-        u is , [bs*n_cls, 196]
-        v is , [bs*n_cls, 77]
-        '''
-        r = torch.ones_like(u)
-        c = torch.ones_like(v)
-        thresh = self.thresh
-        for i in range(self.max_iter):
-            r0 = r
-            r = u / torch.matmul(K, c.unsqueeze(-1)).squeeze(-1)
-            c = v / torch.matmul(K.permute(0, 2, 1).contiguous(), r.unsqueeze(-1)).squeeze(-1)
-            err = (r - r0).abs().mean()
-            if err.item() < thresh:
-                break
-
-        T = torch.matmul(r.unsqueeze(-1), c.unsqueeze(-2)) * K
-
+        self.ot_duals = duals[1]
         return T
-    
-    def entropic_COT_fast(self, a, b, M, reg, numItermax=1000, stopThr=1e-9, verbose=False, log=False):
-        """
-        modify from ot.partial.entropic_partial_wasserstein in torch version
-        a is the source prob, [bs*n_cls, 196]
-        b is the target prob, [bs*n_cls, 77]
-        M is the cost matrix, i.e. Wasserstein distance, [bs*n_cls, 196, 77]
 
-        """
-        dx = torch.ones_like(a)
-        dy = torch.ones_like(b)
-
-        log_e = {'err': []}
-        stopThr=self.thresh 
-
-        # K = torch.exp(M / (-reg))
-        K = M
-
-        Kp = torch.matmul(torch.diag_embed(1 / a, dim1=1), K)
-        Kq = torch.matmul(torch.diag_embed(1 / b, dim1=1), K.permute(0, 2, 1))
-
-        err, cpt = 1, 0
-        u = dx
-        v = dy
-        while (cpt < numItermax):
-
-            v0 = v
-            temp = torch.div(dx, torch.matmul(Kp, v.unsqueeze(-1)).squeeze(-1))
-            u = torch.minimum(temp, dx)
-            v = torch.div(dy, torch.matmul(Kq, u.unsqueeze(-1)).squeeze(-1))
-
-            cpt = cpt + 1
-            err = (v - v0).abs().mean()
-            if err.item() <  stopThr:
-                break
-        Kprev = torch.matmul(torch.diag_embed(u, dim1=1), K)
-        Kprev = torch.matmul(Kprev, torch.diag_embed(v, dim1=1))
-        if log:
-            return Kprev, log_e
-        else:
-            return Kprev
+    def encode_prompts(self):
+        prompts = self.prompt_learner()   
+        tokenized_prompts = self.tokenized_prompts
+        if self.dataset == "ImageNet":
+            with encoder_autocast(self.prec, self.device1):
+                text_features = self.text_encoder(prompts.to(self.device1), tokenized_prompts.to(self.device1)) 
+            return text_features.type(self.dtype).to(self.device)
+        with encoder_autocast(self.prec, prompts.device):
+            text_features = self.text_encoder(prompts, tokenized_prompts) 
+        return text_features.type(self.dtype)
 
-    def forward(self, image, attr=None):
+    def encode_image(self, image, attr=None):
+        """Image encoder features, batch first: (b * slices for 3d input) x (1 + M) x d."""
         b, c, h, w = image.shape
         if self.cfg.DATASET.NAME == "FairFedMed":
-            image = image / 255.
+            # the loader may deliver uint8, scaling happens here on the device
             if self.is_3d_input:
+                image = image / 255.
                 # split 3d input into multiple slices to process
                 image = image.reshape(-1, self.dim_per_3d_slice, h, w)
                 image = self.proj_per_3d_slice(image.type(self.dtype))
@@ -679,26 +802,86 @@ class CustomCLIP(nn.Module):
                 # Normalize to range [0, 1]
                 image = (image - min_vals) / (max_vals - min_vals + 1e-5)  
 
-            image = image - self.pixel_mean.reshape(1,-1,1,1).to(image.device)
-            image = image / self.pixel_std.reshape(1,-1,1,1).to(image.device)
+                image = torch.addcmul(self.pixel_shift, image.float(), self.pixel_scale)
+            else:
+                # x / 255, - mean, / std fused into one multiply-add
+                image = torch.addcmul(self.pixel_shift, image.float(), self.pixel_scale / 255.)
+
+        if attr is not None and self.lora_merged:
+            # the merged FairLoRA layers share one grouping of the batch
+            attr = AttrGroups(attr, image.shape[0] // b, image.device)
+        with encoder_autocast(self.prec, image.device):
+            image_features = self.image_encoder(image.type(self.dtype), attr=attr)
+        image_features = image_features.type(self.dtype)
+        return image_features.permute(1, 0, 2)
+
+    def forward(self, image, attr=None):
+        b = image.shape[0]
+        with profiler.phase('text_encode'):
+            text_features = self.text_cache(self.encode_prompts)
+
+        if self.slice_chunk and self.is_3d_input and not self.cached_features:
+            sim_op = self.forward_slice_chunks(image, attr, text_features)
+        else:
+            if self.cached_features:
+                # the loader yields encode_image() outputs of the frozen encoder, see utils.feature_cache
+                image_features = image.type(self.dtype)
+            else:
+                with profiler.phase('image_encode'):
+                    image_features = self.encode_image(image, attr)
+            sim_op = self.ot_similarity(image_features, text_features)
+            if sim_op is not None:
+                sim_op = sim_op.view(b, -1, self.n_cls).mean(1)  # average all slices 
+        if sim_op is None:
+            return None
+        
+        logit_scale = self.logit_scale.exp()
+        logits = logit_scale * sim_op   
+        
+        return logits
 
-        image_features = self.image_encoder(image.type(self.dtype), attr=attr)  
+    def forward_slice_chunks(self, image, attr, text_features):
+        """
+        The slice-averaged similarity of forward() for a batch of 3d volumes,
+        encoded slice_chunk pseudo images at a time. Every chunk is
+        checkpointed, so the activations of one chunk are alive at a time
+        whatever the number of B-scans. BatchNorm layers in train mode
+        (RN encoders) normalize with the statistics of a chunk.
+        """
+        b, c = image.shape[:2]
+        step = self.slice_chunk * self.dim_per_3d_slice
+        diverged = []
+
+        def run(chunk, attr, text_features, duals):
+            # the recompute in backward warm-starts OT like the first pass
+            self.ot_duals = duals
+            with profiler.phase('image_encode'):
+                image_features = self.encode_image(chunk, attr)
+            sim_op = self.ot_similarity(image_features, text_features)
+            if sim_op is None:
+                # checkpoint() needs a tensor, the flag makes the forward return None
+                diverged.append(True)
+                return text_features.new_zeros((b, self.n_cls))
+            return sim_op.view(b, -1, self.n_cls).sum(1)
+
+        sim_op = 0
+        for start in range(0, c, step):
+            sim_op = sim_op + checkpoint_module(self, run, image[:, start:start + step], attr, text_features, self.ot_duals)
+            if diverged:
+                return None
+        return sim_op / (c // self.dim_per_3d_slice)  # average all slices
+
+    def ot_similarity(self, image_features, text_features):
+        """OT-weighted similarity of every image to every class, (b * slices) x n_cls; None if OT diverged."""
+        image_features = image_features.permute(1, 0, 2)
         image_feature_pool = image_features[0]
         image_features = image_features[1:]  
+        image_features, mass = reduce_tokens(image_features, image_feature_pool, self.token_reduction, self.num_tokens)
         M = image_features.shape[0]  # 14 * 14
         self.d = image_features.shape[-1]
 
-        prompts = self.prompt_learner()   
-        tokenized_prompts = self.tokenized_prompts
-        if self.dataset == "ImageNet":
-            text_features = self.text_encoder(prompts.to(self.device1), tokenized_prompts.to(self.device1)) 
-            text_features = text_features.to(self.device)
-            text_features =  text_features.contiguous().view(self.N, self.n_cls, self.d)  
-            text_feature_pool = text_features.mean(dim=0)
-        else:
-            text_features = self.text_encoder(prompts, tokenized_prompts) 
-            text_features =  text_features.contiguous().view(self.N, self.n_cls, self.d)  
-            text_feature_pool = text_features.mean(dim=0)
+        text_features =  text_features.contiguous().view(self.N, self.n_cls, self.d)  
+        text_feature_pool = text_features.mean(dim=0)
         
         image_features =  F.normalize(image_features, dim=2) 
         image_feature_pool = F.normalize(image_feature_pool, dim=1)
@@ -710,25 +893,24 @@ class CustomCLIP(nn.Module):
         sim = sim.permute(2,0,1)       # batch_size * n_cls, num_pixels, 2
         wdist = 1.0 - sim
 
-        xx = torch.zeros(sim.shape[0], M, dtype=sim.dtype, device=sim.device).fill_(1. / M)
+        if mass is None:
+            xx = torch.zeros(sim.shape[0], M, dtype=sim.dtype, device=sim.device).fill_(1. / M)
+        else:
+            xx = mass.repeat_interleave(self.n_cls, dim=0).type(sim.dtype)
         if self.OT == 'Sinkhorn':
             yy = torch.zeros(sim.shape[0], self.N, dtype=sim.dtype, device=sim.device).fill_(1. / self.N)
         elif self.OT == 'COT':
-            top_percent = min(torch.sum(xx).item(), self.top_percent)
+            # torch.sum(xx) is the number of OT problems, no need to sync for it
+            top_percent = min(float(sim.shape[0]), self.top_percent)
             yy = torch.zeros(sim.shape[0], self.N, dtype=sim.dtype, device=sim.device).fill_(1. / self.N) * top_percent
         elif self.OT == 'None':
             pass
         else:
             raise NotImplementedError
 
-        with torch.no_grad():
-            KK = torch.exp(-wdist / self.eps)
-            if self.OT == 'Sinkhorn':
-                T = self.Sinkhorn(KK, xx, yy)  # T is the transport plan
-                if torch.isnan(T).any():
-                    return None
-            elif self.OT == 'COT':
-                T = self.entropic_COT_fast(xx, yy, KK,0.01,numItermax=self.max_iter)
+        with torch.no_grad(), profiler.phase('ot_solve'):
+            if self.OT in {'Sinkhorn', 'COT'}:
+                T = self.solve_ot(wdist, xx, yy)  # T is the transport plan
                 if torch.isnan(T).any():
                     return None
             elif self.OT == 'None':
@@ -740,13 +922,7 @@ class CustomCLIP(nn.Module):
             sim_op = torch.mean(T * sim, dim=(1, 2))
         else:
             sim_op = torch.sum(T * sim, dim=(1, 2))
-        sim_op = sim_op.contiguous().view(b, -1, self.n_cls)
-        sim_op = sim_op.mean(1)  # average all slices 
-        
-        logit_scale = self.logit_scale.exp()
-        logits = logit_scale * sim_op   
-        
-        return logits
+        return sim_op.view(-1, self.n_cls)
 
 
 # @TRAINER_REGISTRY.register()
@@ -756,7 +932,8 @@ class GLP_OT_SVLoRA(TrainerX):
     """
 
     def check_cfg(self, cfg):
-        assert cfg.TRAINER.GLP_OT.PREC in ["fp16", "fp32", "amp"]
+        assert cfg.TRAINER.GLP_OT.PREC in PRECISIONS
+        assert cfg.TRAINER.GLP_OT.TOKEN_REDUCTION in TOKEN_REDUCTIONS
     
     def retrieval_attributes(self, attr_name):
         return {
@@ -786,13 +963,17 @@ class GLP_OT_SVLoRA(TrainerX):
 
         print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
         clip_model = load_clip_to_cpu(cfg)
+        set_input_resolution(clip_model.visual, cfg.INPUT.SIZE[0])
         
-        if cfg.TRAINER.GLP_OT.PREC == "fp32" or cfg.TRAINER.GLP_OT.PREC == "amp":
+        if cfg.TRAINER.GLP_OT.PREC in ["fp32", "amp", "bf16"]:
             # CLIP's default precision is fp16
             clip_model.float()   
 
         print("Building custom CLIP")
         self.model = CustomCLIP(cfg, classnames, clip_model)
+        if cfg.TRAINER.GLP_OT.TOKEN_REDUCTION != 'none':
+            # python -m utils.profiler compares the ot_solve time and accuracy of --profile runs
+            print(f"Reducing the patch tokens to {cfg.TRAINER.GLP_OT.NUM_TOKENS} by {cfg.TRAINER.GLP_OT.TOKEN_REDUCTION} before OT")
 
         print("Turning off gradients in both the image and the text encoder")
         for name, param in self.model.named_parameters():
@@ -823,6 +1004,11 @@ class GLP_OT_SVLoRA(TrainerX):
             if "prompt_learner" in name or "proj_per_3d_slice" in name:
                 print(name, 'grad:', param.requires_grad, param.shape)
 
+        if cfg.TRAINER.GLP_OT_LORA.GRAD_CHECKPOINT:
+            checkpointed = set_grad_checkpoint(self.model.image_encoder, cfg.TRAINER.GLP_OT_LORA.GRAD_CHECKPOINT)
+            # python -m utils.profiler compares the peak memory and time of --profile runs
+            print(f"Recomputing the activations of {checkpointed} of the image encoder in backward")
+
         if cfg.DATASET.NAME== "ImageNet":
             self.device =  torch.device("cuda:0")
             # device0 = torch.device("cuda:0")
@@ -832,6 +1018,11 @@ class GLP_OT_SVLoRA(TrainerX):
             self.model.text_encoder=nn.DataParallel(self.model.text_encoder)
         else:
             self.model.to(self.device)
+
+        if cfg.TRAINER.GLP_OT.PREC == "bf16":
+            # only the modules that run under autocast, trainable tensors stay fp32
+            cast_frozen_weights(self.model.image_encoder, torch.bfloat16)
+            cast_frozen_weights(self.model.text_encoder, torch.bfloat16)
         
         params_to_optimize = list(self.model.prompt_learner.parameters()) + \
                 list(self.model.image_encoder.parameters())
@@ -846,7 +1037,10 @@ class GLP_OT_SVLoRA(TrainerX):
             # Register the image encoder
             self.register_model("image_encoder", self.model.image_encoder, self.optim, self.sched)
 
-        self.scaler = GradScaler() if cfg.TRAINER.GLP_OT.PREC == "amp" else None
+        # loss scaling only for fp16 autocast on cuda
+        self.scaler = grad_scaler(cfg.TRAINER.GLP_OT.PREC, self.device)
+
+        cache_client_features(self)
 
         # Note that multi-gpu training could be slow because CLIP's size is
         # big, which slows down the copy operation in DataParallel
@@ -863,18 +1057,16 @@ class GLP_OT_SVLoRA(TrainerX):
             image, label = self.parse_batch_train(batch)
             attr = None
 
-        prec = self.cfg.TRAINER.GLP_OT.PREC
-        if prec == "amp":
-            with autocast():
-                output = self.model(image)
-                loss = F.cross_entropy(output, label)
+        output = self.model(image, attr)
+        loss = F.cross_entropy(output, label)
+        if self.scaler is not None:
             self.optim.zero_grad()
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optim)
-            self.scaler.update()
+            with profiler.phase('backward'):
+                self.scaler.scale(loss).backward()
+            with profiler.phase('optimizer_step'):
+                self.scaler.step(self.optim)
+                self.scaler.update()
         else:
-            output = self.model(image, attr)
-            loss = F.cross_entropy(output, label)
             # if attr is None:
             #     loss = F.cross_entropy(output, label)
             # else:
@@ -914,11 +1106,20 @@ class GLP_OT_SVLoRA(TrainerX):
         
         return loss_summary
 
+    def test(self, *args, **kwargs):
+        # the LoRA weights are fixed during evaluation, fold them into the
+        # frozen layers once instead of recomputing the branch for every batch
+        merge_lora_weights(self.model)
+        try:
+            return super().test(*args, **kwargs)
+        finally:
+            unmerge_lora_weights(self.model)
+
     def parse_batch_train(self, batch):
         input = batch["img"]
         label = batch["label"]
-        input = input.to(self.device)
-        label = label.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
 
         if self.cfg.DATASET.NAME == "FairFedMed":
             # input = input / 255.
@@ -935,8 +1136,8 @@ class GLP_OT_SVLoRA(TrainerX):
     def parse_batch_test(self, batch):
         input = batch["img"]
         label = batch["label"]
-        input = input.to(self.device)
-        label = label.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
 
         if self.cfg.DATASET.NAME == "FairFedMed":
             # input = input / 255.
@@ -13,7 +13,9 @@ from Dassl.dassl.utils import load_pretrained_weights, load_checkpoint
 from Dassl.dassl.optim import build_optimizer, build_lr_scheduler
 
 from clip import clip
+from clip.model import set_input_resolution
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
+from utils.text_cache import TextFeatureCache
 
 from Dassl.dassl.data import DataManager
 from Dassl.dassl.optim import build_optimizer, build_lr_scheduler
@@ -197,6 +199,8 @@ class CustomCLIP(nn.Module):
         self.tokenized_prompts = self.prompt_learner.tokenized_prompts
         self.image_encoder = clip_model.visual
         self.text_encoder = TextEncoder(clip_model)
+        # the prompts are fixed, encode them once per text-encoder weight version
+        self.text_cache = TextFeatureCache(self.prompt_learner, self.text_encoder)
         self.logit_scale = clip_model.logit_scale
         self.dtype = clip_model.dtype
 
@@ -215,12 +219,15 @@ class CustomCLIP(nn.Module):
 
         return x
     
+    def encode_prompts(self):
+        prompts = self.prompt_learner().cuda()
+        tokenized_prompts = self.tokenized_prompts.cuda()
+        return self.text_encoder(prompts, tokenized_prompts)
+
     def forward(self, image):
         image_features = self.image_encoder(image.type(self.dtype))
 
-        prompts = self.prompt_learner().cuda()
-        tokenized_prompts = self.tokenized_prompts.cuda()
-        text_features = self.text_encoder(prompts, tokenized_prompts)
+        text_features = self.text_cache(self.encode_prompts)
 
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
         text_features = text_features / text_features.norm(dim=-1, keepdim=True)
@@ -244,6 +251,7 @@ class CLIP(TrainerX):
 
         print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
         clip_model = load_clip_to_cpu(cfg)
+        set_input_resolution(clip_model.visual, cfg.INPUT.SIZE[0])
 
         if cfg.TRAINER.PROMPTFL.PREC == "fp32" or cfg.TRAINER.PROMPTFL.PREC == "amp":
             # CLIP's default precision is fp16
@@ -313,8 +321,8 @@ class CLIP(TrainerX):
     def parse_batch_train(self, batch):
         input = batch["img"]
         label = batch["label"]
-        input = input.to(self.device)
-        label = label.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
         return input, label
 
     def load_model(self, directory, epoch=None):
@@ -12,7 +12,10 @@ from Dassl.dassl.metrics import compute_accuracy
 from Dassl.dassl.utils import load_pretrained_weights, load_checkpoint
 from Dassl.dassl.optim import build_optimizer, build_lr_scheduler
 
+from utils.feature_cache import cache_client_features
+
 from clip import clip
+from clip.model import set_input_resolution
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 from Dassl.dassl.data import DataManager
@@ -207,9 +210,18 @@ class CustomCLIP(nn.Module):
         self.text_encoder = TextEncoder(clip_model)
         self.logit_scale = clip_model.logit_scale
         self.dtype = clip_model.dtype
+        # set when the client loaders yield cached image features instead of images
+        self.cached_features = False
+
+    def encode_image(self, image):
+        return self.image_encoder(image.type(self.dtype))
 
     def forward(self, image):
-        image_features = self.image_encoder(image.type(self.dtype))
+        if self.cached_features:
+            # the loader yields encode_image() outputs of the frozen encoder, see utils.feature_cache
+            image_features = image.type(self.dtype)
+        else:
+            image_features = self.encode_image(image)
 
         prompts = self.prompt_learner()
         tokenized_prompts = self.tokenized_prompts
@@ -237,6 +249,7 @@ class PromptFL(TrainerX):
 
         print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
         clip_model = load_clip_to_cpu(cfg)
+        set_input_resolution(clip_model.visual, cfg.INPUT.SIZE[0])
 
         if cfg.TRAINER.PROMPTFL.PREC == "fp32" or cfg.TRAINER.PROMPTFL.PREC == "amp":
             # CLIP's default precision is fp16
@@ -265,6 +278,8 @@ class PromptFL(TrainerX):
 
         self.scaler = GradScaler() if cfg.TRAINER.PROMPTFL.PREC == "amp" else None
 
+        cache_client_features(self)
+
         # Note that multi-gpu training could be slow because CLIP's size is
         # big, which slows down the copy operation in DataParallel
         os.environ["CUDA_VISIBLE_DEVICES"] = "0,3,2,1"
@@ -306,8 +321,8 @@ class PromptFL(TrainerX):
     def parse_batch_train(self, batch):
         input = batch["img"]
         label = batch["label"]
-        input = input.to(self.device)
-        label = label.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
         return input, label
 
     def load_model(self, directory, epoch=None):
@@ -367,8 +382,8 @@ class Baseline(TrainerX):
     def parse_batch_train(self, batch):
         input = batch["img"]
         label = batch["label"]
-        input = input.to(self.device)
-        label = label.to(self.device)
+        input = input.to(self.device, non_blocking=True)
+        label = label.to(self.device, non_blocking=True)
         return input, label
 
 
@@ -0,0 +1,128 @@
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from Dassl.dassl.utils import set_random_seed
+from Dassl.dassl.engine import build_trainer
+
+from utils.fed_utils import trainable_state_keys
+
+
+def to_device(obj, device):
+    if torch.is_tensor(obj):
+        return obj.detach().to(device)
+    if isinstance(obj, dict):
+        return {k: to_device(v, device) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(v, device) for v in obj)
+    return obj
+
+
+def to_cpu(obj):
+    return to_device(obj, 'cpu')
+
+
+def get_trainer_state(trainer):
+    """Optimizer and lr scheduler states of every registered model."""
+    state = {}
+    for name in trainer.get_model_names():
+        optim, sched = trainer._optims[name], trainer._scheds[name]
+        state[name] = {
+            'optim': optim.state_dict() if optim is not None else None,
+            'sched': sched.state_dict() if sched is not None else None,
+        }
+    return to_cpu(state)
+
+
+def set_trainer_state(trainer, state):
+    for name, s in state.items():
+        if s['optim'] is not None:
+            trainer._optims[name].load_state_dict(s['optim'])
+        if s['sched'] is not None:
+            trainer._scheds[name].load_state_dict(s['sched'])
+
+
+def client_seed(cfg, idx, epoch):
+    """Seed of client idx in round epoch, None in an unseeded run."""
+    if cfg.SEED < 0:
+        return None
+    return cfg.SEED + epoch * cfg.DATASET.USERS + int(idx)
+
+
+def client_worker(cfg, tasks, results, num_threads):
+    torch.set_num_threads(num_threads)
+    # same seed as the server so that the frozen weights of the replica match
+    if cfg.SEED >= 0:
+        set_random_seed(cfg.SEED)
+    trainer = build_trainer(cfg)
+    trainer.fed_before_train()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        idx, epoch, weights, trainer_state, seed, train_kwargs = task
+        try:
+            if seed is not None:
+                set_random_seed(seed)
+            trainer.set_trainable_state(weights)
+            set_trainer_state(trainer, trainer_state)
+            trainer.train(idx=idx, global_epoch=epoch, is_fed=True, **to_device(train_kwargs, trainer.device))
+            results.put((idx, to_cpu(trainer.get_trainable_state()), get_trainer_state(trainer), None))
+        except Exception:
+            results.put((idx, None, None, traceback.format_exc()))
+
+
+class ClientPool:
+    """
+    Trains the selected clients of a round on a pool of worker processes,
+    each holding its own trainer replica and dataloaders.
+
+    Every client of a round starts from the server's optimizer/scheduler
+    state and is seeded from (cfg.SEED, round, client), so the results do not
+    depend on the number of workers or on which worker picks a client. After
+    the round the server adopts the trainer state of the last client.
+    """
+
+    def __init__(self, cfg, trainer, num_workers):
+        self.cfg = cfg
+        self.keys = trainable_state_keys(trainer.model)
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        # not daemonic, the replicas may start their own dataloader workers
+        self.workers = [
+            ctx.Process(target=client_worker, args=(cfg, self.tasks, self.results, num_threads))
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def train(self, trainer, tasks, epoch):
+        """
+        tasks: list of (client idx, initial weights, train kwargs).
+        Returns {client idx: trained trainable tensors}.
+        """
+        trainer_state = get_trainer_state(trainer)
+        for idx, weights, train_kwargs in tasks:
+            weights = to_cpu({k: weights[k] for k in self.keys if k in weights})
+            self.tasks.put((idx, epoch, weights, trainer_state, client_seed(self.cfg, idx, epoch), to_cpu(train_kwargs)))
+
+        trained, states = {}, {}
+        for _ in tasks:
+            idx, weights, state, error = self.results.get()
+            if error is not None:
+                self.close()
+                raise RuntimeError(f'Training client {idx} failed:\n{error}')
+            trained[idx], states[idx] = weights, state
+        set_trainer_state(trainer, states[tasks[-1][0]])
+        return trained
+
+    def close(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
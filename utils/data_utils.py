@@ -9,10 +9,12 @@ import pandas as pd
 import torch
 import copy
 import random
+import zipfile
 from PIL import Image
 from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 from collections import Counter
+from functools import lru_cache
 from skimage.transform import resize
 
 
@@ -434,8 +436,155 @@ class OfficeDataset(Dataset):
         return image, label
 
 
+def _npz_summary(data_file):
+    """Read scalar entries and array shapes of an ``.npz`` without decompressing arrays."""
+    summary = {}
+    with zipfile.ZipFile(data_file) as zf:
+        for name in zf.namelist():
+            if not name.endswith('.npy'):
+                continue
+            key = name[:-len('.npy')]
+            with zf.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            if len(shape) == 0 or (len(shape) == 1 and shape[0] == 1):
+                if dtype.kind in 'biuf':
+                    with zf.open(name) as f:
+                        summary[key] = np.lib.format.read_array(f).item()
+            else:
+                summary[f'{key}_shape'] = 'x'.join(str(d) for d in shape)
+    return summary
+
+
+def _index_shape_len(shape):
+    # shapes are stored as '128x200x200', missing modalities as NaN
+    if not isinstance(shape, str) or shape == '':
+        return 0
+    return int(shape.split('x')[0])
+
+
+def load_fairfedmed_index(data_path, filenames, index_path):
+    """Return a DataFrame (indexed by filename) of per-file attributes, labels and modality shapes.
+
+    The index is cached at ``index_path``; rows whose file mtime/size changed, or
+    which are missing, are rebuilt from the ``.npz`` headers and written back.
+    """
+    if os.path.exists(index_path):
+        # as str, so that a 1-D shape such as '200' is not read back as an int
+        columns = pd.read_csv(index_path, nrows=0).columns
+        index = pd.read_csv(
+            index_path, index_col='filename', dtype={c: str for c in columns if c.endswith('_shape')}
+        )
+    else:
+        index = pd.DataFrame(columns=['mtime_ns', 'size'])
+        index.index.name = 'filename'
+
+    stale = {}
+    for x in dict.fromkeys(filenames):
+        stat = os.stat(os.path.join(data_path, x))
+        if x in index.index and index.at[x, 'mtime_ns'] == stat.st_mtime_ns and index.at[x, 'size'] == stat.st_size:
+            continue
+        row = _npz_summary(os.path.join(data_path, x))
+        row['mtime_ns'] = stat.st_mtime_ns
+        row['size'] = stat.st_size
+        stale[x] = row
+
+    if len(stale) > 0:
+        print(f'Indexing {len(stale)} FairFedMed files into {index_path}')
+        new_rows = pd.DataFrame.from_dict(stale, orient='index')
+        new_rows.index.name = 'filename'
+        index = pd.concat([index.drop(index=list(stale), errors='ignore'), new_rows])
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        index.to_csv(tmp_path)
+        os.replace(tmp_path, index_path)
+
+    return index
+
+
+# every OCT_SLICE_STEP-th B-scan is used by default: 128 -> 32 slices (cfg.DATASET.OCT_SLICE_STEP)
+OCT_SLICE_STEP = 4
+
+
+def read_npz_slices(npz, key, step):
+    """Read every ``step``-th entry along the first axis of ``npz[key]``.
+
+    Only the needed slices are read from the zip member, the full volume is
+    never materialized (stored members are seeked, deflated ones streamed).
+    """
+    with npz.zip.open(f'{key}.npy') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order or dtype.hasobject or len(shape) == 0:
+            return npz[key][::step]
+        slice_shape = tuple(shape[1:])
+        slice_bytes = int(np.prod(slice_shape)) * dtype.itemsize
+        start = f.tell()
+        indices = range(0, shape[0], step)
+        out = np.empty((len(indices),) + slice_shape, dtype=dtype)
+        for i, j in enumerate(indices):
+            f.seek(start + j * slice_bytes)
+            out[i] = np.frombuffer(f.read(slice_bytes), dtype=dtype).reshape(slice_shape)
+    return out
+
+
+@lru_cache(maxsize=None)
+def _linear_resize_matrix(in_size, out_size):
+    """(out_size, in_size) matrix of skimage's order-1 ``resize`` along one axis.
+
+    Same half-pixel sampling and 'reflect' border (scipy 'mirror') as
+    ``skimage.transform.resize``, valid without anti-aliasing, i.e. upsampling.
+    """
+    coords = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    if in_size > 1:
+        period = 2 * (in_size - 1)
+        coords = np.abs(coords) % period
+        coords = np.where(coords > in_size - 1, period - coords, coords)
+    else:
+        coords = np.zeros_like(coords)
+    lo = np.floor(coords).astype(np.int64)
+    hi = np.minimum(lo + 1, in_size - 1)
+    frac = coords - lo
+    matrix = np.zeros((out_size, in_size))
+    np.add.at(matrix, (np.arange(out_size), lo), 1 - frac)
+    np.add.at(matrix, (np.arange(out_size), hi), frac)
+    return matrix.astype(np.float32)
+
+
+def to_uint8(x):
+    if x.dtype == np.uint8:
+        return np.ascontiguousarray(x)
+    return np.clip(np.rint(x), 0, 255).astype(np.uint8)
+
+
+def resize_stack(stack, resolution):
+    """Resize a (N, H, W) stack of slices to (N, resolution, resolution) in one call.
+
+    Upsampling is a separable interpolation-matrix product over the whole
+    stack, downsampling a single anti-aliased ``resize`` over the stack (no
+    smoothing or interpolation across slices). Both match resizing the
+    slices one by one.
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    height, width = stack.shape[1:]
+    if resolution < height or resolution < width:
+        return resize(stack, (stack.shape[0], resolution, resolution))
+    rows = _linear_resize_matrix(height, resolution)
+    cols = _linear_resize_matrix(width, resolution)
+    return rows @ stack @ cols.T
+
+
+# number of groups of each protected attribute
+ATTRIBUTE_GROUPS = {'race': 3, 'language': 3, 'ethnicity': 2, 'gender': 2}
+
+
 class FairFedMedDataset(Dataset):
-    def __init__(self, base_path, site, attribute_type, attributes, modality_type=None, resolution=224, depth=3, train=True, transform=None):
+    def __init__(self, base_path, site, attribute_type, attributes, modality_type=None, resolution=224, depth=3, train=True, transform=None, uint8=False, slice_step=OCT_SLICE_STEP):
         self.task = 'cls'
 
         self.base_path = base_path
@@ -454,39 +603,25 @@ class FairFedMedDataset(Dataset):
         assert 'filename' in df.columns, 'filename must be included in the head'
         self.data_files  = df['filename']
 
-        tmp_data_files = []
-        tmp_data_attrs = []
+        # attributes, labels and modality shapes come from a cached index,
+        # so the sample files are not opened here
+        index = load_fairfedmed_index(
+            self.data_path, self.data_files.tolist(), os.path.join(self.base_path, 'meta_index.csv')
+        )
+        rows = index.loc[self.data_files.tolist()]
         if self.attribute_type in {'gender', 'maritalstatus', 'hispanic', 'language', 'ethnicity'}:
-            for x in self.data_files:
-                data_file = os.path.join(self.data_path, x)
-                raw_data = np.load(data_file, allow_pickle=True)
-                attr = raw_data[self.attribute_type].item()
-                if attr > -1:  # -1=unknown
-                    tmp_data_files.append(x)
-                    tmp_data_attrs.append(attr)
-            self.data_files = tmp_data_files
-            self.data_attrs = tmp_data_attrs
-        
-        tmp_data_files = []
-        tmp_data_attrs = []
-        for x in self.data_files:
-            data_file = os.path.join(self.data_path, x)
-            raw_data = np.load(data_file, allow_pickle=True)
-            attr = raw_data[self.attribute_type].item()
-
-            assert self.modality_type is not None
-            if self.modality_type == 'oct_bscans' or self.modality_type == 'oct_bscans_3d':
-                if len(raw_data['oct_bscans']) > 0:
-                    tmp_data_files.append(x)  # 3D: 128 x 200 x 200
-                    tmp_data_attrs.append(attr)
-            elif self.modality_type == 'slo_fundus':
-                if len(raw_data['slo_fundus']) > 0:
-                    tmp_data_files.append(x)  # 2D: 224 x 224
-                    tmp_data_attrs.append(attr)
-            else:
-                raise NotImplementedError
-        self.data_files = tmp_data_files
-        self.data_attrs = tmp_data_attrs
+            rows = rows[rows[self.attribute_type] > -1]  # -1=unknown
+
+        assert self.modality_type is not None
+        if self.modality_type == 'oct_bscans' or self.modality_type == 'oct_bscans_3d':
+            modality_len = rows['oct_bscans_shape'].map(_index_shape_len)  # 3D: 128 x 200 x 200
+        elif self.modality_type == 'slo_fundus':
+            modality_len = rows['slo_fundus_shape'].map(_index_shape_len)  # 2D: 224 x 224
+        else:
+            raise NotImplementedError
+        rows = rows[modality_len > 0]
+        self.data_files = rows.index.tolist()
+        self.data_attrs = rows[self.attribute_type].astype(int).tolist()
 
         # data_attrs_unique = list(set(self.data_attrs))
         # data_attrs_num = {attr: 0 for attr in data_attrs_unique}
@@ -516,10 +651,85 @@ class FairFedMedDataset(Dataset):
         self.depth = depth  # num of input channels
         self.resolution = resolution
         self.transform = transform
+        self.uint8 = uint8  # keep uint8 samples uint8 through collation and transfer
+        self.slice_step = slice_step  # every slice_step-th B-scan of an oct_bscans volume is used
     
     def __len__(self):
         return len(self.data_files)
 
+    def count_by_attribute(self, attribute_type):
+        """Number of samples per group of ``attribute_type``, the weights of the per-group FedAvg."""
+        assert attribute_type == self.attribute_type, 'groups are only indexed for the split attribute'
+        attrs = np.asarray(self.data_attrs, dtype=np.int64)
+        # every client has to report all groups, even those it has no sample of
+        minlength = ATTRIBUTE_GROUPS.get(attribute_type, int(attrs.max()) + 1 if len(attrs) else 0)
+        return np.bincount(attrs, minlength=minlength).tolist()
+
+    def prepare_modality(self, sample):
+        """Convert a raw ``oct_bscans`` / ``slo_fundus`` array into a model input, before ``transform``.
+
+        Deterministic given the dataset options, so :func:`pack_fairfedmed_split`
+        stores its output. ``oct_bscans`` volumes are passed already subsampled
+        to every ``slice_step``-th slice, so the skipped slices are never read.
+        With ``uint8`` set, uint8 samples stay uint8 (rounded after a resize);
+        scaling and normalization are then left to the model.
+        """
+        if self.modality_type == 'oct_bscans':
+            oct_img = sample                  # 32 * 200 * 200 by default, already strided by slice_step
+            keep_uint8 = self.uint8 and oct_img.dtype == np.uint8
+            if oct_img.dtype == np.uint8 and not keep_uint8:
+                oct_img = oct_img.astype(np.float32)  # or np.float64 for double precision
+            if oct_img.shape[1] != self.resolution:
+                oct_img = resize_stack(oct_img, self.resolution)
+            data_sample = to_uint8(oct_img) if keep_uint8 else oct_img.astype(np.float32)
+
+        elif self.modality_type == 'oct_bscans_3d':
+            data_sample = sample
+            data_sample = data_sample[None, :, :, :]
+            if self.uint8 and data_sample.dtype == np.uint8:
+                data_sample = np.ascontiguousarray(data_sample)
+            else:
+                data_sample = data_sample.astype(np.float32)
+
+        elif self.modality_type == 'slo_fundus':
+            slo_fundus = np.transpose(sample)
+            slo_fundus = slo_fundus[None,:,:]
+            keep_uint8 = self.uint8 and slo_fundus.dtype == np.uint8
+            if slo_fundus.dtype == np.uint8 and not keep_uint8:
+                slo_fundus = slo_fundus.astype(np.float32)  # or np.float64 for double precision
+            if slo_fundus.shape[1] != self.resolution:
+                slo_fundus = resize_stack(slo_fundus, self.resolution)
+            slo_fundus = to_uint8(slo_fundus) if keep_uint8 else slo_fundus.astype(np.float32)
+            if self.depth > 1:
+                slo_fundus = np.repeat(slo_fundus, self.depth, axis=0)
+            data_sample = slo_fundus
+
+        else:
+            raise NotImplementedError
+
+        return data_sample
+
+    def transform_modality(self, data_sample):
+        """Apply ``transform`` to the output of :meth:`prepare_modality` (``slo_fundus`` is not transformed)."""
+        if self.transform is None:
+            return data_sample
+        if self.modality_type == 'oct_bscans':
+            return self.transform(data_sample).float()
+        if self.modality_type == 'oct_bscans_3d':
+            return self.transform(data_sample) #.float()
+        return data_sample
+
+    def preprocess_modality(self, sample):
+        return self.transform_modality(self.prepare_modality(sample))
+
+    def read_modality(self, raw_data):
+        """The raw array of ``modality_type`` in a loaded ``.npz``, only the used slices of ``oct_bscans``."""
+        if self.modality_type == 'oct_bscans':
+            return read_npz_slices(raw_data, 'oct_bscans', self.slice_step)
+        if self.modality_type == 'oct_bscans_3d':
+            return raw_data['oct_bscans']
+        return raw_data[self.modality_type]
+
     def __getitem__(self, item):
         data_file = os.path.join(self.data_path, self.data_files[item])
         raw_data = np.load(data_file, allow_pickle=True)
@@ -535,45 +745,8 @@ class FairFedMedDataset(Dataset):
                 rnflt_sample = np.repeat(rnflt_sample, self.depth, axis=0)
             data_sample = rnflt_sample.astype(np.float32)
 
-        elif self.modality_type == 'oct_bscans':
-            oct_img = raw_data['oct_bscans']  # 128 * 200 * 200
-            oct_img = oct_img[::4]            # 32 * 200 * 200
-            if oct_img.dtype == np.uint8:
-                oct_img = oct_img.astype(np.float32)  # or np.float64 for double precision
-            if oct_img.shape[1] != self.resolution:
-                oct_img_array = []
-                for img in oct_img:
-                    tmp_img = resize(img, (self.resolution, self.resolution))
-                    oct_img_array.append(tmp_img[None,:,:])
-                oct_img = np.concatenate(oct_img_array, axis=0)
-            data_sample = oct_img.astype(np.float32)
-            if self.transform is not None:
-                data_sample = self.transform(data_sample).float()
-
-        elif self.modality_type == 'oct_bscans_3d':
-            oct_img = raw_data['oct_bscans']
-            data_sample = oct_img
-            data_sample = data_sample[None, :, :, :]
-            data_sample = data_sample.astype(int)
-            data_sample = data_sample.astype(np.float32)
-            if self.transform is not None:
-                data_sample = self.transform(data_sample) #.float()
-
-        elif self.modality_type == 'slo_fundus':
-            slo_fundus = raw_data['slo_fundus']
-            slo_fundus = np.transpose(slo_fundus)
-            slo_fundus = slo_fundus[None,:,:]
-            if slo_fundus.dtype == np.uint8:
-                slo_fundus = slo_fundus.astype(np.float32)  # or np.float64 for double precision
-            if slo_fundus.shape[1] != self.resolution:
-                img_array = []
-                for img in slo_fundus:
-                    tmp_img = resize(img, (self.resolution, self.resolution))
-                    img_array.append(tmp_img[None,:,:])
-                slo_fundus = np.concatenate(img_array, axis=0)
-            if self.depth > 1:
-                slo_fundus = np.repeat(slo_fundus, self.depth, axis=0)
-            data_sample = slo_fundus.astype(np.float32)      
+        elif self.modality_type in {'oct_bscans', 'oct_bscans_3d', 'slo_fundus'}:
+            data_sample = self.preprocess_modality(self.read_modality(raw_data))
 
         elif self.modality_type == 'ilm':
             ilm_sample = raw_data[self.modality_type]
@@ -626,6 +799,132 @@ class FairFedMedDataset(Dataset):
         return data_sample, label, attrs
         
 
+def packed_fairfedmed_prefix(packed_dir, site, attribute_type, modality_type, train=True, resolution=224, depth=3, uint8=False, slice_step=OCT_SLICE_STEP):
+    # samples are packed preprocessed, so every option of prepare_modality() is part of the name
+    split = 'train' if train else 'test'
+    options = f'res{resolution}_depth{depth}_step{slice_step}_{"uint8" if uint8 else "float32"}'
+    return os.path.join(packed_dir, f'site{str(site)}_{attribute_type}_{split}_{modality_type}_{options}')
+
+
+def pack_fairfedmed_split(base_path, site, attribute_type, attributes, modality_type, train=True, packed_dir=None, resolution=224, depth=3, uint8=False, slice_step=OCT_SLICE_STEP):
+    """Pack one site/split/modality of FairFedMed into a contiguous memmap of preprocessed samples.
+
+    Writes ``<prefix>.npy`` (N x sample shape, the output of
+    :meth:`FairFedMedDataset.prepare_modality`, i.e. sliced and resized) and
+    ``<prefix>_meta.npz`` (filenames, glaucoma labels, target attribute and all
+    ``attributes``). Samples are selected exactly as in :class:`FairFedMedDataset`.
+    The meta file is written last, so its presence marks a complete pack.
+    """
+    if packed_dir is None:
+        packed_dir = os.path.join(base_path, 'packed')
+    os.makedirs(packed_dir, exist_ok=True)
+
+    src = FairFedMedDataset(
+        base_path, site, attribute_type, attributes, modality_type=modality_type,
+        resolution=resolution, depth=depth, train=train, uint8=uint8, slice_step=slice_step,
+    )
+    prefix = packed_fairfedmed_prefix(
+        packed_dir, site, attribute_type, modality_type, train, resolution, depth, uint8, slice_step
+    )
+    num_samples = len(src.data_files)
+    if num_samples == 0:
+        raise ValueError(f'No {modality_type} samples to pack for site{site}')
+
+    labels = np.zeros(num_samples, dtype=np.int64)
+    attrs = np.zeros((num_samples, len(attributes)), dtype=np.int64)
+    samples = None
+    # per process, concurrent packers of the same split never share a tmp file
+    tmp_path = f'{prefix}.{os.getpid()}.tmp.npy'
+    print(f'Packing {num_samples} {modality_type} samples to {prefix}.npy')
+    for i, x in enumerate(src.data_files):
+        raw_data = np.load(os.path.join(src.data_path, x), allow_pickle=True)
+        sample = src.prepare_modality(src.read_modality(raw_data))
+        if samples is None:
+            samples = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=sample.dtype, shape=(num_samples,) + sample.shape
+            )
+        if sample.shape != samples.shape[1:] or sample.dtype != samples.dtype:
+            raise ValueError(
+                f'Inconsistent sample {sample.dtype}{sample.shape} in {x}, expected {samples.dtype}{samples.shape[1:]}'
+            )
+        samples[i] = sample
+        labels[i] = int(raw_data['glaucoma'].item())
+        attrs[i] = [int(raw_data[k]) for k in attributes]
+    samples.flush()
+    del samples
+    os.replace(tmp_path, prefix + '.npy')
+
+    tmp_meta_path = f'{prefix}_meta.{os.getpid()}.tmp.npz'
+    np.savez(
+        tmp_meta_path,
+        filenames=np.array(src.data_files),
+        labels=labels,
+        data_attrs=np.array(src.data_attrs, dtype=np.int64),
+        attrs=attrs,
+        attributes=np.array(attributes),
+    )
+    os.replace(tmp_meta_path, prefix + '_meta.npz')
+
+    return prefix
+
+
+class PackedFairFedMedDataset(FairFedMedDataset):
+    """FairFedMedDataset backed by the memmap of :func:`pack_fairfedmed_split`.
+
+    The pack is built on first use. Samples are stored preprocessed, so
+    ``__getitem__`` returns a memmap slice (only ``transform`` still runs)
+    instead of decompressing, slicing and resizing a whole ``.npz``.
+    """
+
+    def __init__(self, base_path, site, attribute_type, attributes, modality_type=None, resolution=224, depth=3, train=True, transform=None, packed_dir=None, uint8=False, slice_step=OCT_SLICE_STEP):
+        assert modality_type in {'oct_bscans', 'oct_bscans_3d', 'slo_fundus'}, \
+            f'{modality_type} cannot be packed'
+        super().__init__(
+            base_path, site, attribute_type, attributes, modality_type=modality_type, resolution=resolution,
+            depth=depth, train=train, transform=transform, uint8=uint8, slice_step=slice_step,
+        )
+
+        if packed_dir is None:
+            packed_dir = os.path.join(base_path, 'packed')
+        self.prefix = packed_fairfedmed_prefix(
+            packed_dir, site, attribute_type, modality_type, train, resolution, depth, uint8, slice_step
+        )
+        if not os.path.exists(self.prefix + '_meta.npz'):
+            pack_fairfedmed_split(
+                base_path, site, attribute_type, attributes, modality_type, train=train,
+                packed_dir=packed_dir, resolution=resolution, depth=depth, uint8=uint8, slice_step=slice_step,
+            )
+
+        meta = np.load(self.prefix + '_meta.npz')
+        assert meta['attributes'].tolist() == list(attributes), \
+            f'{self.prefix} was packed with attributes {meta["attributes"].tolist()}'
+        assert meta['filenames'].tolist() == list(self.data_files), \
+            f'{self.prefix} was packed from other samples, remove it to repack'
+        self.labels = meta['labels']
+        self.attrs = meta['attrs']
+        # opened lazily so that every dataloader worker maps the file itself
+        self._samples = None
+
+    @property
+    def samples(self):
+        if self._samples is None:
+            # copy-on-write: the slices are writable for torch, the pack is never modified
+            self._samples = np.load(self.prefix + '.npy', mmap_mode='c')
+        return self._samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_samples'] = None
+        return state
+
+    def __getitem__(self, item):
+        data_sample = self.transform_modality(self.samples[item])
+        label = torch.tensor(int(self.labels[item])).long()
+        attrs = torch.tensor(self.attrs[item])
+
+        return data_sample, label, attrs
+
+
 class DomainNetDataset(Dataset):
     def __init__(self, base_path, site, train=True, transform=None):
         self.base_path = base_path
@@ -0,0 +1,170 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from Dassl.dassl.data import build_data_loader
+
+
+def feature_cache_blocker(model):
+    """
+    Why the image features of `model` cannot be cached, None if they can:
+    nothing before the encoder output may train, and BatchNorm layers would
+    normalize with batch statistics in train mode.
+    """
+    modules = [model.image_encoder]
+    if getattr(model, 'is_3d_input', False):
+        modules.append(model.proj_per_3d_slice)
+    for module in modules:
+        if any(p.requires_grad for p in module.parameters()):
+            return 'the image encoder has trainable parameters'
+        if any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in module.modules()):
+            return 'the image encoder has BatchNorm layers'
+    return None
+
+
+def feature_cache_prefix(cfg, idx, split):
+    # everything the encoded features depend on, besides the sample order of the split
+    key = '|'.join(str(v) for v in (
+        cfg.DATASET.NAME, cfg.DATASET.ROOT, cfg.DATASET.MODALITY_TYPE, cfg.DATASET.ATTRIBUTE_TYPE,
+        cfg.DATASET.ATTRIBUTES, cfg.DATASET.OCT_SLICE_STEP, cfg.DATASET.UINT8, cfg.DATASET.USERS,
+        cfg.DATASET.PARTITION, cfg.DATASET.BETA, cfg.DATASET.IID, cfg.DATASET.USEALL, cfg.DATASET.NUM_SHOTS,
+        cfg.SEED, cfg.MODEL.BACKBONE.NAME, cfg.INPUT.SIZE, cfg.INPUT.PIXEL_MEAN, cfg.INPUT.PIXEL_STD,
+    ))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return os.path.join(cfg.MODEL.FEATURE_CACHE, f'{cfg.DATASET.NAME}_{digest}_client{idx}_{split}')
+
+
+def sample_ids(data_source):
+    """The file every sample of a split is read from, None if the dataset does not expose them."""
+    files = getattr(data_source, 'data_files', None)
+    if files is None:
+        files = getattr(data_source, 'paths', None)
+    if files is None:
+        return None
+    files = list(files)
+    return np.array([str(files[i]) for i in range(len(data_source))])
+
+
+@torch.no_grad()
+def encode_split(cfg, model, data_source, prefix, device):
+    """Encode a client split once into ``<prefix>.npy`` (N x feature shape, fp16)."""
+    loader = build_data_loader(cfg, data_source, cfg.DATALOADER.TEST.BATCH_SIZE, is_train=False)
+    was_training = model.training
+    model.eval()
+    tmp_path = f'{prefix}.{os.getpid()}.tmp.npy'
+    features = None
+    labels, attrs = [], []
+    for batch in loader:
+        output = model.encode_image(batch['img'].to(device, non_blocking=True))
+        if features is None:
+            features = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float16, shape=(len(data_source),) + tuple(output.shape[1:])
+            )
+        features[batch['index'].numpy()] = output.half().cpu().numpy()
+        labels.append(batch['label'])
+        if 'attrs' in batch:
+            attrs.append(batch['attrs'])
+    model.train(was_training)
+    features.flush()
+    del features
+    os.replace(tmp_path, prefix + '.npy')
+
+    # written last, its presence marks a complete cache entry
+    meta = {'labels': torch.cat(labels).numpy()}
+    ids = sample_ids(data_source)
+    if ids is not None:
+        meta['ids'] = ids
+    if attrs:
+        meta['attrs'] = torch.cat(attrs).numpy()
+    tmp_meta_path = f'{prefix}_meta.{os.getpid()}.tmp.npz'
+    np.savez(tmp_meta_path, **meta)
+    os.replace(tmp_meta_path, prefix + '_meta.npz')
+
+
+class CachedFeatures:
+    """
+    A client split as (features, label[, attrs]) samples read from the fp16
+    memmap written by encode_split(); sample i is sample i of `data_source`.
+    """
+
+    def __init__(self, prefix, data_source):
+        self.prefix = prefix
+        self.data_source = data_source
+        meta = np.load(prefix + '_meta.npz')
+        self.labels = meta['labels']
+        self.attrs = meta['attrs'] if 'attrs' in meta else None
+        self.ids = meta['ids'] if 'ids' in meta else None
+        # opened lazily so that every dataloader worker maps the file itself
+        self._features = None
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.load(self.prefix + '.npy', mmap_mode='r')
+        return self._features
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def __len__(self):
+        return len(self.labels)
+
+    def matches(self, data_source):
+        """Whether the entry holds the samples of `data_source`, in its order."""
+        ids = sample_ids(data_source)
+        if ids is None or self.ids is None:
+            return False
+        return np.array_equal(self.ids, ids)
+
+    def __getitem__(self, item):
+        features = torch.from_numpy(np.array(self.features[item]))
+        label = torch.tensor(self.labels[item])
+        if self.attrs is None:
+            return features, label
+        return features, label, torch.tensor(self.attrs[item])
+
+    def count_by_attribute(self, attribute_type):
+        return self.data_source.count_by_attribute(attribute_type)
+
+
+def cache_client_features(trainer):
+    """
+    Encode every client's train and test split once with the frozen image
+    encoder and replace the client loaders by loaders over the cached
+    features, so local training only runs the prompt/text side.
+
+    Entries under cfg.MODEL.FEATURE_CACHE are reused across runs.
+    Returns False, leaving the trainer untouched, if no cache directory is
+    set or the encoder is not frozen.
+    """
+    cfg = trainer.cfg
+    if not cfg.MODEL.FEATURE_CACHE:
+        return False
+    reason = feature_cache_blocker(trainer.model)
+    if reason is not None:
+        print(f'Image feature cache disabled: {reason}')
+        return False
+
+    os.makedirs(cfg.MODEL.FEATURE_CACHE, exist_ok=True)
+    splits = [
+        ('train', trainer.fed_train_loader_x_dict, cfg.DATALOADER.TRAIN_X.BATCH_SIZE, True),
+        ('test', trainer.fed_test_loader_x_dict, cfg.DATALOADER.TEST.BATCH_SIZE, False),
+    ]
+    for split, loaders, batch_size, is_train in splits:
+        for idx, loader in loaders.items():
+            data_source = loader.dataset.data_source
+            prefix = feature_cache_prefix(cfg, idx, split)
+            cached = CachedFeatures(prefix, data_source) if os.path.exists(prefix + '_meta.npz') else None
+            if cached is None or not cached.matches(data_source):
+                print(f'Caching image features of client {idx} ({split}) to {prefix}.npy')
+                encode_split(cfg, trainer.model, data_source, prefix, trainer.device)
+                cached = CachedFeatures(prefix, data_source)
+            loaders[idx] = build_data_loader(cfg, cached, batch_size, is_train=is_train)
+
+    trainer.model.cached_features = True
+    return True
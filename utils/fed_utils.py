@@ -1,8 +1,15 @@
+import os
+import random
 import torch
+import torch.nn as nn
 import copy
+import numpy as np
 from prettytable import PrettyTable
 
+from utils.profiler import profiler
 
+
+@profiler.timed('aggregation')
 def average_weights(w, idxs_users, datanumber_client, datanumber_client_by_attr=None, islist=False):
     """
     Returns the average of the weights.
@@ -39,6 +46,7 @@ def average_weights(w, idxs_users, datanumber_client, datanumber_client_by_attr=
 
     return w_avg
 
+@profiler.timed('aggregation')
 def average_weights_EMA(w_g, w, idxs_users, datanumber_client, datanumber_client_by_attr, epoch, max_epoch, beta=0.999, islist=False):
     """
     Returns the Exponential Moving Average (EMA) of the weights.
@@ -91,6 +99,184 @@ def average_weights_EMA(w_g, w, idxs_users, datanumber_client, datanumber_client
     return w_avg
 
 
+def trainable_state_keys(model):
+    """
+    state_dict keys of the tensors that change during local training: the
+    parameters with requires_grad and the BatchNorm running statistics.
+    """
+    state = model.state_dict(keep_vars=True)
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    for name, module in model.named_modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            prefix = f'{name}.' if name else ''
+            trainable.update(
+                prefix + b_name for b_name, buf in module.named_buffers(recurse=False)
+                if buf.is_floating_point()
+            )
+    return [key for key in state if key in trainable]
+
+
+class FlatAggregator:
+    """
+    FedAvg over the tensors that change during local training.
+
+    Only trainable parameters (the requires_grad filter of save_model_with_grad)
+    and BatchNorm running statistics are tracked; the frozen backbone is never
+    copied. Each client's tensors are packed into one row of a contiguous
+    num_clients x num_elements fp32 buffer, so averaging is a single weighted
+    sum and memory is O(trainable params x clients).
+    """
+
+    def __init__(self, model, num_clients):
+        state = model.state_dict(keep_vars=True)
+        self.keys, self.shapes, self.dtypes, self.offsets = [], [], [], [0]
+        for key in trainable_state_keys(model):
+            self.keys.append(key)
+            self.shapes.append(state[key].shape)
+            self.dtypes.append(state[key].dtype)
+            self.offsets.append(self.offsets[-1] + state[key].numel())
+        self.numel = self.offsets[-1]
+        self.device = next(iter(state.values())).device
+        self.buffer = torch.zeros(num_clients, self.numel, device=self.device)
+
+    def segments(self):
+        return zip(self.keys, self.shapes, self.offsets[:-1], self.offsets[1:])
+
+    def flatten(self, state, out=None):
+        if out is None:
+            out = torch.empty(self.numel, device=self.device)
+        for key, _, start, end in self.segments():
+            out[start:end].copy_(state[key].detach().reshape(-1))
+        return out
+
+    def unflatten(self, flat):
+        return {
+            key: flat[start:end].view(shape).to(dtype)
+            for (key, shape, start, end), dtype in zip(self.segments(), self.dtypes)
+        }
+
+    @profiler.timed('state_swap')
+    def collect(self, idx, state):
+        """Copy the tracked tensors of a trained client's state_dict into its row."""
+        self.flatten(state, out=self.buffer[idx])
+
+    def weighted_sum(self, idxs_users, datanumber_client, datanumber_client_by_attr=None):
+        """
+        Sum of the collected rows with one weight per client, its share of the
+        data. The rows of lora_S tensors are weighted by the client's share
+        of every attribute group instead.
+        """
+        idxs_users = list(idxs_users)
+        num_data = torch.tensor([datanumber_client[r] for r in idxs_users], dtype=torch.float, device=self.device)
+        weights = torch.zeros(self.buffer.shape[0], device=self.device)
+        weights[idxs_users] = num_data / num_data.sum()
+        w_avg = weights @ self.buffer
+        if datanumber_client_by_attr is not None:
+            num_data_by_attr = torch.tensor(datanumber_client_by_attr, dtype=torch.float, device=self.device)[idxs_users]
+            freqs_by_attr = num_data_by_attr / num_data_by_attr.sum(0)   # num_users x num_attrs
+            for key, shape, start, end in self.segments():
+                if 'lora_S' in key and shape[0] == freqs_by_attr.shape[1]:
+                    rows = self.buffer[idxs_users, start:end].view(len(idxs_users), shape[0], -1)
+                    w_avg[start:end] = torch.einsum('ca,cak->ak', freqs_by_attr, rows).reshape(-1)
+        return w_avg
+
+    @profiler.timed('aggregation')
+    def average(self, idxs_users, datanumber_client, datanumber_client_by_attr=None):
+        """
+        Returns the average of the collected weights as a partial state_dict,
+        same as average_weights() on the tracked keys.
+        """
+        w_avg = self.weighted_sum(idxs_users, datanumber_client, datanumber_client_by_attr)
+        return self.unflatten(w_avg)
+
+    @profiler.timed('aggregation')
+    def average_EMA(self, w_g, idxs_users, datanumber_client, datanumber_client_by_attr, epoch, max_epoch, beta=0.999):
+        """
+        Returns the EMA of the collected weights with the global weights w_g,
+        same as average_weights_EMA() on the tracked keys.
+        """
+        w_avg = self.weighted_sum(idxs_users, datanumber_client, datanumber_client_by_attr)
+        beta_decay = beta * (epoch / max(max_epoch, 1))
+        w_avg.mul_(1 - beta_decay).add_(self.flatten(w_g), alpha=beta_decay)
+        return self.unflatten(w_avg)
+
+
+class ClientStateStore:
+    """
+    Personalized client weights as one shared global state_dict plus a
+    per-client overlay of the tensors, or leading-dim row ranges of tensors,
+    that the client keeps for itself (local prompts, lora_S).
+
+    The global dict is shared by reference, so memory grows with the
+    personalized tensors only, not with full models x clients.
+    """
+
+    def __init__(self, num_clients):
+        self.global_weights = {}
+        self.overlays = [{} for _ in range(num_clients)]
+
+    def set_global(self, weights):
+        self.global_weights = weights
+
+    def personalize(self, idx, state, key, rows=None):
+        """Keep state[key], or only rows (start, stop) of it, as client idx's own."""
+        value = state[key] if rows is None else state[key][rows[0]:rows[1]]
+        self.overlays[idx][key] = (rows, value.detach().clone())
+
+    def weights(self, idx):
+        """
+        The client's weights for load_state_dict: the global tensors with its
+        overlay on top. Only tensors personalized by rows are copied.
+        """
+        weights = dict(self.global_weights)
+        for key, (rows, value) in self.overlays[idx].items():
+            if rows is None:
+                weights[key] = value
+            else:
+                weights[key] = weights[key].clone()
+                weights[key][rows[0]:rows[1]] = value
+        return weights
+
+
+def get_rng_states():
+    # plain tuples and tensors only, so that checkpoints load with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    states = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def save_federated_state(state, directory, filename='federated_state.pth.tar'):
+    """Atomically write the round checkpoint, a crash never leaves a partial file."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def load_federated_state(directory, filename='federated_state.pth.tar'):
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        return None
+    # rng states have to stay on cpu, tensors are moved by the caller
+    return torch.load(path, map_location='cpu')
+
+
 def count_parameters(model, model_name):
     table = PrettyTable(["Modules", "Parameters"])
     total_params = 0
@@ -0,0 +1,114 @@
+import torch
+
+
+def sinkhorn(K, u, v, max_iter=100, thresh=1e-3, check_every=10, init=None):
+    """
+    Balanced entropic OT solved by Sinkhorn scaling.
+    K is the kernel exp(-C / eps), [bs*n_cls, M, N]
+    u is the source marginal, [bs*n_cls, M]
+    v is the target marginal, [bs*n_cls, N]
+    init optionally warm-starts the target scaling c, [bs*n_cls, N]
+
+    Convergence is only checked every `check_every` iterations, so the host
+    waits for the device max_iter / check_every times instead of every step.
+    Returns the transport plan and the scalings (r, c).
+    """
+    r = torch.ones_like(u)
+    c = torch.ones_like(v) if init is None else init
+    Kt = K.transpose(1, 2)
+    for i in range(max_iter):
+        check = (i + 1) % check_every == 0
+        if check:
+            r0 = r
+        r = u / torch.matmul(K, c.unsqueeze(-1)).squeeze(-1)
+        c = v / torch.matmul(Kt, r.unsqueeze(-1)).squeeze(-1)
+        if check and (r - r0).abs().mean().item() < thresh:
+            break
+
+    T = r.unsqueeze(-1) * K * c.unsqueeze(-2)
+
+    return T, (r, c)
+
+
+def sinkhorn_log(C, u, v, eps, max_iter=100, thresh=1e-3, check_every=10, init=None):
+    """
+    Log-domain version of sinkhorn(), stable for small eps where exp(-C / eps)
+    underflows. C is the cost matrix [bs*n_cls, M, N]; init and the returned
+    scalings are log(c) and (log(r), log(c)).
+    """
+    log_K = -C / eps
+    log_u = torch.log(u)
+    log_v = torch.log(v)
+    log_r = torch.zeros_like(u)
+    log_c = torch.zeros_like(v) if init is None else init
+    for i in range(max_iter):
+        check = (i + 1) % check_every == 0
+        if check:
+            log_r0 = log_r
+        log_r = log_u - torch.logsumexp(log_K + log_c.unsqueeze(-2), dim=-1)
+        log_c = log_v - torch.logsumexp(log_K + log_r.unsqueeze(-1), dim=-2)
+        if check and (log_r.exp() - log_r0.exp()).abs().mean().item() < thresh:
+            break
+
+    T = torch.exp(log_r.unsqueeze(-1) + log_K + log_c.unsqueeze(-2))
+
+    return T, (log_r, log_c)
+
+
+def entropic_cot(a, b, K, max_iter=100, thresh=1e-3, check_every=10, init=None):
+    """
+    Unbalanced (partial) entropic OT, modified from
+    ot.partial.entropic_partial_wasserstein in torch version.
+    a is the source prob, [bs*n_cls, M]
+    b is the target prob, [bs*n_cls, N]
+    K is the kernel exp(-C / eps), [bs*n_cls, M, N]
+    init optionally warm-starts the target scaling v, [bs*n_cls, N]
+
+    The diag(1/a) K and diag(1/b) K^T products are applied as broadcast
+    row scalings. Returns the transport plan and the scalings (u, v).
+    """
+    dx = torch.ones_like(a)
+    dy = torch.ones_like(b)
+
+    Kp = K / a.unsqueeze(-1)
+    Kq = K.transpose(1, 2) / b.unsqueeze(-1)
+
+    u = dx
+    v = dy if init is None else init
+    for i in range(max_iter):
+        check = (i + 1) % check_every == 0
+        if check:
+            v0 = v
+        u = torch.minimum(dx / torch.matmul(Kp, v.unsqueeze(-1)).squeeze(-1), dx)
+        v = dy / torch.matmul(Kq, u.unsqueeze(-1)).squeeze(-1)
+        if check and (v - v0).abs().mean().item() < thresh:
+            break
+
+    T = u.unsqueeze(-1) * K * v.unsqueeze(-2)
+
+    return T, (u, v)
+
+
+def entropic_cot_log(a, b, C, eps, max_iter=100, thresh=1e-3, check_every=10, init=None):
+    """
+    Log-domain version of entropic_cot(). C is the cost matrix
+    [bs*n_cls, M, N]; init and the returned scalings are in log space.
+    """
+    log_K = -C / eps
+    log_a = torch.log(a)
+    log_b = torch.log(b)
+
+    log_u = torch.zeros_like(a)
+    log_v = torch.zeros_like(b) if init is None else init
+    for i in range(max_iter):
+        check = (i + 1) % check_every == 0
+        if check:
+            log_v0 = log_v
+        log_u = torch.clamp(log_a - torch.logsumexp(log_K + log_v.unsqueeze(-2), dim=-1), max=0)
+        log_v = log_b - torch.logsumexp(log_K + log_u.unsqueeze(-1), dim=-2)
+        if check and (log_v.exp() - log_v0.exp()).abs().mean().item() < thresh:
+            break
+
+    T = torch.exp(log_u.unsqueeze(-1) + log_K + log_v.unsqueeze(-2))
+
+    return T, (log_u, log_v)
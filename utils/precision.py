@@ -0,0 +1,51 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+# cfg.TRAINER.GLP_OT.PREC
+#   fp16: CLIP weights in fp16 (CLIP's default), no autocast
+#   fp32: CLIP weights in fp32
+#   amp:  fp32 weights, encoders under fp16 autocast on cuda (bf16 on cpu)
+#   bf16: frozen weights in bf16, trainable ones in fp32, encoders under bf16 autocast
+PRECISIONS = ["fp16", "fp32", "amp", "bf16"]
+
+
+def encoder_autocast(prec, device):
+    """Autocast region of the image/text encoders for precision `prec` on `device`."""
+    if prec == "amp" and device.type == "cuda":
+        return torch.autocast("cuda", dtype=torch.float16)
+    if prec in ("amp", "bf16"):
+        # cpu autocast only knows bf16
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def grad_scaler(prec, device):
+    # fp16 gradients underflow without loss scaling, bf16 has the exponent range of fp32
+    if prec == "amp" and device.type == "cuda":
+        return torch.cuda.amp.GradScaler()
+    return None
+
+
+def cast_frozen_weights(model, dtype):
+    """
+    Cast the frozen weights that clip.model.convert_weights() casts to fp16
+    (conv, linear, attention projections) to `dtype`. Trainable tensors such
+    as prompts, LoRA factors and BatchNorm affine parameters, and all norm
+    layers, stay in fp32.
+    """
+    def cast(tensor):
+        if isinstance(tensor, torch.Tensor) and not tensor.requires_grad:
+            tensor.data = tensor.data.to(dtype)
+
+    for module in model.modules():
+        if isinstance(module, (nn.Conv1d, nn.Conv2d, nn.Linear)):
+            cast(module.weight)
+            cast(module.bias)
+        if isinstance(module, nn.MultiheadAttention):
+            for name in ["in_proj_weight", "q_proj_weight", "k_proj_weight", "v_proj_weight",
+                         "in_proj_bias", "bias_k", "bias_v"]:
+                cast(getattr(module, name))
+        for name in ["text_projection", "proj"]:
+            cast(getattr(module, name, None))
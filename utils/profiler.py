@@ -0,0 +1,205 @@
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class RoundProfiler:
+    """
+    Wall time and peak CUDA memory of the phases of every federated round.
+
+    Code marks phases with ``with profiler.phase(name):`` (or the
+    ``profiler.timed(name)`` decorator); both are no-ops until enable() is
+    called, so the instrumented code paths cost nothing by default.
+    When enabled, the device is synchronized at phase boundaries so that
+    asynchronous CUDA work is charged to the phase that launched it.
+
+    Every round is appended to ``<output_dir>/profile.jsonl`` (one phase
+    per line) and summarized on stdout; close() converts the log into
+    ``<output_dir>/trace.json`` for chrome://tracing or Perfetto, and the
+    totals of the whole run into ``<output_dir>/summary.json``, which
+    compare() lines up across runs of different settings.
+    Phases may nest, e.g. image_encode inside evaluation.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.round = -1
+        self.client = -1
+        self._events = []
+        self._stack = []
+        self._totals = defaultdict(lambda: {'total_s': 0., 'calls': 0, 'peak_mib': 0.})
+
+    def enable(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.jsonl_path = os.path.join(output_dir, 'profile.jsonl')
+        open(self.jsonl_path, 'w').close()
+        self.cuda = torch.cuda.is_available()
+        self._t0 = time.perf_counter()
+        self._totals.clear()
+        self.enabled = True
+
+    def phase(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    def timed(self, name):
+        """Decorator running the whole function as one phase."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def _phase(self, name):
+        start = self._begin()
+        try:
+            yield
+        finally:
+            self._end(name, start)
+
+    def _begin(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+            if self._stack:
+                # the enclosing phase keeps the peak reached so far
+                self._stack[-1] = max(self._stack[-1], torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        self._stack.append(0)
+        return time.perf_counter()
+
+    def _end(self, name, start):
+        peak = self._stack.pop()
+        if self.cuda:
+            torch.cuda.synchronize()
+            peak = max(peak, torch.cuda.max_memory_allocated())
+            if self._stack:
+                self._stack[-1] = max(self._stack[-1], peak)
+        self._record(name, start, time.perf_counter() - start, peak if self.cuda else None)
+
+    def add(self, name, duration):
+        """Record a phase timed by the caller that ended just now, e.g. waiting for a batch."""
+        if self.enabled:
+            self._record(name, time.perf_counter() - duration, duration, None)
+
+    def _record(self, name, start, duration, peak):
+        self._events.append({
+            'name': name, 'round': self.round, 'client': self.client, 'depth': len(self._stack),
+            'start': start - self._t0, 'dur': duration, 'peak_mem': peak,
+        })
+
+    def start_round(self, round):
+        self.flush()
+        self.round = round
+        self.client = -1
+
+    def flush(self):
+        """Append the phases recorded since the last flush to the log and print their totals."""
+        if not self.enabled or not self._events:
+            return
+        with open(self.jsonl_path, 'a') as f:
+            for event in self._events:
+                f.write(json.dumps(event) + '\n')
+
+        total, count, peak = defaultdict(float), defaultdict(int), defaultdict(int)
+        for event in self._events:
+            total[event['name']] += event['dur']
+            count[event['name']] += 1
+            peak[event['name']] = max(peak[event['name']], event['peak_mem'] or 0)
+        for name in total:
+            run = self._totals[name]
+            run['total_s'] += total[name]
+            run['calls'] += count[name]
+            run['peak_mib'] = max(run['peak_mib'], peak[name] / 2 ** 20)
+        print(f"=> profile of round {self.round}")
+        for name in sorted(total, key=total.get, reverse=True):
+            line = f"* {name}: {total[name]:.3f}s ({count[name]} calls)"
+            if self.cuda:
+                line += f", peak {peak[name] / 2 ** 20:.0f} MiB"
+            print(line)
+        self._events = []
+
+    def close(self, summary=None):
+        """
+        Flush the last round and write the whole log as a Chrome trace.
+
+        The phase totals of the run are written to summary.json together
+        with ``summary``, e.g. the settings and the final accuracy.
+        """
+        if not self.enabled:
+            return
+        self.flush()
+        with open(os.path.join(self.output_dir, 'summary.json'), 'w') as f:
+            json.dump(dict(summary or {}, phases=self._totals), f, indent=2)
+        pid = os.getpid()
+        trace_path = os.path.join(self.output_dir, 'trace.json')
+        with open(self.jsonl_path) as src, open(trace_path, 'w') as dst:
+            dst.write('{"traceEvents": [\n')
+            for i, line in enumerate(src):
+                event = json.loads(line)
+                args = {'round': event['round'], 'client': event['client']}
+                if event['peak_mem'] is not None:
+                    args['peak_mem_mib'] = event['peak_mem'] / 2 ** 20
+                dst.write(('' if i == 0 else ',\n') + json.dumps({
+                    'name': event['name'], 'cat': 'phase', 'ph': 'X', 'pid': pid, 'tid': 0,
+                    'ts': event['start'] * 1e6, 'dur': event['dur'] * 1e6, 'args': args,
+                }))
+            dst.write('\n]}\n')
+        print(f"Profile written to {self.jsonl_path} and {trace_path}")
+        self.enabled = False
+
+
+# shared by the trainers, the aggregation helpers and federated_main
+profiler = RoundProfiler()
+
+
+COMPARED_PHASES = ('image_encode', 'ot_solve', 'backward')
+
+
+def compare(output_dirs):
+    """
+    Print one line per run with the settings, wall time, peak CUDA memory
+    and final metrics from ``<output_dir>/profile/summary.json``, e.g. to
+    weigh --grad_checkpoint or --token_reduction against the baseline.
+    """
+    rows = []
+    for output_dir in output_dirs:
+        with open(os.path.join(output_dir, 'profile', 'summary.json')) as f:
+            summary = json.load(f)
+        phases = summary['phases']
+        row = {'run': os.path.basename(os.path.normpath(output_dir))}
+        row.update(summary.get('settings', {}))
+        row['wall_s'] = summary.get('wall_time')
+        for name in COMPARED_PHASES:
+            row[name + '_s'] = phases.get(name, {}).get('total_s')
+        row['peak_mib'] = max((phase['peak_mib'] for phase in phases.values()), default=0.)
+        row['acc'] = summary.get('acc')
+        row['auc'] = summary.get('auc')
+        rows.append(row)
+
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    def fmt(value):
+        if value is None:
+            return '-'
+        return f'{value:.3f}' if isinstance(value, float) else str(value)
+    cells = [columns] + [[fmt(row.get(key)) for key in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    for line in cells:
+        print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)))
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='compare the --profile summaries of several runs')
+    parser.add_argument('output_dirs', nargs='+', help='--output-dir of runs trained with --profile True')
+    compare(parser.parse_args().output_dirs)
@@ -0,0 +1,37 @@
+import torch
+
+
+class TextFeatureCache:
+    """
+    Caches the text-encoder features of a fixed set of prompts.
+
+    The entry is keyed on the storage and version counter of every parameter
+    and buffer of the given modules. Optimizer steps and load_state_dict()
+    update them in place, which bumps the version and invalidates the entry.
+    Code that writes through `.data` bypasses the version counter and has to
+    call invalidate() itself.
+    """
+
+    def __init__(self, *modules):
+        self.modules = modules
+        self.invalidate()
+
+    def invalidate(self):
+        self.key = None
+        self.features = None
+
+    def version(self):
+        tensors = [t for m in self.modules for t in (*m.parameters(), *m.buffers())]
+        return tuple((t.data_ptr(), t._version) for t in tensors)
+
+    def __call__(self, compute):
+        # the features have to stay in the autograd graph while prompts are trained
+        if torch.is_grad_enabled() and any(p.requires_grad for m in self.modules for p in m.parameters()):
+            self.invalidate()
+            return compute()
+
+        key = self.version()
+        if key != self.key:
+            self.features = compute()
+            self.key = key
+        return self.features
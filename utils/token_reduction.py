@@ -0,0 +1,74 @@
+import math
+
+import torch
+from torch.nn import functional as F
+
+# cfg.TRAINER.GLP_OT.TOKEN_REDUCTION
+TOKEN_REDUCTIONS = ['none', 'topk', 'avgpool', 'merge']
+
+
+def topk_tokens(x, pool, k):
+    """The k tokens of x [M, b, d] most similar to the pooled feature pool [b, d]."""
+    score = torch.einsum('mbd,bd->mb', F.normalize(x, dim=2), F.normalize(pool, dim=1))
+    idx = score.topk(k, dim=0).indices                     # k x b
+    return x.gather(0, idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+
+def avgpool_tokens(x, k):
+    """Average pool the g x g token grid of x [M, b, d] to round(sqrt(k))^2 tokens."""
+    M, b, d = x.shape
+    g = math.isqrt(M)
+    assert g * g == M, f'{M} tokens are not a square grid'
+    s = max(1, round(math.sqrt(k)))
+    x = x.permute(1, 2, 0).reshape(b, d, g, g)
+    x = F.adaptive_avg_pool2d(x, s)
+    return x.reshape(b, d, s * s).permute(2, 0, 1)
+
+
+def merge_tokens(x, k):
+    """
+    Bipartite soft matching as in ToMe (Bolya et al., 2023): the tokens of
+    x [M, b, d] are split into alternating sets A and B, and the A tokens most
+    similar to their best B match are averaged into it, until k tokens remain.
+    Returns the merged tokens [k, b, d] and how many input tokens each one
+    stands for [k, b].
+    """
+    x = x.transpose(0, 1)                                  # b x M x d
+    size = torch.ones(x.shape[:2] + (1,), dtype=x.dtype, device=x.device)
+    while x.shape[1] > k:
+        r = min(x.shape[1] - k, x.shape[1] // 2)
+        a, b = x[:, ::2], x[:, 1::2]
+        size_a, size_b = size[:, ::2], size[:, 1::2]
+        score = F.normalize(a, dim=-1) @ F.normalize(b, dim=-1).transpose(1, 2)
+        best, best_idx = score.max(dim=-1)                 # best B match of every A token
+        order = best.argsort(dim=-1, descending=True).unsqueeze(-1)
+        src_idx, keep_idx = order[:, :r], order[:, r:]
+        dst_idx = best_idx.unsqueeze(-1).gather(1, src_idx)
+
+        # size-weighted average of every B token and the A tokens merged into it
+        d = x.shape[-1]
+        src_size = size_a.gather(1, src_idx)
+        b = (b * size_b).scatter_add(1, dst_idx.expand(-1, -1, d), a.gather(1, src_idx.expand(-1, -1, d)) * src_size)
+        size_b = size_b.scatter_add(1, dst_idx, src_size)
+        x = torch.cat([a.gather(1, keep_idx.expand(-1, -1, d)), b / size_b], dim=1)
+        size = torch.cat([size_a.gather(1, keep_idx), size_b], dim=1)
+    return x.transpose(0, 1), size.squeeze(-1).transpose(0, 1)
+
+
+def reduce_tokens(x, pool, method, k):
+    """
+    Reduce the patch tokens x [M, b, d] of the image encoder to k before OT,
+    pool [b, d] is the pooled feature. Returns the tokens and their OT source
+    marginal [b, k] (None for uniform).
+    """
+    if method == 'none' or k <= 0 or x.shape[0] <= k:
+        return x, None
+    if method == 'topk':
+        return topk_tokens(x, pool, k), None
+    if method == 'avgpool':
+        return avgpool_tokens(x, k), None
+    if method == 'merge':
+        x, size = merge_tokens(x, k)
+        # a merged token carries the mass of the tokens it stands for
+        return x, (size / size.sum(0)).t()
+    raise NotImplementedError